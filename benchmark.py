@@ -0,0 +1,648 @@
+import argparse
+import bz2
+import gzip
+import heapq
+import random
+import time
+from itertools import islice
+
+from pyroaring import BitMap
+
+import config as cf
+from core import io_worker as iw
+from core.claims_codec import PackedClaims, unpack_claim_values, unpack_claims
+from core.claims_view import ClaimsView, decode_claims
+from core.db_core import (
+    ZstdCodec,
+    compress_bytes,
+    decompress_bytes,
+    deserialize_key,
+    deserialize_value,
+    serialize_value,
+)
+from core.db_wd import DBWikidata, parse_json_dump, parse_sql_values
+from core.dump_reader import iter_sql_dump, orjson
+
+
+def iter_sql_dump_csv(dir_dump, columns):
+    # The previous parser: decode lines to str and parse them with csv.reader
+    with gzip.open(dir_dump, "rt", encoding="utf-8", newline="\n") as f:
+        for line in f:
+            if not line.startswith("INSERT INTO"):
+                continue
+            for v in parse_sql_values(line):
+                yield tuple(v[c] for c in columns)
+
+
+def benchmark_sql(dumps=None, limit=None):
+    """
+    Compare the csv parser and the bytes tokenizer on the page and redirect dumps
+    (page_id, page_namespace, page_title)
+    """
+    if not dumps:
+        dumps = [cf.DIR_DUMP_WIKIDATA_PAGE, cf.DIR_DUMP_WIKIDATA_REDIRECT]
+    columns = (0, 1, 2)
+    for dir_dump in dumps:
+        results = {}
+        for name, reader in [
+            ("csv", iter_sql_dump_csv(dir_dump, columns)),
+            ("tokenizer", iter_sql_dump(dir_dump, columns, types=(int, int, str))),
+        ]:
+            start = time.time()
+            n_rows = sum(1 for _ in islice(reader, limit))
+            duration = time.time() - start
+            results[name] = duration
+            iw.print_status(
+                f"{dir_dump}|{name}: {n_rows:,} rows, {duration:.2f}s, "
+                f"{n_rows / max(duration, 1e-9):,.0f} rows/s"
+            )
+        iw.print_status(f"Speedup: {results['csv'] / results['tokenizer']:.2f}x")
+
+
+def benchmark_json(dir_dump=cf.DIR_DUMP_WD, limit=10000):
+    """
+    Compare parsing json dump lines with the full decoding (ujson) and with
+    skipping the unused subtrees. The lines are read to memory before parsing.
+    """
+    if ".bz2" in dir_dump:
+        reader = bz2.open(dir_dump, "rb")
+    elif ".gz" in dir_dump:
+        reader = gzip.open(dir_dump, "rb")
+    else:
+        reader = open(dir_dump, "rb")
+    with reader:
+        lines = list(islice(reader, limit))
+    n_bytes = sum(len(line) for line in lines)
+    iw.print_status(
+        f"{dir_dump}: {len(lines):,} lines, {n_bytes / len(lines) / 1024:,.1f}KB/line, "
+        f"json decoder: {'orjson' if orjson else 'ujson'}"
+    )
+
+    results = {}
+    outputs = {}
+    for name, skip_unused in [("full", False), ("skip_unused", True)]:
+        start = time.time()
+        outputs[name] = [parse_json_dump(line, skip_unused) for line in lines]
+        duration = time.time() - start
+        results[name] = duration
+        iw.print_status(
+            f"{name}: {duration:.2f}s, {len(lines) / max(duration, 1e-9):,.0f} lines/s, "
+            f"{n_bytes / max(duration, 1e-9) / 1_048_576:,.1f}MB/s"
+        )
+    if outputs["full"] != outputs["skip_unused"]:
+        iw.print_status("Error: the parsed entities are different")
+    iw.print_status(f"Speedup: {results['full'] / results['skip_unused']:.2f}x")
+
+
+def benchmark_languages(wd_ids=("Q31",), lang="ja", n=10000):
+    """
+    Compare getting one language of labels, descriptions, and aliases from the
+    values of all languages and from the language keyed stores
+    """
+    db = DBWikidata()
+    if not db.is_build_stage_done("language_keys"):
+        iw.print_status(
+            "Build the language keyed stores: DBWikidata().build_language_keys()"
+        )
+        return
+    compress_values = db.get_compress_values()
+    for attr, get_lang_value, db_all in [
+        ("labels", db.get_labels, db.db_labels),
+        ("descriptions", db.get_descriptions, db.db_descriptions),
+        ("aliases", db.get_aliases, db.db_aliases),
+    ]:
+        lids = [db.get_lid(wd_id) for wd_id in wd_ids]
+        results = {}
+        for name, get_value in [
+            (
+                "all languages",
+                lambda lid: (
+                    db.get_value(
+                        db_all,
+                        lid,
+                        integerkey=True,
+                        compress_value=compress_values[attr],
+                    )
+                    or {}
+                ).get(lang),
+            ),
+            ("language keys", lambda lid: get_lang_value(lid, lang)),
+        ]:
+            start = time.time()
+            for _ in range(n):
+                for lid in lids:
+                    get_value(lid)
+            duration = time.time() - start
+            results[name] = duration
+            iw.print_status(
+                f"{attr}|{name}: {duration / n / len(lids) * 1e6:.1f}us per lookup"
+            )
+        iw.print_status(
+            f"{attr}|Speedup: {results['all languages'] / results['language keys']:.1f}x"
+        )
+
+
+def benchmark_claims(limit=10000, pid="P31"):
+    """
+    Compare the msgpack and the compact claims formats on the claims of the first
+    items: size, unpacking all claims, and unpacking the entity values of a pid
+    """
+    db = DBWikidata()
+    pid = db.get_lid(pid, pid)
+    claims = [
+        claim
+        for _, claim in db.get_db_iter(
+            db.db_claims,
+            to_i=limit,
+            integerkey=True,
+            bytes_value=db.get_claims_bytes_value(),
+            compress_value=db.get_compress_values()["claims"],
+        )
+    ]
+    c_type = "wikibase-entityid"
+    results = {}
+    for name, bytes_value, get_pid_values in [
+        (
+            "msgpack",
+            cf.ToBytesType.OBJ,
+            lambda value: deserialize_value(value, compress_value=True)
+            .get(c_type, {})
+            .get(pid),
+        ),
+        (
+            "compact",
+            cf.ToBytesType.CLAIMS,
+            lambda value: unpack_claim_values(decompress_bytes(value), pid, c_type),
+        ),
+    ]:
+        values = [
+            serialize_value(claim, bytes_value=bytes_value, compress_value=True)
+            for claim in claims
+        ]
+        start = time.time()
+        for value in values:
+            deserialize_value(value, bytes_value=bytes_value, compress_value=True)
+        duration_all = time.time() - start
+        start = time.time()
+        for value in values:
+            get_pid_values(value)
+        duration_pid = time.time() - start
+        results[name] = duration_pid
+        iw.print_status(
+            f"{name}: {sum(len(value) for value in values) / len(values):.0f} bytes, "
+            f"all claims: {duration_all / len(values) * 1e6:.1f}us, "
+            f"values of a pid: {duration_pid / len(values) * 1e6:.1f}us per item"
+        )
+    iw.print_status(
+        f"Values of a pid|Speedup: {results['msgpack'] / results['compact']:.1f}x"
+    )
+
+
+def benchmark_zstd(limit=10000):
+    """
+    Compare lz4 and zstd with a trained dictionary on the values of the first
+    items of labels, descriptions, aliases, sitelinks, and claims: size and
+    decompression time
+    """
+    db = DBWikidata()
+    for attr, compress_value in db.get_compress_values().items():
+        db_attr = getattr(db, f"db_{attr}")
+        values = [
+            decompress_bytes(value, compress_value)
+            for _, value in db.get_db_iter(db_attr, deserialize_obj=False, to_i=limit)
+        ]
+        if not values:
+            continue
+        if isinstance(compress_value, ZstdCodec):
+            codec = compress_value
+        else:
+            dict_data = db.train_zstd_dict(db_attr)
+            if dict_data is None:
+                iw.print_status(f"{attr}|Too few values to train a dictionary")
+                continue
+            codec = ZstdCodec(dict_data)
+        results = {}
+        for name, compress_value in [("lz4", True), ("zstd", codec)]:
+            compressed = [compress_bytes(value, compress_value) for value in values]
+            start = time.time()
+            for value in compressed:
+                decompress_bytes(value, compress_value)
+            duration = time.time() - start
+            size = sum(len(value) for value in compressed)
+            results[name] = size
+            iw.print_status(
+                f"{attr}|{name}: {size / len(values):.0f} bytes, "
+                f"decompress: {duration / len(values) * 1e6:.1f}us per value"
+            )
+        iw.print_status(
+            f"{attr}|Size: {results['zstd'] / results['lz4'] * 100:.0f}% of lz4, "
+            f"dictionary: {len(codec.dict_data) / 1024:.0f}KB"
+        )
+
+
+def benchmark_ids(n=10, limit=100000, repeat=100):
+    """
+    Compare decoding the claims of the items with the largest claims (get_qid is
+    called for each value) with the trie and with the item arrays
+    """
+    db = DBWikidata()
+    # Measure the reads, not the caches
+    db.caches = dict.fromkeys(db.caches)
+    item_arrays = db.get_item_arrays()
+    if item_arrays is None or item_arrays.lid_codes is None:
+        iw.print_status("Build the item arrays: DBWikidata().build_item_arrays()")
+        return
+    lids = [
+        deserialize_key(key, integerkey=True)
+        for _, key in heapq.nlargest(
+            n,
+            (
+                (len(value), key)
+                for key, value in db.get_db_iter(
+                    db.db_claims, deserialize_obj=False, to_i=limit
+                )
+            ),
+        )
+    ]
+    lid_values = []
+    for lid in lids:
+        claims = db.get_claims(lid, get_qid=False) or {}
+        for c_values in claims.get("wikibase-entityid", {}).values():
+            lid_values.extend(c_value["value"] for c_value in c_values)
+    wd_ids = [db.get_qid(lid) for lid in lid_values]
+    results = {}
+    for name, arrays in [("trie", None), ("item arrays", item_arrays)]:
+        # Switch the lookups of the DB between the trie and the item arrays
+        db._item_arrays = arrays
+        for func, args in [
+            ("get_claims", lids),
+            ("get_qid", lid_values),
+            ("get_lid", wd_ids),
+        ]:
+            func_obj = getattr(db, func)
+            start = time.time()
+            for _ in range(repeat):
+                for arg in args:
+                    func_obj(arg)
+            duration = time.time() - start
+            results[(name, func)] = duration
+            iw.print_status(
+                f"{name}|{func}: {duration / repeat / len(args) * 1e6:.2f}us per call"
+            )
+    for func in ["get_claims", "get_qid", "get_lid"]:
+        iw.print_status(
+            f"{func}|Speedup: "
+            f"{results[('trie', func)] / results[('item arrays', func)]:.1f}x"
+        )
+
+
+def benchmark_items(n=10000, lang="en", repeat=3):
+    """
+    Compare getting items one by one and in batch (one read transaction for all
+    items) for n random Wikidata IDs, the best of repeat runs
+    """
+    db = DBWikidata()
+    db.caches = dict.fromkeys(db.caches)
+    wd_ids = list(islice(db.keys(), n * 10))
+    wd_ids = random.sample(wd_ids, min(n, len(wd_ids)))
+    for name, get_one, get_many in [
+        ("get_item", db.get_item, db.get_items),
+        (
+            "get_labels",
+            lambda wd_id: db.get_labels(wd_id, lang),
+            lambda ids: db.get_labels_many(ids, lang),
+        ),
+        ("get_claims", db.get_claims, db.get_claims_many),
+    ]:
+        results = {}
+        for mode, func in [
+            ("one by one", lambda: [get_one(wd_id) for wd_id in wd_ids]),
+            ("batch", lambda: get_many(wd_ids)),
+        ]:
+            durations = []
+            for _ in range(repeat):
+                start = time.time()
+                func()
+                durations.append(time.time() - start)
+            results[mode] = min(durations)
+            iw.print_status(
+                f"{name}|{mode}: {results[mode] / len(wd_ids) * 1e6:.1f}us per item"
+            )
+        iw.print_status(
+            f"{name}|Speedup: {results['one by one'] / results['batch']:.1f}x"
+        )
+
+
+def benchmark_cache(n=10000, lookups=100000):
+    """
+    Compare get_label and get_claims without and with the caches. The lookups
+    draw the items from n items with Zipf weights, so the hot items are looked
+    up repeatedly.
+    """
+    db = DBWikidata()
+    wd_ids = list(islice(db.keys(), n))
+    weights = [1 / rank for rank in range(1, len(wd_ids) + 1)]
+    requests = random.choices(wd_ids, weights=weights, k=lookups)
+    caches = db.caches
+    results = {}
+    for name, c_caches in [("no caches", dict.fromkeys(caches)), ("caches", caches)]:
+        db.caches = c_caches
+        for func in ["get_label", "get_claims"]:
+            func_obj = getattr(db, func)
+            start = time.time()
+            for wd_id in requests:
+                func_obj(wd_id)
+            duration = time.time() - start
+            results[(name, func)] = duration
+            iw.print_status(
+                f"{name}|{func}: {duration / lookups * 1e6:.2f}us per lookup"
+            )
+    for func in ["get_label", "get_claims"]:
+        iw.print_status(
+            f"{func}|Speedup: "
+            f"{results[('no caches', func)] / results[('caches', func)]:.1f}x"
+        )
+    for name, stats in db.get_cache_stats().items():
+        iw.print_status(f"{name}|{stats}")
+
+
+def benchmark_views(limit=10000, pid="P31"):
+    """
+    Compare getting the claims of the first items and reading the entity values
+    of a pid (the other claims are not decoded) with decoding all claims
+    (to_dict). The views of packed claims are checked against unpack_claims
+    after a pid of each claim type is read.
+    """
+    db = DBWikidata()
+    db.caches = dict.fromkeys(db.caches)
+    wd_ids = list(islice(db.keys(), limit))
+    c_type = "wikibase-entityid"
+
+    if db.get_claims_bytes_value() == cf.ToBytesType.CLAIMS:
+        compress_value = db.get_compress_values()["claims"]
+        n_items = n_diffs = 0
+        for _, value in db.get_db_iter(db.db_claims, deserialize_obj=False, to_i=limit):
+            data = decompress_bytes(value, compress_value)
+            claims = ClaimsView(PackedClaims(data), db.get_qid, db.get_lid)
+            for c_statements in claims.values():
+                for c_pid in c_statements:
+                    c_statements[c_pid]
+                    break
+            if claims.to_dict() != decode_claims(unpack_claims(data), db.get_qid):
+                n_diffs += 1
+            n_items += 1
+        iw.print_status(
+            f"Views|{n_diffs:,} of {n_items:,} items differ from unpack_claims"
+        )
+
+    def get_pid_values(wd_id):
+        claims = db.get_claims(wd_id)
+        if claims and c_type in claims and pid in claims[c_type]:
+            return [statement["value"] for statement in claims[c_type][pid]]
+        return None
+
+    def get_all(wd_id):
+        claims = db.get_claims(wd_id)
+        return claims.to_dict() if claims else claims
+
+    results = {}
+    for name, func in [("all claims", get_all), ("values of a pid", get_pid_values)]:
+        start = time.time()
+        for wd_id in wd_ids:
+            func(wd_id)
+        results[name] = time.time() - start
+        iw.print_status(f"{name}: {results[name] / len(wd_ids) * 1e6:.1f}us per item")
+    iw.print_status(
+        f"Values of a pid|Speedup: "
+        f"{results['all claims'] / results['values of a pid']:.1f}x"
+    )
+
+
+def benchmark_types(n=10000, repeat=3):
+    """
+    Compare get_all_types with the breadth-first search over the P279 claims of
+    the superclasses and with the stored closures of classes (see
+    DBWikidata.build_types), one by one and in batch (get_all_types_many), the
+    best of repeat runs
+    """
+    db = DBWikidata()
+    db.caches = dict.fromkeys(db.caches)
+    if not db.is_build_stage_done("types"):
+        db.build_types()
+    wd_ids = list(islice(db.keys(), n))
+    results = {}
+    for name, types, func in [
+        ("search", False, lambda: [db.get_all_types(wd_id) for wd_id in wd_ids]),
+        ("closures", True, lambda: [db.get_all_types(wd_id) for wd_id in wd_ids]),
+        ("closures batch", True, lambda: db.get_all_types_many(wd_ids)),
+    ]:
+        db._types = types
+        durations = []
+        for _ in range(repeat):
+            start = time.time()
+            func()
+            durations.append(time.time() - start)
+        results[name] = min(durations)
+        iw.print_status(f"{name}: {results[name] / len(wd_ids) * 1e6:.1f}us per item")
+    db._types = True
+    for name in ["closures", "closures batch"]:
+        iw.print_status(f"{name}|Speedup: {results['search'] / results[name]:.1f}x")
+
+
+def benchmark_instances(wd_id="Q486972", repeat=10):
+    """
+    Compare getting the instances of a class and of its subclasses
+    (wdt:P31/wdt:P279*) with a recursion over get_head_qid and with
+    get_all_instances, without and with the postings cache, the best of repeat
+    runs
+    """
+    db = DBWikidata()
+    caches = db.caches
+
+    def get_instances_recursion():
+        results = BitMap()
+        visited = set()
+        queue_classes = [wd_id]
+        while queue_classes:
+            c_class = queue_classes.pop()
+            if c_class in visited:
+                continue
+            visited.add(c_class)
+            posting = db.get_head_qid(c_class, "P31")
+            if posting:
+                results |= posting
+            subclasses = db.get_head_qid(c_class, "P279")
+            if subclasses:
+                queue_classes.extend(subclasses)
+        return results
+
+    results = {}
+    for name, c_caches, func in [
+        ("recursion", dict.fromkeys(caches), get_instances_recursion),
+        ("get_all_instances", dict.fromkeys(caches), None),
+        ("get_all_instances cached", caches, None),
+    ]:
+        db.caches = c_caches
+        if func is None:
+            func = lambda: db.get_all_instances(wd_id)
+        durations = []
+        for _ in range(repeat):
+            start = time.time()
+            n_instances = len(func())
+            durations.append(time.time() - start)
+        results[name] = min(durations)
+        iw.print_status(
+            f"{name}: {n_instances:,} instances, {results[name] * 1e3:.2f}ms"
+        )
+    for name in ["get_all_instances", "get_all_instances cached"]:
+        iw.print_status(f"{name}|Speedup: {results['recursion'] / results[name]:.1f}x")
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser()
+    subparsers = parser.add_subparsers(dest="benchmark")
+
+    parser_sql = subparsers.add_parser(
+        "sql", help="Parse the Wikidata page and redirect SQL dumps"
+    )
+    parser_sql.add_argument(
+        "--dumps",
+        "-d",
+        nargs="*",
+        help="SQL dump files. Default: the page and redirect dumps in config.py",
+    )
+    parser_sql.add_argument(
+        "--limit", "-l", type=int, default=None, help="Number of rows per dump"
+    )
+
+    parser_json = subparsers.add_parser(
+        "json", help="Parse entity lines of the Wikidata json dump"
+    )
+    parser_json.add_argument(
+        "--dump",
+        "-d",
+        default=cf.DIR_DUMP_WD,
+        help="Json dump file. Default: the json dump in config.py",
+    )
+    parser_json.add_argument(
+        "--limit", "-l", type=int, default=10000, help="Number of lines"
+    )
+
+    parser_languages = subparsers.add_parser(
+        "languages",
+        help="Get one language of labels, descriptions, and aliases of entities",
+    )
+    parser_languages.add_argument(
+        "--ids", "-i", nargs="*", default=["Q31"], help="Wikidata IDs"
+    )
+    parser_languages.add_argument("--lang", "-l", default="ja", help="Language")
+    parser_languages.add_argument(
+        "--n", "-n", type=int, default=10000, help="Number of lookups per ID"
+    )
+
+    parser_claims = subparsers.add_parser(
+        "claims", help="Unpack the claims of items in the msgpack and compact formats"
+    )
+    parser_claims.add_argument(
+        "--limit", "-l", type=int, default=10000, help="Number of items"
+    )
+    parser_claims.add_argument(
+        "--pid", "-p", default="P31", help="Property of the entity values"
+    )
+
+    parser_zstd = subparsers.add_parser(
+        "zstd", help="Compress the values of items with lz4 and zstd dictionaries"
+    )
+    parser_zstd.add_argument(
+        "--limit", "-l", type=int, default=10000, help="Number of items per DB"
+    )
+
+    parser_ids = subparsers.add_parser(
+        "ids",
+        help="Decode the claims of the items with the largest claims with the trie "
+        "and with the item arrays",
+    )
+    parser_ids.add_argument("--n", "-n", type=int, default=10, help="Number of items")
+    parser_ids.add_argument(
+        "--limit", "-l", type=int, default=100000, help="Number of items to scan"
+    )
+    parser_ids.add_argument(
+        "--repeat", "-r", type=int, default=100, help="Number of lookups per item"
+    )
+
+    parser_items = subparsers.add_parser(
+        "items", help="Get random items one by one and in batch"
+    )
+    parser_items.add_argument(
+        "--n", "-n", type=int, default=10000, help="Number of items"
+    )
+    parser_items.add_argument(
+        "--lang", type=str, default="en", help="Language of get_labels"
+    )
+    parser_items.add_argument(
+        "--repeat", "-r", type=int, default=3, help="Number of runs"
+    )
+
+    parser_cache = subparsers.add_parser(
+        "cache", help="Look up hot items without and with the caches"
+    )
+    parser_cache.add_argument(
+        "--n", "-n", type=int, default=10000, help="Number of items"
+    )
+    parser_cache.add_argument(
+        "--lookups", type=int, default=100000, help="Number of lookups"
+    )
+
+    parser_views = subparsers.add_parser(
+        "views", help="Read the values of a pid from the lazy views of claims"
+    )
+    parser_views.add_argument(
+        "--limit", "-l", type=int, default=10000, help="Number of items"
+    )
+    parser_views.add_argument("--pid", "-p", default="P31", help="Property")
+
+    parser_types = subparsers.add_parser(
+        "types", help="Get the types of items with the search and the closures"
+    )
+    parser_types.add_argument(
+        "--n", "-n", type=int, default=10000, help="Number of items"
+    )
+    parser_types.add_argument(
+        "--repeat", "-r", type=int, default=3, help="Number of runs"
+    )
+
+    parser_instances = subparsers.add_parser(
+        "instances", help="Get the instances of a class and of its subclasses"
+    )
+    parser_instances.add_argument(
+        "--id", "-i", default="Q486972", help="Wikidata ID of the class"
+    )
+    parser_instances.add_argument(
+        "--repeat", "-r", type=int, default=10, help="Number of runs"
+    )
+
+    args = parser.parse_args()
+    if args.benchmark == "sql":
+        benchmark_sql(dumps=args.dumps, limit=args.limit)
+    elif args.benchmark == "json":
+        benchmark_json(dir_dump=args.dump, limit=args.limit)
+    elif args.benchmark == "languages":
+        benchmark_languages(wd_ids=args.ids, lang=args.lang, n=args.n)
+    elif args.benchmark == "claims":
+        benchmark_claims(limit=args.limit, pid=args.pid)
+    elif args.benchmark == "zstd":
+        benchmark_zstd(limit=args.limit)
+    elif args.benchmark == "ids":
+        benchmark_ids(n=args.n, limit=args.limit, repeat=args.repeat)
+    elif args.benchmark == "items":
+        benchmark_items(n=args.n, lang=args.lang, repeat=args.repeat)
+    elif args.benchmark == "cache":
+        benchmark_cache(n=args.n, lookups=args.lookups)
+    elif args.benchmark == "views":
+        benchmark_views(limit=args.limit, pid=args.pid)
+    elif args.benchmark == "types":
+        benchmark_types(n=args.n, repeat=args.repeat)
+    elif args.benchmark == "instances":
+        benchmark_instances(wd_id=args.id, repeat=args.repeat)
+    else:
+        parser.print_help()
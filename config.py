@@ -17,6 +17,7 @@ DIR_MODELS = f"{DIR_ROOT}/data/models"
 DIR_WIKIDATA_ITEMS_JSON = f"{DIR_MODELS}/wikidb.lmdb"
 DIR_WIKIDATA_ITEMS_TRIE = f"{DIR_MODELS}/wikidb.trie"
 DIR_WIKIDATA_ITEMS_PAGE = f"{DIR_MODELS}/wikidb.page"
+DIR_WIKIDATA_ITEMS_ARRAYS = f"{DIR_MODELS}/wikidb.arrays"
 
 # Log
 FORMAT_DATE = "%Y_%m_%d_%H_%M"
@@ -37,6 +38,60 @@ LMDB_BUFF_BYTES_SIZE = psutil.virtual_memory().total // 10
 if LMDB_BUFF_BYTES_SIZE > SIZE_1GB:
     LMDB_BUFF_BYTES_SIZE = SIZE_1GB
 # LMDB_BUFF_BYTES_SIZE = SIZE_1MB * 10
+# Batch size of a DB handed to the LMDB writer thread, and the number of
+# batches queued per DB before the producer waits
+LMDB_WRITER_BATCH_SIZE = SIZE_1MB * 64
+LMDB_WRITER_QUEUE_SIZE = 2
+# Build with writemap and without fsync on commit (faster, but the DB can be
+# corrupted by a system crash during the build)
+LMDB_BULK_LOAD = False
+
+# Json dump shards (parallel parsing): decompressed bytes per shard
+DUMP_SHARD_SIZE = 134_217_728  # 128MB
+# Distance between seek points of the gzip dump index (each point stores a 32KB window)
+DUMP_GZIP_INDEX_SPACING = 33_554_432  # 32MB
+
+# Build profile of the json dump: None keeps everything, or a dict of
+# - languages: languages of labels, descriptions, and aliases
+# - sites: sites of sitelinks, e.g., "enwiki"
+# - attributes: label, labels, descriptions, aliases, claims, sitelinks
+# - claim_types: datavalue types of claims, e.g., wikibase-entityid, time
+# - references: keep the references of claims (default: True)
+# - instance_of: keep only the entities which are instances (P31) of these QIDs
+# A missing key (or None) keeps everything of this key, e.g.,
+# BUILD_PROFILE = {
+#     "languages": ["en", "ja", "de", "fr", "vi"],
+#     "attributes": ["label", "labels", "descriptions", "aliases", "claims"],
+#     "references": False,
+# }
+BUILD_PROFILE = None
+# Also store labels, descriptions, and aliases keyed by (lid, language), so getting
+# one language does not decompress the values of all languages (see
+# DBWikidata.build_language_keys)
+BUILD_LANGUAGE_KEYS = False
+# Compress labels, descriptions, aliases, sitelinks, and claims with zstd
+# dictionaries trained on their values instead of lz4 (requires zstandard, see
+# DBWikidata.build_zstd_dicts)
+BUILD_ZSTD_DICTS = False
+ZSTD_LEVEL = 3
+ZSTD_DICT_SIZE = 112_640  # 110KB
+# Number of values sampled from a DB to train its dictionary
+ZSTD_DICT_SAMPLES = 100_000
+# Memory mapped arrays of the labels and redirects of lids, get_label and
+# get_redirect read them without LMDB transactions (see
+# DBWikidata.build_item_arrays)
+BUILD_ITEM_ARRAYS = False
+# Direct P31 and P279 values of items and the transitive P279 closure of each
+# class, get_all_types reads them instead of the claims of every superclass (see
+# DBWikidata.build_types)
+BUILD_TYPES = True
+
+# Byte budgets of the LRU caches of DBWikidata (None disables a cache): labels
+# (get_label), decoded claims (get_claims), and postings of db_claim_ent_inv
+# (get_head_qid). The caches are cleared when a delta is applied.
+CACHE_LABELS_BYTES = 67_108_864  # 64MB
+CACHE_CLAIMS_BYTES = 536_870_912  # 512MB
+CACHE_POSTINGS_BYTES = 268_435_456  # 256MB
 
 
 # Enum
@@ -44,6 +99,7 @@ class ToBytesType:
     OBJ = 0
     INT_NUMPY = 1
     INT_BITMAP = 2
+    CLAIMS = 3  # core.claims_codec
 
 
 class DBUpdateType:
@@ -57,6 +113,10 @@ class ATTR_OPTS:
     NOT = "NOT"
 
 
+# Property path of get_haswbstatements: the instances of a class and of its
+# subclasses (wdt:P31/wdt:P279*)
+PATH_INSTANCE_OF = "P31/P279*"
+
 WD = "http://www.wikidata.org/entity/"
 WDT = "http://www.wikidata.org/prop/direct/"
 
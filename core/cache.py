@@ -0,0 +1,108 @@
+import sys
+import threading
+from collections import OrderedDict
+
+from pyroaring import AbstractBitMap
+
+# Default of LRUCache.get, None can be a cached value
+MISSING = object()
+
+
+def get_obj_size(obj):
+    """
+    Approximate memory size (bytes) of a decoded value: strings, numbers,
+    BitMaps, and the dicts, lists, tuples, and sets of them
+    """
+    size = sys.getsizeof(obj)
+    if isinstance(obj, dict):
+        for key, value in obj.items():
+            size += get_obj_size(key) + get_obj_size(value)
+    elif isinstance(obj, (list, tuple, set, frozenset)):
+        for value in obj:
+            size += get_obj_size(value)
+    elif isinstance(obj, AbstractBitMap):
+        stats = obj.get_statistics()
+        size += (
+            stats["n_bytes_array_containers"]
+            + stats["n_bytes_run_containers"]
+            + stats["n_bytes_bitset_containers"]
+        )
+    return size
+
+
+class LRUCache(object):
+    """
+    Least recently used cache with a byte budget: the least recently used
+    entries are evicted when the sizes of the entries exceed max_bytes. The
+    threads share it (one lock). The cached values are shared by the callers of
+    get, they must not be modified.
+
+    clear starts a new generation. A reader takes the generation before reading
+    a value from the DB and passes it to put, so a value read before an update
+    is not cached after the update cleared the cache.
+    """
+
+    def __init__(self, max_bytes):
+        self.max_bytes = max_bytes
+        self.generation = 0
+        self.n_bytes = 0
+        self.hits = 0
+        self.misses = 0
+        self.evictions = 0
+        self._items = OrderedDict()
+        self._lock = threading.Lock()
+
+    def __len__(self):
+        return len(self._items)
+
+    def get(self, key, default=MISSING):
+        with self._lock:
+            item = self._items.get(key)
+            if item is None:
+                self.misses += 1
+                return default
+            self._items.move_to_end(key)
+            self.hits += 1
+            return item[0]
+
+    def put(self, key, value, size=None, generation=None):
+        """
+        :param size: size of the value (bytes), default: get_obj_size(value)
+        :param generation: generation when the value was read, the value is
+        not cached if the cache was cleared after it
+        """
+        if size is None:
+            size = get_obj_size(value)
+        if size > self.max_bytes:
+            return
+        with self._lock:
+            if generation is not None and generation != self.generation:
+                return
+            item = self._items.pop(key, None)
+            if item is not None:
+                self.n_bytes -= item[1]
+            self._items[key] = (value, size)
+            self.n_bytes += size
+            while self.n_bytes > self.max_bytes:
+                _, (_, c_size) = self._items.popitem(last=False)
+                self.n_bytes -= c_size
+                self.evictions += 1
+
+    def clear(self):
+        with self._lock:
+            self._items.clear()
+            self.n_bytes = 0
+            self.generation += 1
+
+    def get_stats(self):
+        with self._lock:
+            n_lookups = self.hits + self.misses
+            return {
+                "entries": len(self._items),
+                "bytes": self.n_bytes,
+                "max_bytes": self.max_bytes,
+                "hits": self.hits,
+                "misses": self.misses,
+                "hit_rate": self.hits / n_lookups if n_lookups else 0.0,
+                "evictions": self.evictions,
+            }
@@ -0,0 +1,585 @@
+"""
+Compact binary format of the claims of an item (config.ToBytesType.CLAIMS)
+
+The claims {claim type: {pid: [{"value": value}, ...]}} of an item are stored
+column by column instead of nested msgpack maps (little endian):
+
+header   version (uint8), then uint32: number of types, groups, slots, col32 values,
+         col64 values, strings, and the size of the objects
+types    type refs uint32[types], group ends uint32[types]
+groups   a group is the values of a pid, in the order of the claims:
+         pids uint32[groups], slot ends uint32[groups]
+kinds    uint8[slots], a value is a slot, a quantity is two slots (amount, unit),
+         a globe coordinate is five slots (see COORDINATE_KEYS)
+col32    uint32[col32]: local IDs, string and object indexes
+col64    int64[col64]: integers, floats, dates, and numbers of quantities
+strings  uint32 offsets[strings + 1] and the utf-8 bytes of the strings
+objects  msgpack list of the other values
+
+A type ref is an index of CLAIM_TYPES, a pid is a local ID, or they are a string
+index with STR_FLAG (e.g., properties which are not in the trie). The values of
+a type ref with STR_FLAG are one slot each, e.g., quantities which are not
+(amount, unit). The statement order is the order of the claims, so the statement
+indexes of db_references are kept.
+"""
+
+import re
+import struct
+from bisect import bisect_right
+from collections.abc import Mapping
+
+import msgpack
+
+CLAIMS_VERSION = 1
+
+CLAIM_TYPES = [
+    "wikibase-entityid",
+    "time",
+    "quantity",
+    "string",
+    "monolingualtext",
+    "globecoordinate",
+]
+CLAIM_TYPE_IDS = {c_type: i for i, c_type in enumerate(CLAIM_TYPES)}
+TYPE_QUANTITY = CLAIM_TYPE_IDS["quantity"]
+TYPE_COORDINATE = CLAIM_TYPE_IDS["globecoordinate"]
+COORDINATE_KEYS = ("latitude", "longitude", "altitude", "precision", "globe")
+# Number of slots of a value of the claim types, the others are one slot
+TYPE_SLOTS = {TYPE_QUANTITY: 2, TYPE_COORDINATE: len(COORDINATE_KEYS)}
+
+STR_FLAG = 0x80000000
+
+# Approximate memory size of unpacked claims (dicts and lists) per packed byte
+UNPACKED_SIZE_RATIO = 20
+
+# Kinds of slots
+KIND_ID = 0  # col32
+KIND_STR = 1  # col32
+KIND_OBJ = 2  # col32
+KIND_NEG = 3  # col32, a negative int32, e.g., -1 of quantities without units
+KIND_INT = 4  # col64
+KIND_FLOAT = 5  # col64
+KIND_DATE = 6  # col64
+KIND_INT_STR = 7  # col64
+KIND_FLOAT_STR = 8  # col64
+KIND_NONE = 9
+# Columns of the kinds (0: col32, 1: col64, 2: none), to count the values of
+# slots in the columns
+COL_32, COL_64, COL_NONE = 0, 1, 2
+KIND_COLUMNS = bytes(
+    COL_32 if i < KIND_INT else COL_64 if i < KIND_NONE else COL_NONE
+    for i in range(256)
+)
+
+HEADER = struct.Struct("<B7I")
+INT64 = struct.Struct("<q")
+FLOAT64 = struct.Struct("<d")
+UINT32_MAX = 0xFFFFFFFF
+UINT32_SIZE = 1 << 32
+INT32_MIN = -(1 << 31)
+INT64_MIN = -(1 << 63)
+INT64_MAX = (1 << 63) - 1
+DATE_YEAR_MAX = 1 << 53
+
+NUMBER_CHARS = "-0123456789"
+RE_INT = re.compile(r"-?(?:0|[1-9][0-9]*)")
+RE_FLOAT = re.compile(r"-?[0-9]+\.[0-9]+")
+RE_DATE = re.compile(r"(-?)([0-9]{4,})-([0-9]{2})-([0-9]{2})")
+
+
+def pack_date(year, month, day):
+    return (year << 9) | (month << 5) | day
+
+
+def unpack_date(value):
+    year = value >> 9
+    sign = "-" if year < 0 else ""
+    return f"{sign}{abs(year):04d}-{(value >> 5) & 15:02d}-{value & 31:02d}"
+
+
+def pack_str_number(value):
+    """
+    :return: (kind, number) of a string which is a date, an integer, or a decimal,
+    None if the string can not be restored exactly from a number
+    """
+    if not value or value[0] not in NUMBER_CHARS:
+        return None
+    match = RE_DATE.fullmatch(value)
+    if match:
+        year = int(match.group(2))
+        if match.group(1):
+            year = -year
+        month, day = int(match.group(3)), int(match.group(4))
+        if abs(year) < DATE_YEAR_MAX and month <= 12 and day <= 31:
+            number = pack_date(year, month, day)
+            if unpack_date(number) == value:
+                return KIND_DATE, number
+        return None
+    if RE_INT.fullmatch(value):
+        number = int(value)
+        if INT64_MIN <= number <= INT64_MAX and str(number) == value:
+            return KIND_INT_STR, number
+        return None
+    if RE_FLOAT.fullmatch(value) and repr(float(value)) == value:
+        return KIND_FLOAT_STR, float(value)
+    return None
+
+
+def get_slot_values(type_id, value):
+    """
+    :return: values of the slots of a value of a known claim type, None if the
+    value does not have the slots of the type
+    """
+    if type_id == TYPE_QUANTITY:
+        if isinstance(value, (list, tuple)) and len(value) == 2:
+            return value
+        return None
+    if type_id == TYPE_COORDINATE:
+        if isinstance(value, dict) and tuple(value) == COORDINATE_KEYS:
+            return list(value.values())
+        return None
+    return (value,)
+
+
+def pack_claims(claims):
+    """
+    Serialize the claims of an item (values only, the references are stored in
+    db_references)
+    :param claims: {claim type: {pid: [{"value": value}, ...]}}, pids and entity
+    values are local IDs, a quantity is (amount, unit)
+    :return: bytes
+    """
+    strings = {}
+    objects = []
+    types, type_ends, pids, ends = [], [], [], []
+    kinds, col32, col64 = [], [], []
+
+    def get_str_id(value):
+        str_id = strings.get(value)
+        if str_id is None:
+            str_id = strings[value] = len(strings)
+        return str_id
+
+    def get_ref(value):
+        if type(value) is int and 0 <= value < STR_FLAG:
+            return value
+        if isinstance(value, str):
+            return STR_FLAG | get_str_id(value)
+        raise ValueError(f"Invalid claim key: {value!r}")
+
+    def add_slot(value):
+        value_type = type(value)
+        if value_type is int:
+            if 0 <= value <= UINT32_MAX:
+                kinds.append(KIND_ID)
+                col32.append(value)
+                return
+            if INT32_MIN <= value < 0:
+                kinds.append(KIND_NEG)
+                col32.append(value + UINT32_SIZE)
+                return
+            if INT64_MIN <= value <= INT64_MAX:
+                kinds.append(KIND_INT)
+                col64.append(INT64.pack(value))
+                return
+        elif value_type is str:
+            number = pack_str_number(value)
+            if number:
+                kind, number = number
+                kinds.append(kind)
+                if kind == KIND_FLOAT_STR:
+                    col64.append(FLOAT64.pack(number))
+                else:
+                    col64.append(INT64.pack(number))
+            else:
+                kinds.append(KIND_STR)
+                col32.append(get_str_id(value))
+            return
+        elif value_type is float:
+            kinds.append(KIND_FLOAT)
+            col64.append(FLOAT64.pack(value))
+            return
+        elif value is None:
+            kinds.append(KIND_NONE)
+            return
+        kinds.append(KIND_OBJ)
+        col32.append(len(objects))
+        objects.append(value)
+
+    for c_type, c_statements in claims.items():
+        type_id = CLAIM_TYPE_IDS.get(c_type)
+        if type_id is None:
+            type_id = get_ref(c_type)
+        types.append(type_id)
+        type_ends.append(len(pids))
+        n_slots = TYPE_SLOTS.get(type_id, 1)
+        for c_prop, c_values in c_statements.items():
+            for c_value in c_values:
+                if len(c_value) != 1 or "value" not in c_value:
+                    raise ValueError("Only the values of statements can be packed")
+            values = [c_value["value"] for c_value in c_values]
+            if n_slots > 1:
+                slots = [get_slot_values(type_id, value) for value in values]
+                if None in slots:
+                    # Values are one slot each in a group of the type name
+                    if types[-1] == type_id:
+                        types.append(STR_FLAG | get_str_id(c_type))
+                        type_ends.append(len(pids))
+                else:
+                    if types[-1] != type_id:
+                        types.append(type_id)
+                        type_ends.append(len(pids))
+                    values = [value for slot in slots for value in slot]
+            for value in values:
+                add_slot(value)
+            pids.append(get_ref(c_prop))
+            ends.append(len(kinds))
+            type_ends[-1] = len(pids)
+
+    strings = [s.encode("utf-8") for s in strings]
+    offsets = [0]
+    for s in strings:
+        offsets.append(offsets[-1] + len(s))
+    objects = msgpack.packb(objects) if objects else b""
+    return b"".join(
+        [
+            HEADER.pack(
+                CLAIMS_VERSION,
+                len(types),
+                len(pids),
+                len(kinds),
+                len(col32),
+                len(col64),
+                len(strings),
+                len(objects),
+            ),
+            struct.pack(f"<{len(types) * 2}I", *types, *type_ends),
+            struct.pack(f"<{len(pids) * 2}I", *pids, *ends),
+            bytes(kinds),
+            struct.pack(f"<{len(col32)}I", *col32),
+            b"".join(col64),
+            struct.pack(f"<{len(offsets)}I", *offsets),
+        ]
+        + strings
+        + [objects]
+    )
+
+
+class ClaimsReader(object):
+    """
+    Read the packed claims of an item. The types and groups are unpacked when it
+    is created, the values are unpacked by slot ranges.
+    """
+
+    def __init__(self, data):
+        (
+            version,
+            n_types,
+            n_groups,
+            n_slots,
+            n_col32,
+            n_col64,
+            n_strings,
+            size_objects,
+        ) = HEADER.unpack_from(data, 0)
+        if version != CLAIMS_VERSION:
+            raise ValueError(f"Unknown claims version: {version}")
+        self.data = data
+        offset = HEADER.size
+        types = struct.unpack_from(f"<{n_types * 2}I", data, offset)
+        self.types, self.type_ends = types[:n_types], types[n_types:]
+        offset += n_types * 8
+        groups = struct.unpack_from(f"<{n_groups * 2}I", data, offset)
+        self.pids, self.ends = groups[:n_groups], groups[n_groups:]
+        self.off_kinds = offset + n_groups * 8
+        self.off_col32 = self.off_kinds + n_slots
+        self.off_col64 = self.off_col32 + n_col32 * 4
+        self.off_strings = self.off_col64 + n_col64 * 8
+        self.off_blob = self.off_strings + (n_strings + 1) * 4
+        self.off_objects = len(data) - size_objects
+        self.n_slots = n_slots
+        self.n_col32 = n_col32
+        self.n_col64 = n_col64
+        self.n_strings = n_strings
+        self._columns = None
+        self._objects = None
+
+    def get_str(self, str_id):
+        start, end = struct.unpack_from("<2I", self.data, self.off_strings + str_id * 4)
+        return str(self.data[self.off_blob + start : self.off_blob + end], "utf-8")
+
+    def get_strs(self):
+        if not self.n_strings:
+            return []
+        data, off_blob = self.data, self.off_blob
+        offsets = struct.unpack_from(f"<{self.n_strings + 1}I", data, self.off_strings)
+        blob = str(data[off_blob : self.off_objects], "utf-8")
+        if len(blob) != offsets[-1]:
+            # Not ASCII, the offsets are not the character offsets
+            return [
+                str(data[off_blob + offsets[i] : off_blob + offsets[i + 1]], "utf-8")
+                for i in range(self.n_strings)
+            ]
+        return [blob[offsets[i] : offsets[i + 1]] for i in range(self.n_strings)]
+
+    def get_ref(self, ref, strs=None):
+        if ref & STR_FLAG:
+            ref &= ~STR_FLAG
+            return strs[ref] if strs is not None else self.get_str(ref)
+        return ref
+
+    def get_type(self, type_i, strs=None):
+        type_id = self.types[type_i]
+        if type_id & STR_FLAG:
+            return self.get_ref(type_id, strs)
+        return CLAIM_TYPES[type_id]
+
+    def get_kinds(self, start, end):
+        return bytes(self.data[self.off_kinds + start : self.off_kinds + end])
+
+    def get_slots(self, start, end, strs=None):
+        """
+        :return: values of the slots [start, end)
+        """
+        data = self.data
+        if start == 0 and end == self.n_slots:
+            start32 = start64 = 0
+            n_col32, n_col64 = self.n_col32, self.n_col64
+        else:
+            if self._columns is None:
+                kinds = self.get_kinds(0, self.n_slots)
+                self._columns = kinds.translate(KIND_COLUMNS)
+            columns = self._columns
+            start64 = columns.count(COL_64, 0, start)
+            start32 = start - start64 - columns.count(COL_NONE, 0, start)
+            n_col64 = columns.count(COL_64, start, end)
+            n_col32 = end - start - n_col64 - columns.count(COL_NONE, start, end)
+        kinds = self.get_kinds(start, end)
+        col32 = struct.unpack_from(f"<{n_col32}I", data, self.off_col32 + start32 * 4)
+        col64 = struct.unpack_from(f"<{n_col64}q", data, self.off_col64 + start64 * 8)
+        if KIND_FLOAT in kinds or KIND_FLOAT_STR in kinds:
+            floats = struct.unpack_from(
+                f"<{n_col64}d", data, self.off_col64 + start64 * 8
+            )
+        if kinds and kinds.count(kinds[0]) == len(kinds):
+            # Slots of a kind, e.g., the entity values of a type
+            kind = kinds[0]
+            if kind == KIND_ID:
+                return list(col32)
+            if kind == KIND_STR:
+                if strs is not None:
+                    return [strs[value] for value in col32]
+                return [self.get_str(value) for value in col32]
+            if kind == KIND_FLOAT:
+                return list(floats)
+            if kind == KIND_DATE:
+                return [unpack_date(value) for value in col64]
+            if kind == KIND_INT_STR:
+                return [str(value) for value in col64]
+        values = []
+        i32 = i64 = 0
+        for kind in kinds:
+            if kind == KIND_ID:
+                value = col32[i32]
+                i32 += 1
+            elif kind == KIND_STR:
+                value = col32[i32]
+                value = strs[value] if strs is not None else self.get_str(value)
+                i32 += 1
+            elif kind == KIND_FLOAT:
+                value = floats[i64]
+                i64 += 1
+            elif kind == KIND_DATE:
+                value = unpack_date(col64[i64])
+                i64 += 1
+            elif kind == KIND_INT_STR:
+                value = str(col64[i64])
+                i64 += 1
+            elif kind == KIND_FLOAT_STR:
+                value = repr(floats[i64])
+                i64 += 1
+            elif kind == KIND_NEG:
+                value = col32[i32] - UINT32_SIZE
+                i32 += 1
+            elif kind == KIND_INT:
+                value = col64[i64]
+                i64 += 1
+            elif kind == KIND_NONE:
+                value = None
+            else:
+                if self._objects is None:
+                    self._objects = msgpack.unpackb(
+                        data[self.off_objects :], strict_map_key=False
+                    )
+                value = self._objects[col32[i32]]
+                i32 += 1
+            values.append(value)
+        return values
+
+    def get_group_values(self, type_ref, values):
+        """
+        :return: values of a group from the values of its slots
+        """
+        if type_ref == TYPE_QUANTITY:
+            return [[values[i], values[i + 1]] for i in range(0, len(values), 2)]
+        if type_ref == TYPE_COORDINATE:
+            return [
+                dict(zip(COORDINATE_KEYS, values[i : i + 5]))
+                for i in range(0, len(values), 5)
+            ]
+        return values
+
+    def get_values(self, pid, c_type=None):
+        """
+        :return: the values of a pid (of a claim type), the values of the other
+        pids are not unpacked
+        """
+        if isinstance(pid, int):
+            if pid not in self.pids:
+                return []
+            groups = [group for group, ref in enumerate(self.pids) if ref == pid]
+        else:
+            groups = [
+                group
+                for group, ref in enumerate(self.pids)
+                if ref & STR_FLAG and self.get_ref(ref) == pid
+            ]
+        results = []
+        for group in groups:
+            type_i = bisect_right(self.type_ends, group)
+            if c_type is not None and self.get_type(type_i) != c_type:
+                continue
+            start = self.ends[group - 1] if group else 0
+            values = self.get_slots(start, self.ends[group])
+            results.extend(self.get_group_values(self.types[type_i], values))
+        return results
+
+    def to_dict(self):
+        strs = self.get_strs()
+        pids = [ref if ref < STR_FLAG else strs[ref - STR_FLAG] for ref in self.pids]
+        ends = self.ends
+        values = self.get_slots(0, self.n_slots, strs)
+        results = {}
+        group_start = start = 0
+        for type_ref, group_end in zip(self.types, self.type_ends):
+            if type_ref < STR_FLAG:
+                c_type = CLAIM_TYPES[type_ref]
+            else:
+                c_type = strs[type_ref - STR_FLAG]
+            c_statements = results.setdefault(c_type, {})
+            if group_start == group_end:
+                continue
+            end = ends[group_end - 1]
+            n_slots = TYPE_SLOTS.get(type_ref)
+            if n_slots:
+                type_values = self.get_group_values(type_ref, values[start:end])
+            else:
+                type_values, n_slots = values[start:end], 1
+            statements = [{"value": value} for value in type_values]
+            if group_end - group_start == 1:
+                c_statements[pids[group_start]] = statements
+            else:
+                slot = start
+                for group in range(group_start, group_end):
+                    c_statements[pids[group]] = statements[
+                        (slot - start) // n_slots : (ends[group] - start) // n_slots
+                    ]
+                    slot = ends[group]
+            start = end
+            group_start = group_end
+        return results
+
+
+class PackedClaims(Mapping):
+    """
+    Lazy {claim type: {pid: [{"value": value}, ...]}} of packed claims (see
+    unpack_claims): the types and groups are read when it is created, the values
+    of a pid are unpacked when they are read. The groups of a claim type can be
+    split (see pack_claims), they are merged as in ClaimsReader.to_dict.
+    """
+
+    __slots__ = ("_reader", "_types")
+
+    def __init__(self, data):
+        reader = ClaimsReader(data)
+        self._reader = reader
+        # {claim type: {pid: (type ref, group)}}
+        groups = {}
+        group_start = 0
+        for type_i, group_end in enumerate(reader.type_ends):
+            type_ref = reader.types[type_i]
+            type_groups = groups.setdefault(reader.get_type(type_i), {})
+            for group in range(group_start, group_end):
+                type_groups[reader.get_ref(reader.pids[group])] = (type_ref, group)
+            group_start = group_end
+        self._types = {
+            c_type: PackedTypeClaims(reader, type_groups)
+            for c_type, type_groups in groups.items()
+        }
+
+    def __getitem__(self, c_type):
+        return self._types[c_type]
+
+    def __iter__(self):
+        return iter(self._types)
+
+    def __len__(self):
+        return len(self._types)
+
+    def unpack(self):
+        """
+        :return: the unpacked claims (see unpack_claims)
+        """
+        return self._reader.to_dict()
+
+    def __sizeof__(self):
+        # The size of the claims when they are unpacked
+        return object.__sizeof__(self) + len(self._reader.data) * UNPACKED_SIZE_RATIO
+
+
+class PackedTypeClaims(Mapping):
+    """
+    Lazy {pid: [{"value": value}, ...]} of the groups of a claim type
+    """
+
+    __slots__ = ("_reader", "_groups")
+
+    def __init__(self, reader, groups):
+        """
+        :param groups: {pid: (type ref, group)}
+        """
+        self._reader = reader
+        self._groups = groups
+
+    def __getitem__(self, pid):
+        type_ref, group = self._groups[pid]
+        reader = self._reader
+        start = reader.ends[group - 1] if group else 0
+        values = reader.get_slots(start, reader.ends[group])
+        values = reader.get_group_values(type_ref, values)
+        return [{"value": value} for value in values]
+
+    def __iter__(self):
+        return iter(self._groups)
+
+    def __contains__(self, pid):
+        return pid in self._groups
+
+    def __len__(self):
+        return len(self._groups)
+
+
+def unpack_claims(data):
+    """
+    :return: {claim type: {pid: [{"value": value}, ...]}}, a quantity is
+    [amount, unit] (as the msgpack values)
+    """
+    return ClaimsReader(data).to_dict()
+
+
+def unpack_claim_values(data, pid, c_type=None):
+    """
+    :return: the values of a pid (of a claim type), without unpacking the
+    values of the other pids
+    """
+    return ClaimsReader(data).get_values(pid, c_type)
@@ -0,0 +1,260 @@
+from collections.abc import Mapping
+
+from core.cache import get_obj_size
+from core.claims_codec import PackedClaims
+
+# Not decoded yet, None can be a decoded value
+NOT_DECODED = object()
+
+
+def decode_claim_value(c_type, c_value, get_qid):
+    """
+    Replace the lids of an encoded claim value with Wikidata IDs: entity values
+    and the units of quantities
+    """
+    if c_type == "wikibase-entityid":
+        return get_qid(c_value)
+    if c_type == "quantity":
+        if c_value[1] == -1:
+            return c_value[0], 1
+        return c_value[0], get_qid(c_value[1])
+    return c_value
+
+
+def decode_ref_nodes(c_refs, get_qid):
+    """
+    Replace the lids of encoded references (properties and entity values) with
+    Wikidata IDs
+    """
+    decode_ref_nodes = []
+    for c_ref_nodes in c_refs:
+        decode_ref_node = {}
+        for ref_type, ref_values in c_ref_nodes.items():
+            decode_ref_type = {}
+            for ref_prop, ref_value_objs in ref_values.items():
+                decode_ref_prop = get_qid(ref_prop)
+                decode_ref_values = []
+                for ref_value_obj in ref_value_objs:
+                    if ref_type == "wikibase-entityid":
+                        ref_value_obj = get_qid(ref_value_obj)
+                    decode_ref_values.append(ref_value_obj)
+                decode_ref_type[decode_ref_prop] = decode_ref_values
+            decode_ref_node[ref_type] = decode_ref_type
+        decode_ref_nodes.append(decode_ref_node)
+    return decode_ref_nodes
+
+
+def decode_statement(c_type, c_value, get_qid):
+    """
+    :return: decoded {"value": value, "references": references} of an encoded
+    statement
+    """
+    statement = {"value": decode_claim_value(c_type, c_value["value"], get_qid)}
+    c_refs = c_value.get("references")
+    if c_refs:
+        statement["references"] = decode_ref_nodes(c_refs, get_qid)
+    return statement
+
+
+def decode_claims(claims, get_qid):
+    """
+    :return: decoded claims of encoded claims, everything is decoded
+    """
+    results = {}
+    for c_type, c_statements in claims.items():
+        results[c_type] = {
+            get_qid(pid): [
+                decode_statement(c_type, c_value, get_qid) for c_value in c_values
+            ]
+            for pid, c_values in c_statements.items()
+        }
+    return results
+
+
+class ClaimsView(Mapping):
+    """
+    Decoded claims {claim type: {pid: [{"value": value, "references": ...}]}} of
+    encoded claims (a dict, or core.claims_codec.PackedClaims). Nothing is
+    decoded when it is created: the pids of a claim type are converted to
+    Wikidata IDs when the type is read, the statements of a pid when the pid is
+    read, and the value and the references of a statement when they are read.
+    The decoded parts are kept. to_dict decodes all claims.
+    """
+
+    __slots__ = ("_claims", "_get_qid", "_get_lid", "_types")
+
+    def __init__(self, claims, get_qid, get_lid):
+        """
+        :param get_qid: function lid -> Wikidata ID
+        :param get_lid: function Wikidata ID -> lid (None if it has no lid)
+        """
+        self._claims = claims
+        self._get_qid = get_qid
+        self._get_lid = get_lid
+        self._types = {}
+
+    def __getitem__(self, c_type):
+        view = self._types.get(c_type)
+        if view is None:
+            view = TypeClaimsView(
+                c_type, self._claims[c_type], self._get_qid, self._get_lid
+            )
+            self._types[c_type] = view
+        return view
+
+    def __iter__(self):
+        return iter(self._claims)
+
+    def __len__(self):
+        return len(self._claims)
+
+    def __contains__(self, c_type):
+        return c_type in self._claims
+
+    def __repr__(self):
+        return repr(self.to_dict())
+
+    def __sizeof__(self):
+        # The encoded claims and their decoded copies when all claims are read
+        return object.__sizeof__(self) + 2 * get_obj_size(self._claims)
+
+    def to_dict(self):
+        if not self._types:
+            # Nothing is read, decode all claims at once
+            claims = self._claims
+            if isinstance(claims, PackedClaims):
+                claims = claims.unpack()
+            return decode_claims(claims, self._get_qid)
+        return {c_type: self[c_type].to_dict() for c_type in self}
+
+
+class TypeClaimsView(Mapping):
+    """
+    Decoded {pid: [statement, ...]} of a claim type (see ClaimsView)
+    """
+
+    __slots__ = ("_c_type", "_claims", "_get_qid", "_get_lid", "_pids", "_statements")
+
+    def __init__(self, c_type, claims, get_qid, get_lid):
+        self._c_type = c_type
+        self._claims = claims
+        self._get_qid = get_qid
+        self._get_lid = get_lid
+        # {Wikidata ID: encoded pid}, the pids are converted when they are listed
+        self._pids = None
+        self._statements = {}
+
+    def _get_pids(self):
+        if self._pids is None:
+            self._pids = {self._get_qid(pid): pid for pid in self._claims}
+        return self._pids
+
+    def _get_encoded_pid(self, pid):
+        if self._pids is not None:
+            return self._pids.get(pid)
+        if not isinstance(pid, str):
+            return None
+        lid = self._get_lid(pid)
+        if lid is not None and lid in self._claims:
+            return lid
+        # The properties which are not in the trie are kept as strings
+        if pid in self._claims:
+            return pid
+        return None
+
+    def __getitem__(self, pid):
+        statements = self._statements.get(pid)
+        if statements is None:
+            encoded_pid = self._get_encoded_pid(pid)
+            if encoded_pid is None:
+                raise KeyError(pid)
+            statements = [
+                Statement(self._c_type, c_value, self._get_qid)
+                for c_value in self._claims[encoded_pid]
+            ]
+            self._statements[pid] = statements
+        return statements
+
+    def __iter__(self):
+        return iter(self._get_pids())
+
+    def __len__(self):
+        return len(self._claims)
+
+    def __contains__(self, pid):
+        return self._get_encoded_pid(pid) is not None
+
+    def __repr__(self):
+        return repr(self.to_dict())
+
+    def to_dict(self):
+        results = {}
+        for pid, encoded_pid in self._get_pids().items():
+            statements = self._statements.get(pid)
+            if statements is None:
+                results[pid] = [
+                    decode_statement(self._c_type, c_value, self._get_qid)
+                    for c_value in self._claims[encoded_pid]
+                ]
+            else:
+                results[pid] = [statement.to_dict() for statement in statements]
+        return results
+
+
+class Statement(Mapping):
+    """
+    Decoded {"value": value, "references": references} of an encoded statement,
+    the references are decoded when they are read
+    """
+
+    __slots__ = ("_c_type", "_c_value", "_get_qid", "_value", "_references")
+
+    def __init__(self, c_type, c_value, get_qid):
+        self._c_type = c_type
+        self._c_value = c_value
+        self._get_qid = get_qid
+        self._value = NOT_DECODED
+        self._references = NOT_DECODED
+
+    @property
+    def value(self):
+        if self._value is NOT_DECODED:
+            self._value = decode_claim_value(
+                self._c_type, self._c_value["value"], self._get_qid
+            )
+        return self._value
+
+    @property
+    def references(self):
+        """
+        :return: decoded references, None if the statement has no references
+        """
+        if self._references is NOT_DECODED:
+            c_refs = self._c_value.get("references")
+            self._references = (
+                decode_ref_nodes(c_refs, self._get_qid) if c_refs else None
+            )
+        return self._references
+
+    def __getitem__(self, key):
+        if key == "value":
+            return self.value
+        if key == "references" and self._c_value.get("references"):
+            return self.references
+        raise KeyError(key)
+
+    def __iter__(self):
+        yield "value"
+        if self._c_value.get("references"):
+            yield "references"
+
+    def __len__(self):
+        return 2 if self._c_value.get("references") else 1
+
+    def __repr__(self):
+        return repr(self.to_dict())
+
+    def to_dict(self):
+        if self._value is NOT_DECODED and self._references is NOT_DECODED:
+            return decode_statement(self._c_type, self._c_value, self._get_qid)
+        return dict(self.items())
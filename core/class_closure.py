@@ -0,0 +1,88 @@
+"""
+Transitive closures of the subclass of (P279) graph: the closure of a class is
+the BitMap of the lids of all its superclasses (wdt:P279+). The strongly
+connected components are found with Tarjan's algorithm (iterative), so the
+classes of a cycle share one closure, which includes them. The components are
+completed in reverse topological order, so the closure of a component is the
+union of the closures of its successors.
+"""
+
+from pyroaring import BitMap
+
+
+def iter_class_closures(nodes, get_successors, get_closure=None):
+    """
+    :param nodes: classes (lids) to compute the closures of
+    :param get_successors: function lid -> lids of the direct superclasses
+    :param get_closure: function lid -> stored closure (BitMap or None) of a
+    class which is not in nodes. None: the closures of all classes reachable from
+    nodes are computed
+    :return: iterator of (lid, closure), the closures of a cycle are the same
+    BitMap, the classes without superclasses have empty closures
+    """
+    if get_closure is None:
+        is_computed = None
+    else:
+        nodes = set(nodes)
+        is_computed = nodes.__contains__
+    # Tarjan's index and low link of the visited classes
+    index = {}
+    low = {}
+    stack = []
+    on_stack = set()
+    # Successors of the classes on the stack
+    successors = {}
+    # Closures of the completed components
+    closures = {}
+
+    def visit(lid):
+        index[lid] = low[lid] = len(index)
+        stack.append(lid)
+        on_stack.add(lid)
+        successors[lid] = list(get_successors(lid) or [])
+        return lid, iter(successors[lid])
+
+    for root in nodes:
+        if root in index:
+            continue
+        work = [visit(root)]
+        while work:
+            lid, c_successors = work[-1]
+            for successor in c_successors:
+                if successor in index:
+                    if successor in on_stack:
+                        low[lid] = min(low[lid], index[successor])
+                    continue
+                if is_computed is not None and not is_computed(successor):
+                    continue
+                work.append(visit(successor))
+                break
+            else:
+                work.pop()
+                if work:
+                    parent = work[-1][0]
+                    low[parent] = min(low[parent], low[lid])
+                if low[lid] != index[lid]:
+                    continue
+                # lid is the root of a component
+                component = []
+                while True:
+                    member = stack.pop()
+                    on_stack.discard(member)
+                    component.append(member)
+                    if member == lid:
+                        break
+                closure = BitMap()
+                for member in component:
+                    for successor in successors.pop(member):
+                        closure.add(successor)
+                        if successor in index:
+                            successor_closure = closures.get(successor)
+                        else:
+                            successor_closure = get_closure(successor)
+                        if successor_closure:
+                            closure |= successor_closure
+                for member in component:
+                    if closure:
+                        closures[member] = closure
+                    yield member, closure
@@ -1,9 +1,12 @@
 import gc
 import os
+import queue
 import struct
+import threading
 import zlib
+from bisect import bisect_right
 from collections import defaultdict
-from contextlib import closing
+from contextlib import closing, contextmanager
 
 import lmdb
 import msgpack
@@ -14,6 +17,15 @@ from tqdm import tqdm
 
 import config as cf
 from core import io_worker as iw
+from core.claims_codec import pack_claims, unpack_claims
+
+try:
+    import zstandard
+except ImportError:
+    zstandard = None
+
+# Magic number of zstd frames
+ZSTD_MAGIC = b"\x28\xb5\x2f\xfd"
 
 
 def is_byte_obj(obj):
@@ -41,6 +53,71 @@ def deserialize_key(key, integerkey=False, is_64bit=False):
         raise Exception
 
 
+def check_zstandard():
+    if zstandard is None:
+        raise ImportError("Install zstandard (pip install zstandard) for zstd values")
+
+
+class ZstdCodec:
+    """
+    Zstandard compression with a dictionary trained on the values of a DB (see
+    DBCore.train_zstd_dict). It is a compress_value option of serialize_value
+    and deserialize_value. Values which are not zstd frames are decompressed as
+    lz4 frames, so the values of a DB can be read during its migration.
+    """
+
+    def __init__(self, dict_data, level=cf.ZSTD_LEVEL):
+        check_zstandard()
+        self.dict_data = dict_data
+        self.level = level
+        self._dict = zstandard.ZstdCompressionDict(dict_data)
+        self._dict.precompute_compress(level=level)
+        # Compression contexts can not be shared by threads
+        self._local = threading.local()
+
+    def compress(self, value):
+        try:
+            compressor = self._local.compressor
+        except AttributeError:
+            compressor = zstandard.ZstdCompressor(
+                level=self.level, dict_data=self._dict
+            )
+            self._local.compressor = compressor
+        return compressor.compress(value)
+
+    def decompress(self, value):
+        if bytes(value[:4]) != ZSTD_MAGIC:
+            return decompress_bytes(value)
+        try:
+            decompressor = self._local.decompressor
+        except AttributeError:
+            decompressor = zstandard.ZstdDecompressor(dict_data=self._dict)
+            self._local.decompressor = decompressor
+        return decompressor.decompress(value)
+
+
+def compress_bytes(value, compress_value=True):
+    """
+    :param compress_value: True (lz4 frame) or a ZstdCodec
+    """
+    if isinstance(compress_value, ZstdCodec):
+        return compress_value.compress(value)
+    return frame.compress(value)
+
+
+def decompress_bytes(value, compress_value=True):
+    """
+    :param compress_value: True (lz4 frame) or a ZstdCodec
+    :return: the value itself if it is not compressed
+    """
+    if isinstance(compress_value, ZstdCodec):
+        return compress_value.decompress(value)
+    try:
+        return frame.decompress(value)
+    except RuntimeError:
+        return value
+
+
 def deserialize_value(value, bytes_value=cf.ToBytesType.OBJ, compress_value=False):
     if bytes_value == cf.ToBytesType.INT_NUMPY:
         value = np.frombuffer(value, dtype=np.uint32).tolist()
@@ -48,13 +125,13 @@ def deserialize_value(value, bytes_value=cf.ToBytesType.OBJ, compress_value=Fals
         if not isinstance(value, bytes):
             value = bytes(value)
         value = BitMap.deserialize(value)
-    else:  # mode == "msgpack"
+    else:
         if compress_value:
-            try:
-                value = frame.decompress(value)
-            except RuntimeError:
-                pass
-        value = msgpack.unpackb(value, strict_map_key=False)
+            value = decompress_bytes(value, compress_value)
+        if bytes_value == cf.ToBytesType.CLAIMS:
+            value = unpack_claims(value)
+        else:  # mode == "msgpack"
+            value = msgpack.unpackb(value, strict_map_key=False)
     return value
 
 
@@ -94,10 +171,13 @@ def serialize_value(
         value = value.tobytes()
     elif bytes_value == cf.ToBytesType.INT_BITMAP:
         value = BitMap(value).serialize()
-    else:  # mode == "msgpack"
-        value = msgpack.packb(value, default=set_default)
+    else:
+        if bytes_value == cf.ToBytesType.CLAIMS:
+            value = pack_claims(value)
+        else:  # mode == "msgpack"
+            value = msgpack.packb(value, default=set_default)
         if compress_value:
-            value = frame.compress(value)
+            value = compress_bytes(value, compress_value)
     return value
 
 
@@ -150,25 +230,229 @@ def preprocess_data_before_dump(
     return data
 
 
+def get_append_start(cur, data, integerkey=False):
+    """
+    Find the items of a batch which can be written in LMDB append mode
+    :return: i, data[i:] is strictly increasing, and its keys are greater than
+    the keys of data[:i] and the last key of the DB
+    """
+    if not data:
+        return 0
+    last_key = bytes(cur.key()) if cur.last() else None
+    if integerkey:
+        # Integer keys are compared as native unsigned integers
+        dtype = np.uint64 if len(data[0][0]) == 8 else np.uint32
+        keys = np.frombuffer(b"".join(k for k, _ in data), dtype=dtype)
+        not_increasing = np.flatnonzero(keys[1:] <= keys[:-1])
+        start = int(not_increasing[-1]) + 1 if len(not_increasing) else 0
+        bounds = [keys[:start].max()] if start else []
+        if last_key is not None:
+            bounds.append(np.frombuffer(last_key, dtype=dtype)[0])
+        if bounds:
+            start += int(np.searchsorted(keys[start:], max(bounds), side="right"))
+        return start
+
+    keys = [bytes(k) for k, _ in data]
+    start = len(keys) - 1
+    while start > 0 and keys[start - 1] < keys[start]:
+        start -= 1
+    bounds = keys[:start]
+    if last_key is not None:
+        bounds.append(last_key)
+    if bounds:
+        start = bisect_right(keys, max(bounds), lo=start)
+    return start
+
+
+class ReadSession(object):
+    """
+    Read transaction shared by the getters of a thread (see DBCore.reader). It
+    is a context manager of its transaction which does not end it, so the
+    getters use it like the transactions of env.begin.
+    """
+
+    def __init__(self, db):
+        self._db = db
+        self.txn = None
+        self.begin()
+
+    def __enter__(self):
+        return self.txn
+
+    def __exit__(self, exc_type, exc_value, traceback):
+        return False
+
+    def begin(self):
+        self.txn = self._db._begin_session_txn()
+
+    def renew(self):
+        """
+        End the transaction and begin a new one, which reads the current
+        snapshot of the DB. A writer waiting for the session (see
+        DBCore.pause_reader) writes in between.
+        """
+        self.close()
+        self.begin()
+
+    def close(self):
+        if self.txn is not None:
+            self._db._end_session_txn(self.txn)
+            self.txn = None
+
+
 class DBCore:
     def __init__(self, db_file, max_db, map_size=cf.LMDB_MAP_SIZE):
         self._db_file = db_file
         iw.create_dir(self._db_file)
         self._max_db = max_db
+        # Read session of each thread (see reader)
+        self._sessions = threading.local()
+        # Open session transactions of all threads and writers (see pause_reader)
+        self._sessions_cond = threading.Condition()
+        self._n_session_txns = 0
+        self._n_writers = 0
+        self._open_env(map_size)
+
+    def _open_env(self, map_size, bulk_load=False):
+        # Bulk load: write through the memory map, and do not sync on commit
         self._env = lmdb.open(
             self._db_file,
             map_async=True,
             map_size=map_size,
             subdir=False,
             lock=False,
-            max_dbs=max_db,
+            max_dbs=self._max_db,
+            writemap=bulk_load,
+            sync=not bulk_load,
+            metasync=not bulk_load,
         )
         self._env.set_mapsize(map_size)
 
+    def _open_dbs(self):
+        """
+        Open the DBs of the env. Subclasses open their DBs here, it is called
+        again when the env is reopened.
+        """
+        pass
+
+    def _reopen_env(self, bulk_load=False):
+        map_size = self._env.info()["map_size"]
+        self._env.close()
+        self._open_env(map_size, bulk_load=bulk_load)
+        self._open_dbs()
+
+    @contextmanager
+    def bulk_load(self):
+        """
+        Reopen the env with writemap and without fsync on commit for a bulk
+        load, then sync it and reopen it with the default options. The DB file
+        can be corrupted if the system crashes during the bulk load, and it is
+        grown to the map size (sparse file), copy_lmdb compacts it.
+        """
+        self._reopen_env(bulk_load=True)
+        try:
+            yield self
+        finally:
+            self._env.sync(True)
+            self._reopen_env()
+
     @property
     def env(self):
         return self._env
 
+    @contextmanager
+    def reader(self):
+        """
+        Read session: the getters called in this thread share one read
+        transaction until the session exits, instead of beginning a transaction
+        per call. Nested sessions reuse the open session, and no session is
+        opened while this thread writes (see pause_reader). The transaction reads
+        the snapshot of the DB at its beginning. The env is opened with
+        lock=False, so LMDB does not know its readers: the writes wait until the
+        session transactions of all threads end, and long-lived sessions call
+        renew() between requests to let them in, e.g.,
+        with db.reader() as session:
+            for request in requests:
+                ...
+                session.renew()
+        The reads outside sessions are not waited for, the threads which read
+        while the DB is written use sessions.
+        """
+        if getattr(self._sessions, "writing", False):
+            yield None
+            return
+        session = getattr(self._sessions, "session", None)
+        if session is not None:
+            yield session
+            return
+        session = ReadSession(self)
+        self._sessions.session = session
+        try:
+            yield session
+        finally:
+            self._sessions.session = None
+            session.close()
+
+    @contextmanager
+    def pause_reader(self):
+        """
+        Write the DB (e.g., build, apply_delta): the session of this thread is
+        paused and the getters read with new transactions. The writer waits until
+        the session transactions of the other threads end (closed or renewed),
+        and the new session transactions wait until the writers end, so the pages
+        of a session snapshot are not reused while it is read. The session of
+        this thread begins a new transaction when it is resumed.
+        """
+        session = getattr(self._sessions, "session", None)
+        writing = getattr(self._sessions, "writing", False)
+        if session is not None:
+            session.close()
+        self._sessions.session = None
+        self._sessions.writing = True
+        with self._sessions_cond:
+            self._n_writers += 1
+            while self._n_session_txns:
+                self._sessions_cond.wait()
+        try:
+            yield
+        finally:
+            with self._sessions_cond:
+                self._n_writers -= 1
+                self._sessions_cond.notify_all()
+            self._sessions.writing = writing
+            self._sessions.session = session
+            if session is not None:
+                session.begin()
+
+    def _begin_session_txn(self):
+        with self._sessions_cond:
+            while self._n_writers:
+                self._sessions_cond.wait()
+            self._n_session_txns += 1
+        try:
+            return self._env.begin(buffers=True)
+        except Exception:
+            self._end_session_txn(None)
+            raise
+
+    def _end_session_txn(self, txn):
+        if txn is not None:
+            txn.abort()
+        with self._sessions_cond:
+            self._n_session_txns -= 1
+            self._sessions_cond.notify_all()
+
+    def _begin_read(self, db=None, buffers=True):
+        """
+        :return: the read session of this thread if it is open, otherwise a new
+        read transaction. The DB is not the default DB of the session, so the
+        callers pass db to get, cursor, and stat.
+        """
+        session = getattr(self._sessions, "session", None)
+        if session is not None:
+            return session
+        return self._env.begin(db=db, buffers=buffers)
+
     def get_map_size(self):
         tmp = self._env.info().get("map_size")
         if not tmp:
@@ -204,18 +488,22 @@ class DBCore:
         get_values=True,
         bytes_value=cf.ToBytesType.OBJ,
         compress_value=False,
+        is_64bit=False,
     ):
         with self._env.begin(db=db, write=False) as txn:
             if to_i == -1:
                 to_i = self.get_db_size(db)
             cur = txn.cursor()
-            cur.set_range(serialize_key(from_i, integerkey=True))
+            if not cur.set_range(
+                serialize_key(from_i, integerkey=True, is_64bit=is_64bit)
+            ):
+                return
             for item in cur.iternext(values=get_values):
                 if get_values:
                     key, value = item
                 else:
                     key = item
-                key = deserialize_key(key, integerkey=True)
+                key = deserialize_key(key, integerkey=True, is_64bit=is_64bit)
                 if key > to_i:
                     break
                 if get_values:
@@ -260,11 +548,11 @@ class DBCore:
                 cur.next()
 
     def is_available(self, db, key_obj, integerkey=False):
-        with self._env.begin(db=db) as txn:
+        with self._begin_read(db=db, buffers=False) as txn:
             key_obj = serialize_key(key_obj, integerkey=integerkey)
             if key_obj:
                 try:
-                    value_obj = txn.get(key_obj)
+                    value_obj = txn.get(key_obj, db=db)
                     if value_obj:
                         return True
                 except Exception as message:
@@ -272,12 +560,12 @@ class DBCore:
         return False
 
     def get_memory_size(self, db, key_obj, integerkey=False, is_64bit=False):
-        with self._env.begin(db=db, buffers=True) as txn:
+        with self._begin_read(db=db) as txn:
             key_obj = serialize_key(key_obj, integerkey=integerkey, is_64bit=is_64bit)
             responds = None
             if key_obj:
                 try:
-                    value_obj = txn.get(key_obj)
+                    value_obj = txn.get(key_obj, db=db)
                     if value_obj:
                         return len(value_obj)
                 except Exception as message:
@@ -295,7 +583,7 @@ class DBCore:
         bytes_value=cf.ToBytesType.OBJ,
         compress_value=False,
     ):
-        with self._env.begin(db=db, buffers=True) as txn:
+        with self._begin_read(db=db) as txn:
             if isinstance(key_obj, np.ndarray):
                 key_obj = key_obj.tolist()
 
@@ -333,7 +621,7 @@ class DBCore:
                 responds = None
                 if key_obj:
                     try:
-                        value_obj = txn.get(key_obj)
+                        value_obj = txn.get(key_obj, db=db)
                         if value_obj:
                             if get_deserialize:
                                 responds = deserialize_value(
@@ -420,8 +708,8 @@ class DBCore:
                     raise Exception
 
     def get_db_size(self, db):
-        with self._env.begin(db=db) as txn:
-            return txn.stat()["entries"]
+        with self._begin_read(db=db, buffers=False) as txn:
+            return txn.stat(db)["entries"]
 
     def delete(self, db, key, integerkey=False, with_prefix=False):
         if not (
@@ -460,7 +748,13 @@ class DBCore:
         bytes_value=cf.ToBytesType.OBJ,
         compress_value=False,
         one_sample_write=False,
+        append=False,
     ):
+        """
+        :param append: write the increasing keys after the last key of the DB
+        in append mode (no B-tree descent, full pages), the other items are
+        written with the default mode
+        """
         data = preprocess_data_before_dump(
             data,
             bytes_value=bytes_value,
@@ -471,7 +765,14 @@ class DBCore:
         added_items = 0
         try:
             with env.begin(db=db, write=True, buffers=True) as txn:
-                if not one_sample_write:
+                if not one_sample_write and append:
+                    cur = txn.cursor()
+                    start = get_append_start(cur, data, integerkey=integerkey)
+                    _, added_items = cur.putmulti(data[start:], append=True)
+                    if start:
+                        _, added = cur.putmulti(data[:start])
+                        added_items += added
+                elif not one_sample_write:
                     _, added_items = txn.cursor().putmulti(data)
                 else:
                     for k, v in data:
@@ -481,7 +782,9 @@ class DBCore:
             curr_limit = env.info()["map_size"]
             new_limit = curr_limit + cf.SIZE_1GB * 5
             env.set_mapsize(new_limit)
-            return DBCore.write_bulk(env, db, data, sort_key=False)
+            return DBCore.write_bulk(
+                env, db, data, sort_key=False, integerkey=integerkey, append=append
+            )
         except lmdb.BadValsizeError:
             iw.print_status(lmdb.BadValsizeError)
         except lmdb.BadTxnError:
@@ -642,6 +945,14 @@ class DBCore:
         n_compress_value=False,
         step=1000,
     ):
+        """
+        Rewrite the values of a DB with another format or compression. The DB is
+        read in chunks of LMDB_BUFF_BYTES_SIZE, and a chunk is written after its
+        read transaction is closed (the env has no lock, so a write transaction
+        can reuse the pages of an open read transaction). If the key and value
+        formats do not change, the values are only recompressed.
+        """
+        recompress = c_integerkey == n_integerkey and c_bytes_value == n_bytes_value
         buff = []
         buff_size = 0
 
@@ -649,32 +960,91 @@ class DBCore:
             return f"buff:{buff_size / cf.LMDB_BUFF_BYTES_SIZE * 100:.0f}%"
 
         p_bar = tqdm(total=self.get_db_size(c_db))
-        for i, (k, v) in enumerate(
-            self.get_db_iter(
-                c_db,
-                integerkey=c_integerkey,
-                bytes_value=c_bytes_value,
-                compress_value=c_compress_value,
-            )
-        ):
-            k, v = serialize(
-                k,
-                v,
-                integerkey=n_integerkey,
-                bytes_value=n_bytes_value,
-                compress_value=n_compress_value,
-            )
-            buff_size += len(k) + len(v)
-            buff.append((k, v))
-            if buff_size >= cf.LMDB_BUFF_BYTES_SIZE:
-                self.write_bulk(self.env, c_db, buff)
+        i = 0
+        last_key = None
+        while True:
+            with self._env.begin(db=c_db) as txn:
+                cur = txn.cursor()
+                if last_key is None:
+                    has_item = cur.first()
+                else:
+                    has_item = cur.set_range(last_key)
+                    if has_item and cur.key() == last_key:
+                        has_item = cur.next()
+                if not has_item:
+                    break
+                for k, v in cur.iternext():
+                    if recompress:
+                        if c_compress_value:
+                            v = decompress_bytes(v, c_compress_value)
+                        if n_compress_value:
+                            v = compress_bytes(v, n_compress_value)
+                    else:
+                        k, v = deserialize(
+                            k,
+                            v,
+                            integerkey=c_integerkey,
+                            bytes_value=c_bytes_value,
+                            compress_value=c_compress_value,
+                        )
+                        k, v = serialize(
+                            k,
+                            v,
+                            integerkey=n_integerkey,
+                            bytes_value=n_bytes_value,
+                            compress_value=n_compress_value,
+                        )
+                    buff_size += len(k) + len(v)
+                    buff.append((k, v))
+                    i += 1
+                    if i % step == 0:
+                        p_bar.update(step)
+                        p_bar.set_description(desc=update_desc())
+                    if buff_size >= cf.LMDB_BUFF_BYTES_SIZE:
+                        break
+                # Empty if the last item of the DB is read
+                last_key = cur.key()
+            if buff:
+                self.write_bulk(self._env, c_db, buff)
                 buff = []
                 buff_size = 0
-            if i and i % step == 0:
-                p_bar.update(step)
-                p_bar.set_description(desc=update_desc())
-        if buff:
-            self.write_bulk(self.env, c_db, buff)
+            if not last_key:
+                break
+        p_bar.update(i % step)
+        p_bar.close()
+
+    def train_zstd_dict(
+        self,
+        db,
+        compress_value=True,
+        n_samples=cf.ZSTD_DICT_SAMPLES,
+        dict_size=cf.ZSTD_DICT_SIZE,
+        level=cf.ZSTD_LEVEL,
+    ):
+        """
+        Train a zstd dictionary on values sampled evenly from a DB
+        :param compress_value: compression of the values of the DB
+        :return: dictionary (bytes), None if the DB has too few values
+        """
+        check_zstandard()
+        sample_step = max(1, self.get_db_size(db) // n_samples)
+        samples = [
+            decompress_bytes(v, compress_value) if compress_value else v
+            for i, (_, v) in enumerate(self.get_db_iter(db, deserialize_obj=False))
+            if i % sample_step == 0
+        ]
+        if not samples:
+            return None
+        try:
+            return zstandard.train_dictionary(
+                dict_size, samples, level=level
+            ).as_bytes()
+        except zstandard.ZstdError:
+            return None
+
+    def clear_db(self, db):
+        with self._env.begin(write=True) as txn:
+            txn.drop(db, delete=False)
 
     def drop_db(self, db):
         with self._env.begin(write=True) as in_txn:
@@ -756,3 +1126,93 @@ class DBCore:
                         p_bar.close()
             iw.print_status(env.info())
             iw.print_status("%.2fGB" % (env.info()["map_size"] / cf.SIZE_1GB))
+
+
+class DBWriter(object):
+    """
+    Writer thread of an LMDB env. Producers put batches of a DB into bounded
+    per-DB queues and keep working while the writer commits them with
+    DBCore.write_bulk. put blocks when the queue of the DB is full
+    (backpressure). Callbacks (e.g., saving a checkpoint) run in the writer
+    thread after the batches put before them. The env must not be written by
+    other threads until close. Errors of the writer are raised in the producer.
+    """
+
+    def __init__(self, env, queue_size=cf.LMDB_WRITER_QUEUE_SIZE):
+        self.env = env
+        self.queue_size = queue_size
+        self._queues = {}
+        self._tasks = queue.Queue()
+        self._error = None
+        self._thread = threading.Thread(target=self._run, daemon=True)
+        self._thread.start()
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, exc_type, exc_value, traceback):
+        self.close(raise_error=exc_type is None)
+
+    def put(self, db, data, **kwargs):
+        """
+        Queue a batch, kwargs are passed to DBCore.write_bulk
+        """
+        self._check_error()
+        db_queue = self._queues.get(db)
+        if db_queue is None:
+            db_queue = queue.Queue(maxsize=self.queue_size)
+            self._queues[db] = db_queue
+        while True:
+            try:
+                db_queue.put((data, kwargs), timeout=1)
+                break
+            except queue.Full:
+                self._check_error()
+        self._tasks.put(db)
+
+    def put_callback(self, callback):
+        self._check_error()
+        self._tasks.put(callback)
+
+    def join(self):
+        """
+        Wait until the queued batches and callbacks are done
+        """
+        self._tasks.join()
+        self._check_error()
+
+    def close(self, raise_error=True):
+        if self._thread.is_alive():
+            self._tasks.put(None)
+            self._thread.join()
+        # Break the reference cycle: error -> traceback -> frames -> writer
+        error, self._error = self._error, None
+        if raise_error and error is not None:
+            try:
+                raise error
+            finally:
+                error = None
+
+    def _check_error(self):
+        if self._error is not None:
+            raise self._error
+
+    def _run(self):
+        while True:
+            task = self._tasks.get()
+            try:
+                if task is None:
+                    return
+                if callable(task):
+                    if self._error is None:
+                        task()
+                    continue
+                # After an error, the queues are drained without writing, so
+                # the producer is not blocked
+                data, kwargs = self._queues[task].get()
+                if self._error is None:
+                    DBCore.write_bulk(self.env, task, data, **kwargs)
+            except BaseException as message:
+                self._error = message
+            finally:
+                self._tasks.task_done()
@@ -1,19 +1,46 @@
-import bz2
 import csv
 import gc
-import gzip
 import os.path
 import queue
+import re
+from array import array
 from collections import defaultdict
+from contextlib import closing
+from itertools import islice
+from multiprocessing import Pool
 
 import marisa_trie
+import numpy as np
 import ujson
-from pyroaring import BitMap
+from pyroaring import AbstractBitMap, BitMap, FrozenBitMap
 from tqdm import tqdm
 
 import config as cf
 import core.io_worker as iw
-from core.db_core import DBCore, serialize, serialize_key, serialize_value
+from core.cache import MISSING, LRUCache
+from core.class_closure import iter_class_closures
+from core.db_core import (
+    DBCore,
+    DBWriter,
+    ZstdCodec,
+    decompress_bytes,
+    deserialize_key,
+    deserialize_value,
+    serialize_key,
+    serialize_value,
+)
+from core.dump_reader import (
+    DumpReaderWikidata,
+    DumpShardReaderWikidata,
+    iter_dump_shard,
+    iter_sql_dump,
+    loads_json,
+    skip_json_qualifiers,
+)
+from core.claims_codec import ClaimsReader, PackedClaims, unpack_claim_values
+from core.claims_view import ClaimsView, decode_claim_value
+from core.inverted_index import InvertedIndexBuilder
+from core.item_arrays import ItemArrays, QIDSequence, save_item_arrays
 
 
 def parse_sql_values(line):
@@ -81,28 +108,90 @@ def is_wd_item(wd_id):
         return True
 
 
-class DumpReaderWikidata(object):
-    def __init__(self, dir_dump):
-        self.dir_dump = dir_dump
+WD_ID_PATTERN = re.compile(r"[QP](?:0|[1-9][0-9]*)", re.ASCII)
+
+
+def encode_wd_id(wd_id):
+    """
+    Encode a Wikidata item or property ID to an integer: Q{n} -> 2n, P{n} -> 2n+1
+    :return: None if wd_id is not a canonical item or property ID
+    """
+    if not wd_id or not WD_ID_PATTERN.fullmatch(wd_id):
+        return None
+    return int(wd_id[1:]) << 1 | (wd_id[0] == "P")
+
+
+def decode_wd_id(wd_code):
+    return f"{'QP'[wd_code & 1]}{wd_code >> 1}"
+
+
+# Keys of the language keyed stores: lid << LANG_ID_BITS | language ID
+LANG_ID_BITS = 16
+LANG_ID_MASK = (1 << LANG_ID_BITS) - 1
+
+
+def get_lang_key(lid, lang_id):
+    return lid << LANG_ID_BITS | lang_id
+
+
+# Keys of db_references: lid << STATEMENT_ID_BITS | statement index, the
+# statements are indexed in the order of the claims of the item
+STATEMENT_ID_BITS = 24
+STATEMENT_ID_MASK = (1 << STATEMENT_ID_BITS) - 1
 
-    def __iter__(self):
-        if ".bz2" in self.dir_dump:
-            reader = bz2.BZ2File(self.dir_dump)
-        elif ".gz" in self.dir_dump:
-            reader = gzip.open(self.dir_dump, "rt")
-        else:
-            reader = open(self.dir_dump)
 
-        if reader:
-            for line in reader:
-                yield line
-            reader.close()
+def get_reference_key(lid, statement_id):
+    return lid << STATEMENT_ID_BITS | statement_id
+
+
+# Attributes of the items of get_item and get_items
+ITEM_ATTRS = ("label", "labels", "descriptions", "aliases", "sitelinks", "claims")
+
+# Keys of the build profiles (see config.BUILD_PROFILE)
+BUILD_PROFILE_KEYS = {
+    "languages",
+    "sites",
+    "attributes",
+    "claim_types",
+    "references",
+    "instance_of",
+}
 
 
 class DBWikidata(DBCore):
     def __init__(self, db_file=cf.DIR_WIKIDATA_ITEMS_JSON):
-        super().__init__(db_file=db_file, max_db=11, map_size=cf.SIZE_1GB * 100)
+        super().__init__(db_file=db_file, max_db=24, map_size=cf.SIZE_1GB * 100)
         self.db_file = db_file
+        self._open_dbs()
+        self._item_arrays = self.get_item_arrays()
+        self._size_lid_ext = self.get_db_size(self.db_lid_ext)
+        self._load_lang_ids()
+        self._language_keys = self.is_build_stage_done("language_keys")
+        self._types = self.is_build_stage_done("types")
+        self._claims_bytes_value = self.get_claims_bytes_value()
+        self._compress_values = self.get_compress_values()
+        # LRU caches of decoded values (None if disabled), a cache can be
+        # replaced by an object with the methods of LRUCache
+        self.caches = {
+            name: LRUCache(max_bytes) if max_bytes else None
+            for name, max_bytes in [
+                ("labels", cf.CACHE_LABELS_BYTES),
+                ("claims", cf.CACHE_CLAIMS_BYTES),
+                ("postings", cf.CACHE_POSTINGS_BYTES),
+            ]
+        }
+        if os.path.exists(cf.DIR_WIKIDATA_ITEMS_TRIE):
+            self.db_qid_trie = marisa_trie.Trie()
+            self.db_qid_trie.load(cf.DIR_WIKIDATA_ITEMS_TRIE)
+        else:
+            self.db_qid_trie = None
+
+        if not self.is_built():
+            # Build (or resume building) wiki database
+            # Will take 1-2 days
+            self.build()
+
+    def _open_dbs(self):
         self.db_redirect = self._env.open_db(b"db_redirect", integerkey=True)
         self.db_redirect_of = self._env.open_db(b"db_redirect_of", integerkey=True)
         self.db_label = self._env.open_db(b"db_label", integerkey=True)
@@ -110,16 +199,72 @@ class DBWikidata(DBCore):
         self.db_descriptions = self._env.open_db(b"db_descriptions", integerkey=True)
         self.db_aliases = self._env.open_db(b"db_aliases", integerkey=True)
         self.db_claims = self._env.open_db(b"db_claims", integerkey=True)
+        self.db_references = self._env.open_db(b"db_references", integerkey=True)
         self.db_sitelinks = self._env.open_db(b"db_sitelinks", integerkey=True)
         self.db_claim_ent_inv = self._env.open_db(b"db_claim_ent_inv")
-        if os.path.exists(cf.DIR_WIKIDATA_ITEMS_TRIE):
-            self.db_qid_trie = marisa_trie.Trie()
-            self.db_qid_trie.load(cf.DIR_WIKIDATA_ITEMS_TRIE)
-        else:
-            # Build wiki database
-            # Will take 1-2 days
-            self.db_qid_trie = None
-            self.build()
+        self.db_build_state = self._env.open_db(b"db_build_state")
+        # Local IDs of the items added by apply_delta (not in the trie)
+        self.db_qid_ext = self._env.open_db(b"db_qid_ext")
+        self.db_lid_ext = self._env.open_db(b"db_lid_ext", integerkey=True)
+        # Language keyed stores (see build_language_keys)
+        self.db_langs = self._env.open_db(b"db_langs")
+        self.db_labels_lang = self._env.open_db(b"db_labels_lang", integerkey=True)
+        self.db_descriptions_lang = self._env.open_db(
+            b"db_descriptions_lang", integerkey=True
+        )
+        self.db_aliases_lang = self._env.open_db(b"db_aliases_lang", integerkey=True)
+        # Zstd dictionaries of DBs (see build_zstd_dicts)
+        self.db_zstd_dicts = self._env.open_db(b"db_zstd_dicts")
+        # Direct P31 and P279 values of items, and superclasses of classes (see
+        # build_types)
+        self.db_instance_of = self._env.open_db(b"db_instance_of", integerkey=True)
+        self.db_subclass_of = self._env.open_db(b"db_subclass_of", integerkey=True)
+        self.db_superclasses = self._env.open_db(b"db_superclasses", integerkey=True)
+
+    def _get_lang_dbs(self):
+        return {
+            "labels": (self.db_labels, self.db_labels_lang),
+            "descriptions": (self.db_descriptions, self.db_descriptions_lang),
+            "aliases": (self.db_aliases, self.db_aliases_lang),
+        }
+
+    def _get_zstd_dbs(self):
+        return {
+            "labels": self.db_labels,
+            "descriptions": self.db_descriptions,
+            "aliases": self.db_aliases,
+            "sitelinks": self.db_sitelinks,
+            "claims": self.db_claims,
+        }
+
+    def get_compress_values(self):
+        """
+        :return: {attr: compress_value} of labels, descriptions, aliases,
+        sitelinks, and claims: a ZstdCodec if the dictionary of the DB is in
+        db_zstd_dicts, otherwise True (lz4)
+        """
+        compress_values = {attr: True for attr in self._get_zstd_dbs()}
+        for attr, dict_data in self.get_db_iter(self.db_zstd_dicts):
+            compress_values[attr] = ZstdCodec(dict_data)
+        return compress_values
+
+    def _load_lang_ids(self):
+        self._lang_ids = {
+            lang: lang_id for lang, lang_id in self.get_db_iter(self.db_langs)
+        }
+
+    def _add_lang_ids(self, langs):
+        new_ids = {}
+        for lang in langs:
+            if lang in self._lang_ids or lang in new_ids:
+                continue
+            lang_id = len(self._lang_ids) + len(new_ids)
+            if lang_id > LANG_ID_MASK:
+                raise ValueError(f"Too many languages: {lang}")
+            new_ids[lang] = lang_id
+        if new_ids:
+            self.write_bulk(self._env, self.db_langs, new_ids)
+            self._lang_ids.update(new_ids)
 
     def get_redirect_of(self, wd_id, decode=True):
         return self._get_db_item(
@@ -131,6 +276,17 @@ class DBWikidata(DBCore):
         )
 
     def get_redirect(self, wd_id, decode=True):
+        if self._item_arrays is not None and wd_id is not None:
+            lid = wd_id if isinstance(wd_id, int) else self.get_lid(wd_id)
+            if lid is None:
+                return None
+            try:
+                redirect = self._item_arrays.get_redirect(lid)
+                if decode and redirect is not None:
+                    return self.get_qid(redirect)
+                return redirect
+            except KeyError:
+                wd_id = lid
         return self._get_db_item(
             self.db_redirect,
             wd_id,
@@ -143,6 +299,9 @@ class DBWikidata(DBCore):
     def keys(self):
         for k in self.db_qid_trie:
             yield k
+        if self._size_lid_ext:
+            for _, k in self.get_db_iter(self.db_lid_ext, integerkey=True):
+                yield k
 
     def items(self):
         for k in self.keys():
@@ -150,7 +309,7 @@ class DBWikidata(DBCore):
             yield k, v
 
     def size(self):
-        return len(self.db_qid_trie)
+        return len(self.db_qid_trie) + self._size_lid_ext
 
     def _get_db_item(
         self,
@@ -162,6 +321,7 @@ class DBWikidata(DBCore):
         bytes_value=cf.ToBytesType.OBJ,
         lang=None,
         get_redirect=True,
+        with_references=False,
     ):
         if wd_id is None:
             return None
@@ -188,99 +348,152 @@ class DBWikidata(DBCore):
                         compress_value=compress_value,
                         bytes_value=bytes_value,
                     )
+                    wd_id = wd_id_redirect
             except Exception as message:
                 iw.print_status(message, is_screen=False)
         if not results:
             return results
+        if with_references:
+            add_references(results, self.get_references(wd_id))
         if lang and results and isinstance(results, dict):
             results = results.get(lang)
 
         if not decode:
             return results
         if decode and isinstance(results, int):
-            return self.db_qid_trie.restore_key(results)
+            return self.get_qid(results)
         if decode and type(results) in [list]:
-            return [self.db_qid_trie.restore_key(r) for r in results]
-
-        def decode_ref_nodes(c_refs):
-            decode_ref_nodes = []
-            for c_ref_nodes in c_refs:
-                decode_ref_node = {}
-                for ref_type, ref_values in c_ref_nodes.items():
-                    decode_ref_type = {}
-                    for (ref_prop, ref_value_objs) in ref_values.items():
-                        decode_ref_prop = self.get_qid(ref_prop)
-                        decode_ref_values = []
-                        for ref_value_obj in ref_value_objs:
-                            if ref_type == "wikibase-entityid":
-                                ref_value_obj = self.get_qid(ref_value_obj)
-                            decode_ref_values.append(ref_value_obj)
-                        decode_ref_type[decode_ref_prop] = decode_ref_values
-                    decode_ref_node[ref_type] = decode_ref_type
-                decode_ref_nodes.append(decode_ref_node)
-            return decode_ref_nodes
-
-        decode_results = {}
-        for c_type, c_statements in results.items():
-            decode_c_type = {}
-            for c_prop, c_values in c_statements.items():
-                decode_c_prop = self.get_qid(c_prop)
-                decode_c_values = []
-                for c_value in c_values:
-                    decode_c_value = c_value["value"]
-                    if c_type == "wikibase-entityid":
-                        decode_c_value = self.get_qid(decode_c_value)
-                    elif c_type == "quantity":
-                        if decode_c_value[1] == -1:
-                            decode_c_value = (decode_c_value[0], 1)
-                        else:
-                            decode_c_value = (
-                                decode_c_value[0],
-                                self.get_qid(decode_c_value[1]),
-                            )
-                    c_refs = c_value.get("references")
-                    if c_refs:
-                        c_refs = decode_ref_nodes(c_refs)
-                        decode_c_values.append(
-                            {"value": decode_c_value, "references": c_refs,}
-                        )
-                    else:
-                        decode_c_values.append({"value": decode_c_value})
-                decode_c_type[decode_c_prop] = decode_c_values
-
-            decode_results[c_type] = decode_c_type
-        return decode_results
+            return [self.get_qid(r) for r in results]
+        return ClaimsView(results, self.get_qid, self.get_lid)
+
+    def _get_cached(self, cache_name, key, get_value):
+        """
+        :return: the value of key in a cache, or get_value() which is cached
+        (including None, e.g., the items without claims)
+        """
+        cache = self.caches.get(cache_name)
+        if cache is None:
+            return get_value()
+        value = cache.get(key)
+        if value is MISSING:
+            generation = cache.generation
+            value = get_value()
+            cache.put(key, value, generation=generation)
+        return value
+
+    def clear_caches(self):
+        for cache in self.caches.values():
+            if cache is not None:
+                cache.clear()
+
+    def get_cache_stats(self):
+        """
+        :return: {cache name: stats (entries, bytes, hits, misses, evictions)}
+        """
+        return {
+            name: cache.get_stats()
+            for name, cache in self.caches.items()
+            if cache is not None
+        }
 
     def get_label(self, wd_id):
+        return self._get_cached("labels", wd_id, lambda: self._get_label(wd_id))
+
+    def _get_label(self, wd_id):
+        if self._item_arrays is not None and wd_id is not None:
+            lid = wd_id if isinstance(wd_id, int) else self.get_lid(wd_id)
+            if lid is None:
+                return None
+            try:
+                return self._item_arrays.get_label(lid)
+            except KeyError:
+                wd_id = lid
         return self._get_db_item(
             self.db_label, wd_id, compress_value=False, integerkey=True, decode=False
         )
 
+    def get_label_many(self, wd_ids):
+        """
+        :param wd_ids: Wikidata IDs or lids, e.g., a NumPy array of lids
+        :return: list of the labels (see get_label), they are read from the item
+        arrays at once if they are built
+        """
+        if self._item_arrays is None:
+            return [self.get_label(wd_id) for wd_id in wd_ids]
+        lids = self._get_lids_of(wd_ids)
+        labels, missing = self._item_arrays.get_labels(lids)
+        for i in missing.tolist():
+            lid = int(lids[i])
+            if lid >= 0:
+                labels[i] = self.get_label(lid)
+        return labels
+
+    def _has_lang_values(self, db, lid):
+        with self._begin_read(db=db) as txn:
+            cur = txn.cursor(db)
+            start = get_lang_key(lid, 0)
+            if not cur.set_range(serialize_key(start, integerkey=True, is_64bit=True)):
+                return False
+            key = deserialize_key(bytes(cur.key()), integerkey=True, is_64bit=True)
+            return key >> LANG_ID_BITS == lid
+
+    def _get_db_lang_item(self, db, wd_id, lang):
+        """
+        Get the value of a language from a language keyed store
+        """
+        lang_id = self._lang_ids.get(lang)
+        if wd_id is None or lang_id is None:
+            return None
+        if not isinstance(wd_id, int):
+            wd_id = self.get_lid(wd_id)
+            if wd_id is None:
+                return None
+        result = self.get_value(
+            db, get_lang_key(wd_id, lang_id), integerkey=True, is_64bit=True
+        )
+        if result is None and not self._has_lang_values(db, wd_id):
+            # Try redirect item
+            wd_id_redirect = self.get_redirect(wd_id, decode=False)
+            if wd_id_redirect and wd_id_redirect != wd_id:
+                result = self.get_value(
+                    db,
+                    get_lang_key(wd_id_redirect, lang_id),
+                    integerkey=True,
+                    is_64bit=True,
+                )
+        return result
+
     def get_labels(self, wd_id, lang=None):
+        if lang and self._language_keys:
+            return self._get_db_lang_item(self.db_labels_lang, wd_id, lang)
         return self._get_db_item(
             self.db_labels,
             wd_id,
-            compress_value=True,
+            compress_value=self._compress_values["labels"],
             integerkey=True,
             decode=False,
             lang=lang,
         )
 
     def get_descriptions(self, wd_id, lang=None):
+        if lang and self._language_keys:
+            return self._get_db_lang_item(self.db_descriptions_lang, wd_id, lang)
         return self._get_db_item(
             self.db_descriptions,
             wd_id,
-            compress_value=True,
+            compress_value=self._compress_values["descriptions"],
             integerkey=True,
             decode=False,
             lang=lang,
         )
 
     def get_aliases(self, wd_id, lang=None):
+        if lang and self._language_keys:
+            return self._get_db_lang_item(self.db_aliases_lang, wd_id, lang)
         return self._get_db_item(
             self.db_aliases,
             wd_id,
-            compress_value=True,
+            compress_value=self._compress_values["aliases"],
             integerkey=True,
             decode=False,
             lang=lang,
@@ -290,17 +503,111 @@ class DBWikidata(DBCore):
         return self._get_db_item(
             self.db_sitelinks,
             wd_id,
-            compress_value=True,
+            compress_value=self._compress_values["sitelinks"],
             integerkey=True,
             decode=False,
         )
 
-    def get_claims(self, wd_id, get_qid=True):
+    def get_claims(self, wd_id, get_qid=True, with_references=False):
+        """
+        :param with_references: add the references of the statements, they are
+        read from db_references only if they are asked. The claims without
+        references are cached, they must not be modified.
+        :return: claims (core.claims_view.ClaimsView if get_qid), the statements of
+        a pid are decoded when they are read, to_dict decodes all claims
+        """
+        if with_references:
+            return self._get_claims(wd_id, get_qid, with_references=True)
+        return self._get_cached(
+            "claims", (wd_id, get_qid), lambda: self._get_claims(wd_id, get_qid)
+        )
+
+    def _get_claims(self, wd_id, get_qid=True, with_references=False):
+        if (
+            get_qid
+            and not with_references
+            and self._claims_bytes_value == cf.ToBytesType.CLAIMS
+        ):
+            return self._get_packed_claims_view(wd_id)
         return self._get_db_item(
-            self.db_claims, wd_id, compress_value=True, integerkey=True, decode=get_qid
+            self.db_claims,
+            wd_id,
+            compress_value=self._compress_values["claims"],
+            integerkey=True,
+            decode=get_qid,
+            bytes_value=self._claims_bytes_value,
+            with_references=with_references,
         )
 
-    def get_item(self, wd_id):
+    def _to_packed_claims(self, value):
+        compress_value = self._compress_values["claims"]
+        if compress_value:
+            value = decompress_bytes(value, compress_value)
+        else:
+            # Copy the buffer of the read transaction
+            value = bytes(value)
+        return PackedClaims(value)
+
+    def _get_packed_claims(self, lid):
+        with self._begin_read(db=self.db_claims) as txn:
+            value = txn.get(serialize_key(lid, integerkey=True), db=self.db_claims)
+            if not value:
+                return None
+            return self._to_packed_claims(value)
+
+    def _get_packed_claims_view(self, wd_id):
+        """
+        :return: ClaimsView of the packed claims of an item, the values of a pid
+        are unpacked and decoded when they are read
+        """
+        if wd_id is None:
+            return None
+        if not isinstance(wd_id, int):
+            wd_id = self.get_lid(wd_id)
+            if wd_id is None:
+                return None
+        claims = self._get_packed_claims(wd_id)
+        if not claims:
+            # Try redirect item
+            wd_id_redirect = self.get_redirect(wd_id, decode=False)
+            if wd_id_redirect and wd_id_redirect != wd_id:
+                claims = self._get_packed_claims(wd_id_redirect)
+        if claims is None:
+            return None
+        if not claims:
+            return {}
+        return ClaimsView(claims, self.get_qid, self.get_lid)
+
+    def get_claims_bytes_value(self):
+        """
+        :return: format of db_claims (config.ToBytesType), the claims of the DBs
+        built before the compact format are msgpack
+        """
+        state = self.get_build_state("claims")
+        if not state:
+            return cf.ToBytesType.OBJ
+        return state["bytes_value"]
+
+    def _get_claim_values(self, lid, pid, c_type):
+        """
+        :return: the encoded values of a pid of the packed claims of an item,
+        the other values are not unpacked, None if the item has no claims
+        """
+        with self._begin_read(db=self.db_claims) as txn:
+            value = txn.get(serialize_key(lid, integerkey=True), db=self.db_claims)
+            if not value:
+                return None
+            value = decompress_bytes(value, self._compress_values["claims"])
+            return unpack_claim_values(value, pid, c_type)
+
+    def get_references(self, lid):
+        """
+        :return: {statement index: encoded references} of an item
+        """
+        with self._begin_read(db=self.db_references) as txn:
+            return self._get_references_many(txn, [lid]).get(lid, {})
+
+    def get_item(self, wd_id, with_references=False):
         result = dict()
         result["wikidata_id"] = wd_id
         if not isinstance(wd_id, int):
@@ -313,25 +620,339 @@ class DBWikidata(DBCore):
             if tmp is not None:
                 result[attr] = tmp
 
-        wd_redirect = self.get_redirect(wd_id)
-        if wd_redirect and wd_redirect != wd_id:
-            result["wikidata_id"] = wd_redirect
-
-        update_dict("label", self.get_label)
-        update_dict("labels", self.get_labels)
-        update_dict("descriptions", self.get_descriptions)
-        update_dict("aliases", self.get_aliases)
-        update_dict("sitelinks", self.get_sitelinks)
-        update_dict("claims", self.get_claims)
+        # The attributes are read in one read transaction
+        with self.reader():
+            wd_redirect = self.get_redirect(wd_id)
+            if wd_redirect and wd_redirect != wd_id:
+                result["wikidata_id"] = wd_redirect
+
+            update_dict("label", self.get_label)
+            update_dict("labels", self.get_labels)
+            update_dict("descriptions", self.get_descriptions)
+            update_dict("aliases", self.get_aliases)
+            update_dict("sitelinks", self.get_sitelinks)
+            update_dict(
+                "claims",
+                lambda lid: self.get_claims(lid, with_references=with_references),
+            )
         return result
 
+    def _get_values_many(
+        self,
+        txn,
+        db,
+        lids,
+        compress_value=False,
+        bytes_value=cf.ToBytesType.OBJ,
+        deserialize=None,
+    ):
+        """
+        :param lids: sorted lids, the keys are read in the order of the DB
+        :param deserialize: function bytes -> value, default: deserialize_value
+        :return: {lid: value} of the lids which have values in db
+        """
+        if deserialize is None:
+
+            def deserialize(value):
+                return deserialize_value(
+                    value, bytes_value=bytes_value, compress_value=compress_value
+                )
+
+        keys = [serialize_key(lid, integerkey=True) for lid in lids]
+        return {
+            deserialize_key(key, integerkey=True): deserialize(value)
+            for key, value in txn.cursor(db).getmulti(keys)
+            if value
+        }
+
+    def _get_db_items_many(
+        self,
+        txn,
+        db,
+        lids,
+        redirects,
+        compress_value=False,
+        bytes_value=cf.ToBytesType.OBJ,
+        deserialize=None,
+    ):
+        """
+        Batch _get_db_item: the empty values of the redirected items are read from
+        their redirects
+        :return: {lid: value}, {lid: lid of the value} of the lids which have values
+        """
+        results = self._get_values_many(
+            txn, db, lids, compress_value, bytes_value, deserialize
+        )
+        sources = {lid: lid for lid in results}
+        missing = {
+            lid: redirects[lid]
+            for lid in lids
+            if not results.get(lid) and redirects.get(lid) and redirects[lid] != lid
+        }
+        if missing:
+            targets = self._get_values_many(
+                txn,
+                db,
+                sorted(set(missing.values())),
+                compress_value,
+                bytes_value,
+                deserialize,
+            )
+            for lid, redirect in missing.items():
+                value = targets.get(redirect)
+                if value is None:
+                    results.pop(lid, None)
+                    sources.pop(lid, None)
+                else:
+                    results[lid] = value
+                    sources[lid] = redirect
+        return results, sources
+
+    def _get_db_lang_items_many(self, txn, db, lids, redirects, lang):
+        """
+        Batch _get_db_lang_item
+        :return: {lid: value} of the lids which have values of lang
+        """
+        lang_id = self._lang_ids.get(lang)
+        if lang_id is None:
+            return {}
+
+        def get_values(c_lids):
+            keys = [
+                serialize_key(
+                    get_lang_key(lid, lang_id), integerkey=True, is_64bit=True
+                )
+                for lid in c_lids
+            ]
+            return {
+                deserialize_key(key, integerkey=True, is_64bit=True)
+                >> LANG_ID_BITS: deserialize_value(value)
+                for key, value in txn.cursor(db).getmulti(keys)
+                if value
+            }
+
+        results = get_values(lids)
+        cur = txn.cursor(db)
+        missing = {}
+        for lid in lids:
+            redirect = redirects.get(lid)
+            if lid in results or not redirect or redirect == lid:
+                continue
+            # Read the redirect if the item has no values of any language
+            start = serialize_key(get_lang_key(lid, 0), integerkey=True, is_64bit=True)
+            if cur.set_range(start):
+                key = deserialize_key(cur.key(), integerkey=True, is_64bit=True)
+                if key >> LANG_ID_BITS == lid:
+                    continue
+            missing[lid] = redirect
+        if missing:
+            targets = get_values(sorted(set(missing.values())))
+            for lid, redirect in missing.items():
+                if redirect in targets:
+                    results[lid] = targets[redirect]
+        return results
+
+    def _get_references_many(self, txn, lids):
+        """
+        Batch get_references
+        :param lids: sorted lids
+        :return: {lid: {statement index: encoded references}}
+        """
+        results = defaultdict(dict)
+        cur = txn.cursor(self.db_references)
+        for lid in lids:
+            start = serialize_key(
+                get_reference_key(lid, 0), integerkey=True, is_64bit=True
+            )
+            if not cur.set_range(start):
+                break
+            for key, value in cur:
+                key = deserialize_key(key, integerkey=True, is_64bit=True)
+                if key >> STATEMENT_ID_BITS != lid:
+                    break
+                results[lid][key & STATEMENT_ID_MASK] = deserialize_value(
+                    value, compress_value=True
+                )
+        return results
+
+    def _get_lids_of(self, wd_ids):
+        """
+        :param wd_ids: Wikidata IDs or lids
+        :return: int64 NumPy array of lids, -1 if an ID has no lid
+        """
+        if isinstance(wd_ids, np.ndarray) and wd_ids.dtype.kind in "iu":
+            return wd_ids.astype(np.int64)
+        lids = np.full(len(wd_ids), -1, dtype=np.int64)
+        str_ids = []
+        for i, wd_id in enumerate(wd_ids):
+            if isinstance(wd_id, str):
+                str_ids.append(i)
+            elif isinstance(wd_id, (int, np.integer)):
+                lids[i] = wd_id
+        if str_ids:
+            lids[str_ids] = self.get_lids([wd_ids[i] for i in str_ids])
+        return lids
+
+    def _get_items_many(
+        self, wd_ids, attrs, lang=None, get_qid=True, with_references=False
+    ):
+        """
+        Read the attributes of items in one read transaction. The lids are sorted,
+        so the values of each DB are read in key order with one cursor, and the
+        redirects of all items are read at once.
+        :param attrs: attributes of ITEM_ATTRS
+        :return: int64 NumPy array of the lids of wd_ids (-1 if an ID has no lid),
+        {lid: redirect lid}, {attr: {lid: value}}
+        """
+        for attr in attrs:
+            if attr not in ITEM_ATTRS:
+                raise ValueError(f"Unknown attribute: {attr}")
+        lids = self._get_lids_of(wd_ids)
+        sorted_lids = np.unique(lids[lids >= 0]).tolist()
+        dbs = self._get_zstd_dbs()
+        dbs["label"] = self.db_label
+        lang_dbs = self._get_lang_dbs()
+        results = {}
+        references = None
+        with self._begin_read() as txn:
+            redirects = self._get_values_many(txn, self.db_redirect, sorted_lids)
+            for attr in attrs:
+                if lang and self._language_keys and attr in lang_dbs:
+                    results[attr] = self._get_db_lang_items_many(
+                        txn, lang_dbs[attr][1], sorted_lids, redirects, lang
+                    )
+                    continue
+                deserialize = None
+                if attr == "claims":
+                    bytes_value = self._claims_bytes_value
+                    if (
+                        get_qid
+                        and not with_references
+                        and bytes_value == cf.ToBytesType.CLAIMS
+                    ):
+                        # The values of a pid are unpacked when they are read
+                        deserialize = self._to_packed_claims
+                else:
+                    bytes_value = cf.ToBytesType.OBJ
+                values, sources = self._get_db_items_many(
+                    txn,
+                    dbs[attr],
+                    sorted_lids,
+                    redirects,
+                    compress_value=self._compress_values.get(attr, False),
+                    bytes_value=bytes_value,
+                    deserialize=deserialize,
+                )
+                if lang and attr in lang_dbs:
+                    for lid, value in values.items():
+                        if value and isinstance(value, dict):
+                            values[lid] = value.get(lang)
+                if attr == "claims" and with_references:
+                    references = self._get_references_many(
+                        txn, sorted(set(sources[lid] for lid, v in values.items() if v))
+                    )
+                    for lid, value in values.items():
+                        if value:
+                            add_references(value, references.get(sources[lid]))
+                results[attr] = values
+
+        claims = results.get("claims")
+        if claims and get_qid:
+            # Decode the lids of the claims of all items with one cache
+            qids = {}
+
+            def get_qid_cached(lid):
+                qid = qids.get(lid)
+                if qid is None:
+                    qid = qids[lid] = self.get_qid(lid)
+                return qid
+
+            for lid, value in claims.items():
+                if value:
+                    claims[lid] = ClaimsView(value, get_qid_cached, self.get_lid)
+                else:
+                    claims[lid] = {}
+        return lids, redirects, results
+
+    def _get_many(self, wd_ids, attr, **kwargs):
+        if isinstance(wd_ids, np.ndarray):
+            wd_ids = wd_ids.tolist()
+        lids, _, results = self._get_items_many(wd_ids, [attr], **kwargs)
+        values = results[attr]
+        return {wd_id: values.get(lid) for wd_id, lid in zip(wd_ids, lids.tolist())}
+
+    def get_items(self, wd_ids, attrs=None, with_references=False):
+        """
+        Batch get_item: the attributes of all items are read in one read transaction
+        :param wd_ids: Wikidata IDs or lids
+        :param attrs: attributes of ITEM_ATTRS, default: all
+        :return: {wd_id: item (see get_item), None if an ID has no lid}
+        """
+        if attrs is None:
+            attrs = ITEM_ATTRS
+        if isinstance(wd_ids, np.ndarray):
+            wd_ids = wd_ids.tolist()
+        lids, redirects, values = self._get_items_many(
+            wd_ids, attrs, with_references=with_references
+        )
+        results = {}
+        for wd_id, lid in zip(wd_ids, lids.tolist()):
+            if lid < 0:
+                results[wd_id] = None
+                continue
+            item = {"wikidata_id": wd_id}
+            redirect = redirects.get(lid)
+            if redirect is not None:
+                item["wikidata_id"] = self.get_qid(redirect)
+            for attr in attrs:
+                value = values[attr].get(lid)
+                if value is not None:
+                    item[attr] = value
+            results[wd_id] = item
+        return results
+
+    def get_labels_many(self, wd_ids, lang=None):
+        """
+        Batch get_labels
+        :return: {wd_id: labels (see get_labels)}
+        """
+        return self._get_many(wd_ids, "labels", lang=lang)
+
+    def get_claims_many(self, wd_ids, get_qid=True, with_references=False):
+        """
+        Batch get_claims
+        :return: {wd_id: claims (see get_claims)}
+        """
+        return self._get_many(
+            wd_ids, "claims", get_qid=get_qid, with_references=with_references
+        )
+
     def _get_ptype_pid(self, ptype, pid, wd_id):
-        claims = self.get_claims(wd_id)
-        if claims and claims.get(ptype) and claims[ptype].get(pid):
-            obj_qid = claims[ptype][pid]
-            results = [i["value"] for i in obj_qid]
-            return results
-        return None
+        if self._claims_bytes_value != cf.ToBytesType.CLAIMS:
+            claims = self.get_claims(wd_id)
+            if claims and claims.get(ptype) and claims[ptype].get(pid):
+                obj_qid = claims[ptype][pid]
+                results = [i["value"] for i in obj_qid]
+                return results
+            return None
+
+        # Unpack only the values of the pid
+        if wd_id is None:
+            return None
+        if not isinstance(wd_id, int):
+            wd_id = self.get_lid(wd_id)
+            if wd_id is None:
+                return None
+        pid = self.get_lid(pid, pid)
+        results = self._get_claim_values(wd_id, pid, ptype)
+        if results is None:
+            # Try redirect item
+            wd_id_redirect = self.get_redirect(wd_id, decode=False)
+            if wd_id_redirect and wd_id_redirect != wd_id:
+                results = self._get_claim_values(wd_id_redirect, pid, ptype)
+        if not results:
+            return None
+        return [decode_claim_value(ptype, value, self.get_qid) for value in results]
 
     def get_instance_of(self, wd_id):
         return self._get_ptype_pid(ptype="wikibase-entityid", pid="P31", wd_id=wd_id)
@@ -341,22 +962,89 @@ class DBWikidata(DBCore):
 
     def get_all_types(self, wd_id):
         # wdt:P31/wdt:P279*
+        if self._types:
+            if wd_id is None:
+                return []
+            lid = wd_id if isinstance(wd_id, int) else self.get_lid(wd_id)
+            if lid is None:
+                return []
+            types = self._get_all_types_many([lid]).get(lid)
+            return list(self.get_qids(types)) if types else []
+
         results = set()
-        p_items = self.get_instance_of(wd_id)
-        if p_items:
-            process_queue = queue.Queue()
-            for p_item in p_items:
-                process_queue.put(p_item)
-            while process_queue.qsize():
-                process_wd = process_queue.get()
-                results.add(process_wd)
-                p_items = self.get_subclass_of(process_wd)
-                if p_items:
-                    for item in p_items:
-                        if item not in results:
-                            process_queue.put(item)
+        # The claims of the classes are read in one read transaction
+        with self.reader():
+            p_items = self.get_instance_of(wd_id)
+            if p_items:
+                process_queue = queue.Queue()
+                for p_item in p_items:
+                    process_queue.put(p_item)
+                while process_queue.qsize():
+                    process_wd = process_queue.get()
+                    results.add(process_wd)
+                    p_items = self.get_subclass_of(process_wd)
+                    if p_items:
+                        for item in p_items:
+                            if item not in results:
+                                process_queue.put(item)
         return list(results)
 
+    def _get_all_types_many(self, lids):
+        """
+        Read the direct types (db_instance_of) of items and the union of the
+        superclasses (db_superclasses) of the types
+        :param lids: sorted lids
+        :return: {lid: BitMap of the types} of the lids which have types
+        """
+        with self._begin_read() as txn:
+            redirects = self._get_values_many(txn, self.db_redirect, lids)
+            direct_types, _ = self._get_db_items_many(
+                txn,
+                self.db_instance_of,
+                lids,
+                redirects,
+                bytes_value=cf.ToBytesType.INT_NUMPY,
+            )
+            classes = sorted(set().union(*direct_types.values()))
+            # The classes without superclasses use the superclasses of their
+            # redirects, like get_subclass_of
+            class_redirects = self._get_values_many(txn, self.db_redirect, classes)
+            superclasses, _ = self._get_db_items_many(
+                txn,
+                self.db_superclasses,
+                classes,
+                class_redirects,
+                bytes_value=cf.ToBytesType.INT_BITMAP,
+            )
+        results = {}
+        for lid, types in direct_types.items():
+            c_results = BitMap(types)
+            for type_lid in types:
+                type_superclasses = superclasses.get(type_lid)
+                if type_superclasses:
+                    c_results |= type_superclasses
+            results[lid] = c_results
+        return results
+
+    def get_all_types_many(self, wd_ids):
+        """
+        Batch get_all_types
+        :param wd_ids: Wikidata IDs or lids
+        :return: {wd_id: list of the Wikidata IDs of its types (see get_all_types)}
+        """
+        if isinstance(wd_ids, np.ndarray):
+            wd_ids = wd_ids.tolist()
+        if not self._types:
+            with self.reader():
+                return {wd_id: self.get_all_types(wd_id) for wd_id in wd_ids}
+        lids = self._get_lids_of(wd_ids)
+        types = self._get_all_types_many(np.unique(lids[lids >= 0]).tolist())
+        results = {}
+        for wd_id, lid in zip(wd_ids, lids.tolist()):
+            c_types = types.get(lid)
+            results[wd_id] = list(self.get_qids(c_types)) if c_types else []
+        return results
+
     def get_wikipedia_title(self, lang, wd_id):
         tmp = self.get_sitelinks(wd_id)
         if tmp and tmp.get(f"{lang}wiki"):
@@ -371,18 +1059,67 @@ class DBWikidata(DBCore):
         return None
 
     def get_lid(self, wd_id, default=None):
+        if self._item_arrays is not None and isinstance(wd_id, str):
+            results = self._item_arrays.get_lid(wd_id)
+            if results is not None:
+                return results
         results = self.db_qid_trie.get(wd_id)
+        if results is None and self._size_lid_ext:
+            results = self.get_value(self.db_qid_ext, wd_id)
         if results is None:
             return default
         return results
 
     def get_qid(self, lid):
         if isinstance(lid, int):
-            results = self.db_qid_trie.restore_key(lid)
+            if self._item_arrays is not None:
+                results = self._item_arrays.get_qid(lid)
+                if results is not None:
+                    return results
+            if lid < len(self.db_qid_trie):
+                results = self.db_qid_trie.restore_key(lid)
+            else:
+                results = self.get_value(self.db_lid_ext, lid, integerkey=True)
             if results is not None:
                 return results
         return lid
 
+    def get_lids(self, wd_ids):
+        """
+        Batch get_lid, the IDs are parsed at once if the item arrays are built
+        :param wd_ids: list or NumPy array of Wikidata IDs
+        :return: int64 NumPy array of lids, -1 if an ID has no lid
+        """
+        if self._item_arrays is not None:
+            lids = self._item_arrays.get_lids(wd_ids)
+        else:
+            lids = np.full(len(wd_ids), -1, dtype=np.int64)
+        # IDs which are not in the arrays, e.g., the IDs added by apply_delta
+        for i in np.flatnonzero(lids < 0).tolist():
+            wd_id = wd_ids[i]
+            if isinstance(wd_id, str):
+                lid = self.get_lid(str(wd_id))
+                if lid is not None:
+                    lids[i] = lid
+        return lids
+
+    def get_qids(self, lids):
+        """
+        Batch get_qid
+        :param lids: NumPy array (e.g., uint32) or BitMap of lids
+        :return: QIDSequence, a lazy sequence of the Wikidata IDs of lids. If the
+        item arrays are built, the codes of the IDs are read at once, and the IDs
+        are formatted when they are read.
+        """
+        if isinstance(lids, AbstractBitMap):
+            lids = np.frombuffer(lids.to_array(), dtype=np.uint32)
+        else:
+            lids = np.asarray(lids)
+        codes = None
+        if self._item_arrays is not None:
+            codes = self._item_arrays.get_codes(lids)
+        return QIDSequence(lids, codes, self.get_qid)
+
     def iter_item_provenances(self, wd_id=None):
         if wd_id is None:
             keys = self.keys()
@@ -395,7 +1132,7 @@ class DBWikidata(DBCore):
         for key in keys:
             wd_claims = None
             try:
-                wd_claims = self.get_claims(key)
+                wd_claims = self.get_claims(key, with_references=True)
             except Exception as message:
                 iw.print_status(message, is_screen=False)
             if wd_claims:
@@ -484,66 +1221,146 @@ class DBWikidata(DBCore):
                             )
 
     def get_haswbstatements(self, statements, get_qid=True):
+        """
+        :param statements: list of [operation (config.ATTR_OPTS), pid, qid], pid
+        can be None (any property), or config.PATH_INSTANCE_OF for the instances
+        of the class qid and of its subclasses (see get_all_instances)
+        """
         results = None
-        # sort attr
-        if statements:
-            sorted_attr = []
-            for operation, pid, qid in statements:
-                fre = None
-                if pid and qid:
-                    fre = self.get_head_qid(qid, pid, get_posting=False, get_qid=False)
-                elif qid:
-                    fre = self.get_head_qid(qid, get_posting=False, get_qid=False)
-                if fre is None:
-                    continue
-                sorted_attr.append([operation, pid, qid, fre])
-            sorted_attr.sort(key=lambda x: x[3])
-            statements = [
-                [operation, pid, qid] for operation, pid, qid, f in sorted_attr
-            ]
+        # The postings are read in one read transaction
+        with self.reader():
+            # sort attr
+            if statements:
+                sorted_attr = []
+                for operation, pid, qid in statements:
+                    fre = None
+                    posting = None
+                    if pid == cf.PATH_INSTANCE_OF and qid:
+                        posting = self.get_all_instances(qid)
+                        if posting is not None:
+                            # Serialized size, like the stored postings
+                            fre = len(posting.serialize())
+                    elif pid and qid:
+                        fre = self.get_head_qid(
+                            qid, pid, get_posting=False, get_qid=False
+                        )
+                    elif qid:
+                        fre = self.get_head_qid(qid, get_posting=False, get_qid=False)
+                    if fre is None:
+                        continue
+                    sorted_attr.append([operation, pid, qid, fre, posting])
+                sorted_attr.sort(key=lambda x: x[3])
+                statements = [
+                    [operation, pid, qid, posting]
+                    for operation, pid, qid, f, posting in sorted_attr
+                ]
 
-        for operation, pid, qid in statements:
-            if pid and qid:
-                tmp = self.get_head_qid(qid, pid, get_qid=False)
-            elif qid:
-                tmp = self.get_head_qid(qid, get_qid=False)
-            else:
-                tmp = BitMap()
+            for operation, pid, qid, posting in statements:
+                if posting is not None:
+                    tmp = posting
+                elif pid and qid:
+                    tmp = self.get_head_qid(qid, pid, get_qid=False)
+                elif qid:
+                    tmp = self.get_head_qid(qid, get_qid=False)
+                else:
+                    tmp = BitMap()
 
-            if results is None:
-                results = tmp
-                if tmp is None:
-                    break
-            else:
-                if operation == cf.ATTR_OPTS.AND:
-                    results = results & tmp
-                elif operation == cf.ATTR_OPTS.OR:
-                    results = results | tmp
-                elif operation == cf.ATTR_OPTS.NOT:
-                    results = BitMap.difference(results, tmp)
-                else:  # default = AND
-                    results = results & tmp
-
-            # iw.print_status(
-            #     f"  {operation}. {pid}={qid} ({self.get_label(pid)}={self.get_label(qid)}) : {len(tmp):,} --> Context: {len(results):,}"
-            # )
+                if results is None:
+                    results = tmp
+                    if tmp is None:
+                        break
+                else:
+                    if operation == cf.ATTR_OPTS.AND:
+                        results = results & tmp
+                    elif operation == cf.ATTR_OPTS.OR:
+                        results = results | tmp
+                    elif operation == cf.ATTR_OPTS.NOT:
+                        results = BitMap.difference(results, tmp)
+                    else:  # default = AND
+                        results = results & tmp
+
+                # iw.print_status(
+                #     f"  {operation}. {pid}={qid} ({self.get_label(pid)}={self.get_label(qid)}) : {len(tmp):,} --> Context: {len(results):,}"
+                # )
         if results is None:
             return []
         if get_qid:
-            results = [self.get_qid(i) for i in results]
+            results = self.get_qids(results)
         else:
             results = results.to_array()
         return results
 
-    def build(self):
+    def get_build_state(self, stage):
+        return self.get_value(self.db_build_state, stage)
+
+    def set_build_state(self, stage, state):
+        self.write_bulk(self._env, self.db_build_state, {stage: state})
+
+    def get_build_profile(self):
+        """
+        :return: build profile of the DB (see config.BUILD_PROFILE), None if
+        everything of the json dump is stored
+        """
+        state = self.get_build_state("profile")
+        if not state:
+            return None
+        return state.get("profile")
+
+    def is_build_stage_done(self, stage):
+        state = self.get_build_state(stage)
+        return bool(state and state.get("done"))
+
+    def is_built(self):
+        if self.db_qid_trie is None:
+            return False
+        # DBs built before the build states were recorded have no state
+        state = self.get_build_state("build")
+        return state is None or state.get("done", False)
+
+    def build(self, bulk_load=cf.LMDB_BULK_LOAD):
+        with self.pause_reader():
+            if bulk_load:
+                with self.bulk_load():
+                    self._build()
+            else:
+                self._build()
+        self.clear_caches()
+
+    def _build(self):
+        # Finished stages are skipped when a build is resumed
+        self.set_build_state("build", {"done": False})
+
         # 1. Build trie and redirect
-        self.build_trie_and_redirects()
+        if not self.is_build_stage_done("trie_and_redirects"):
+            self.build_trie_and_redirects()
+            self.set_build_state("trie_and_redirects", {"done": True})
+
+        # 2. Build json dump, and haswbstatements from the claim postings
+        if not self.is_build_stage_done("json_dump"):
+            self.build_from_json_dump(n_process=6, build_haswbstatements=True)
 
-        # 2. Build json dump
-        self.build_from_json_dump(n_process=6)
+        # 3. Build haswdstatement if it was not built with the json dump
+        if not self.is_build_stage_done("haswbstatements"):
+            self.build_haswbstatements()
+            self.set_build_state("haswbstatements", {"done": True})
 
-        # 3. Build haswdstatement (Optional)
-        self.build_haswbstatements()
+        # 4. Build the language keyed stores
+        if cf.BUILD_LANGUAGE_KEYS and not self.is_build_stage_done("language_keys"):
+            self.build_language_keys()
+
+        # 5. Compress the values with zstd dictionaries
+        if cf.BUILD_ZSTD_DICTS and not self.is_build_stage_done("zstd_dicts"):
+            self.build_zstd_dicts()
+
+        # 6. Build the arrays of the labels and redirects
+        if cf.BUILD_ITEM_ARRAYS and not self.is_build_stage_done("item_arrays"):
+            self.build_item_arrays()
+
+        # 7. Build the direct types and the superclasses of classes
+        if cf.BUILD_TYPES and not self.is_build_stage_done("types"):
+            self.build_types()
+
+        self.set_build_state("build", {"done": True})
 
     def get_properties_from_head_qid_tail_qid(self, head_qid, tail_qid, get_qid=True):
         if not isinstance(head_qid, int):
@@ -586,63 +1403,454 @@ class DBWikidata(DBCore):
         if not get_posting:
             return self.get_memory_size(self.db_claim_ent_inv, key)
 
+        posting = self._get_cached("postings", key, lambda: self._get_posting(key))
+        if get_qid and posting is not None:
+            posting = self.get_qids(posting)
+        return posting
+
+    def get_all_instances(self, wd_id, get_qid=False):
+        """
+        Items of wdt:P31/wdt:P279* of a class: the instances (P31) of the class and
+        of its subclasses (P279*). The subclass tree is read from the P279
+        postings (and the items redirected to its classes, like get_subclass_of),
+        and the P31 postings of its classes are unioned. The results are cached
+        with the postings.
+        :return: BitMap of lids (or Wikidata IDs if get_qid), None if the class
+        has no lid
+        """
+        if wd_id is None:
+            return None
+        if not isinstance(wd_id, int):
+            wd_id = self.get_lid(wd_id)
+            if wd_id is None:
+                return None
+        key = f"{wd_id}|{cf.PATH_INSTANCE_OF}"
+        posting = self._get_cached(
+            "postings", key, lambda: self._get_all_instances(wd_id)
+        )
+        if get_qid:
+            posting = self.get_qids(posting)
+        return posting
+
+    def _get_postings_many(self, txn, keys):
+        """
+        :return: BitMaps of the keys of db_claim_ent_inv which have postings
+        """
+        keys = sorted(serialize_key(key) for key in keys)
+        return [
+            deserialize_value(value, bytes_value=cf.ToBytesType.INT_BITMAP)
+            for _, value in txn.cursor(self.db_claim_ent_inv).getmulti(keys)
+            if value
+        ]
+
+    def _get_all_instances(self, lid):
+        pid_instance_of, pid_subclass_of = self._get_type_pids()
+        with self._begin_read() as txn:
+            # The subclass tree, level by level
+            classes = {lid}
+            c_classes = [lid]
+            while c_classes:
+                subclasses = self._get_postings_many(
+                    txn, [f"{c_lid}|{pid_subclass_of}" for c_lid in c_classes]
+                )
+                subclasses += self._get_values_many(
+                    txn,
+                    self.db_redirect_of,
+                    sorted(c_classes),
+                    bytes_value=cf.ToBytesType.INT_NUMPY,
+                ).values()
+                c_classes = set()
+                for c_subclasses in subclasses:
+                    c_classes.update(c_subclasses)
+                c_classes -= classes
+                classes |= c_classes
+            postings = self._get_postings_many(
+                txn, [f"{c_lid}|{pid_instance_of}" for c_lid in classes]
+            )
+        posting = BitMap.union(*postings) if postings else BitMap()
+        if self.caches["postings"] is not None:
+            # The cached postings are shared, they are immutable
+            posting = FrozenBitMap(posting)
+        return posting
+
+    def _get_posting(self, key):
         posting = self.get_value(
             self.db_claim_ent_inv, key, bytes_value=cf.ToBytesType.INT_BITMAP
         )
-        if get_qid:
-            posting = [self.get_qid(p) for p in posting]
+        if posting is not None and self.caches["postings"] is not None:
+            # The cached postings are shared, they are immutable
+            posting = FrozenBitMap(posting)
         return posting
 
     def build_haswbstatements(self, buff_limit=cf.SIZE_512MB, step=10000):
-        invert_index = defaultdict(BitMap)
-
-        for i, head_id in enumerate(tqdm(self.keys(), total=self.size())):
+        # Postings of "{tail}" and "{tail}|{pid}" keys, spilled to disk when the
+        # buffer is full
+        index_builder = InvertedIndexBuilder(
+            dir_runs=os.path.dirname(self.db_file), buff_limit=buff_limit
+        )
+        p_bar = tqdm(total=self.get_db_size(self.db_claims), desc="Claims")
+        for i, (head_lid, v) in enumerate(
+            self.get_db_iter(
+                self.db_claims,
+                integerkey=True,
+                bytes_value=self._claims_bytes_value,
+                compress_value=self._compress_values["claims"],
+            )
+        ):
             if i and i % step == 0:
-                break
+                p_bar.update(step)
+            add_claim_postings(index_builder, head_lid, get_claim_postings(v))
+        p_bar.close()
+        index_builder.save(
+            self._env, self.db_claim_ent_inv, buff_limit=buff_limit, message="Save db"
+        )
+        index_builder.close()
+
+    def build_language_keys(self, step=10000):
+        """
+        Build the language keyed stores of labels, descriptions, and aliases from
+        db_labels, db_descriptions, and db_aliases. The value of a language is
+        stored with the key lid << 16 | language ID, so getting a language reads
+        only this value instead of decompressing the values of all languages.
+        """
+        self.set_build_state("language_keys", {"done": False})
+        self._language_keys = False
+        buff = []
+        buff_size = 0
 
-            head_lid = self.get_lid(head_id)
-            if head_lid is None or not isinstance(head_lid, int):
+        def save_buff(db_lang):
+            # Items are read in lid order, and the languages of an item are
+            # sorted, so the keys are appended
+            self.write_bulk(self._env, db_lang, buff, sort_key=False, append=True)
+            buff.clear()
+
+        for attr, (db, db_lang) in self._get_lang_dbs().items():
+            self.clear_db(db_lang)
+            p_bar = tqdm(total=self.get_db_size(db), desc=f"Language keys: {attr}")
+            for i, (lid, values) in enumerate(
+                self.get_db_iter(
+                    db, integerkey=True, compress_value=self._compress_values[attr]
+                )
+            ):
+                if i and i % step == 0:
+                    p_bar.update(step)
+                self._add_lang_ids(values.keys())
+                for lang_id, value in sorted(
+                    (self._lang_ids[lang], value) for lang, value in values.items()
+                ):
+                    key = serialize_key(
+                        get_lang_key(lid, lang_id), integerkey=True, is_64bit=True
+                    )
+                    value = serialize_value(value)
+                    buff.append((key, value))
+                    buff_size += len(key) + len(value)
+                if buff_size >= cf.LMDB_BUFF_BYTES_SIZE:
+                    save_buff(db_lang)
+                    buff_size = 0
+            if buff:
+                save_buff(db_lang)
+                buff_size = 0
+            p_bar.close()
+        self.set_build_state("language_keys", {"done": True})
+        self._language_keys = True
+
+    def build_zstd_dicts(
+        self, n_samples=cf.ZSTD_DICT_SAMPLES, dict_size=cf.ZSTD_DICT_SIZE
+    ):
+        """
+        Train a zstd dictionary for each of db_labels, db_descriptions, db_aliases,
+        db_sitelinks, and db_claims on samples of its values, store it in
+        db_zstd_dicts, and recompress the values of the DB with it. The values
+        are small and similar, so they are compressed better with a shared
+        dictionary than as independent lz4 frames. The values written before a
+        migration is finished are still lz4 frames, and they are read as lz4.
+        """
+        state = self.get_build_state("zstd_dicts") or {}
+        migrated = set(state.get("dbs", []))
+        for attr, db in self._get_zstd_dbs().items():
+            if attr in migrated:
                 continue
-            v = self.get_value(
-                self.db_claims, head_lid, integerkey=True, compress_value=True
+            codec = self._compress_values[attr]
+            if not isinstance(codec, ZstdCodec):
+                dict_data = self.train_zstd_dict(
+                    db, n_samples=n_samples, dict_size=dict_size
+                )
+                if dict_data is None:
+                    iw.print_status(f"Too few values to train a dictionary: {attr}")
+                    continue
+                self.write_bulk(self._env, self.db_zstd_dicts, {attr: dict_data})
+                codec = ZstdCodec(dict_data)
+                self._compress_values[attr] = codec
+            self.modify_db_compress_value(
+                db,
+                c_integerkey=True,
+                c_compress_value=codec,
+                n_integerkey=True,
+                n_compress_value=codec,
             )
-            if not v or not v.get("wikibase-entityid"):
-                continue
-            for claim_prop, claim_value_objs in v["wikibase-entityid"].items():
-                for claim_value_obj in claim_value_objs:
-                    claim_value = claim_value_obj["value"]
-                    if isinstance(claim_value, int):
-                        invert_index[f"{claim_value}|{claim_prop}"].add(head_lid)
-
-        invert_index = sorted(invert_index.items(), key=lambda x: x[0])
-        buff = []
+            migrated.add(attr)
+            self.set_build_state("zstd_dicts", {"done": False, "dbs": sorted(migrated)})
+        self.set_build_state("zstd_dicts", {"done": True, "dbs": sorted(migrated)})
+
+    def get_item_arrays(self):
+        """
+        :return: ItemArrays of the labels and redirects of lids, None if they are
+        not built (see build_item_arrays)
+        """
+        state = self.get_build_state("item_arrays")
+        if not state or not state.get("done"):
+            return None
+        if not os.path.exists(cf.DIR_WIKIDATA_ITEMS_ARRAYS):
+            return None
+        changed = state.get("changed")
+        if changed:
+            changed = BitMap.deserialize(changed)
+        return ItemArrays(cf.DIR_WIKIDATA_ITEMS_ARRAYS, changed)
+
+    def _iter_wd_codes(self):
+        """
+        :return: iterator of (lid, encoded Wikidata ID) of the trie and of the
+        IDs added by apply_delta
+        """
+        for wd_id, lid in self.db_qid_trie.iteritems():
+            yield lid, encode_wd_id(wd_id)
+        for lid, wd_id in self.get_db_iter(self.db_lid_ext, integerkey=True):
+            yield lid, encode_wd_id(wd_id)
+
+    def build_item_arrays(self):
+        """
+        Build the memory mapped arrays of the labels, redirects, and Wikidata IDs
+        of lids (see core.item_arrays.ItemArrays). get_label, get_label_many,
+        get_redirect, get_lid, and get_qid read them instead of LMDB and the
+        trie. The labels changed and the IDs added by apply_delta are read from
+        LMDB until the arrays are rebuilt.
+        """
+        self.set_build_state("item_arrays", {"done": False})
+        self._item_arrays = None
+        save_item_arrays(
+            cf.DIR_WIKIDATA_ITEMS_ARRAYS,
+            self.size(),
+            tqdm(
+                self.get_db_iter(self.db_label, integerkey=True),
+                total=self.get_db_size(self.db_label),
+                desc="Item arrays",
+            ),
+            self.get_db_iter(self.db_redirect, integerkey=True),
+            self._iter_wd_codes(),
+        )
+        self.set_build_state("item_arrays", {"done": True})
+        self._item_arrays = self.get_item_arrays()
+
+    def _get_type_pids(self):
+        """
+        :return: encoded pids of instance of (P31) and subclass of (P279)
+        """
+        return self.get_lid("P31", "P31"), self.get_lid("P279", "P279")
+
+    def _get_type_values(self, value, pids):
+        """
+        :param value: serialized claims of an item (db_claims)
+        :return: sets of the entity lids of pids, only the values of pids are
+        unpacked from packed claims
+        """
+        compress_value = self._compress_values["claims"]
+        if self._claims_bytes_value == cf.ToBytesType.CLAIMS:
+            if compress_value:
+                value = decompress_bytes(value, compress_value)
+            reader = ClaimsReader(value)
+            values = [reader.get_values(pid, "wikibase-entityid") for pid in pids]
+        else:
+            claims = deserialize_value(value, compress_value=compress_value)
+            claims = claims.get("wikibase-entityid") or {}
+            values = [[obj["value"] for obj in claims.get(pid, [])] for pid in pids]
+        return [{v for v in c_values if isinstance(v, int)} for c_values in values]
+
+    def _get_superclasses_successors(self, subclass_of):
+        """
+        :param subclass_of: function lid -> P279 lids of the class
+        :return: function lid -> P279 lids of a class, or of its redirect if the
+        class has none (like get_subclass_of)
+        """
+
+        def get_successors(lid):
+            successors = subclass_of(lid)
+            if not successors:
+                redirect = self.get_redirect(lid, decode=False)
+                if redirect is not None and redirect != lid:
+                    successors = subclass_of(redirect)
+            return successors
+
+        return get_successors
+
+    def build_types(self, step=10000):
+        """
+        Build the direct types of items and the superclasses of classes:
+        db_instance_of and db_subclass_of store the sorted lids of the P31 and P279
+        values of items (uint32 arrays), and db_superclasses stores the transitive
+        closure of P279 of each class (BitMap, see core.class_closure).
+        get_all_types reads the direct types of an item and the union of their
+        closures instead of the claims of every superclass. The P279 edges are
+        kept in memory to compute the closures.
+        """
+        self.set_build_state("types", {"done": False})
+        self._types = False
+        for db in [self.db_instance_of, self.db_subclass_of, self.db_superclasses]:
+            self.clear_db(db)
+        pids = self._get_type_pids()
+        subclass_of = {}
+        buff = {self.db_instance_of: [], self.db_subclass_of: []}
         buff_size = 0
-        tail_kv_list = []
-        tail_k = None
-        tail_v = BitMap()
-        for k, v in tqdm(invert_index, desc="Save db", total=len(invert_index)):
-            tmp_k = k.split("|")[0]
-            if tmp_k != tail_k:
-                if tail_k:
-                    tail_k, tail_v = serialize(
-                        tail_k, tail_v, bytes_value=cf.ToBytesType.INT_BITMAP
+
+        def save_buff():
+            # Items are read in lid order, so the keys are appended
+            for db, db_buff in buff.items():
+                if db_buff:
+                    self.write_bulk(self._env, db, db_buff, sort_key=False, append=True)
+                    db_buff.clear()
+
+        p_bar = tqdm(total=self.get_db_size(self.db_claims), desc="Types")
+        for i, (key, value) in enumerate(
+            self.get_db_iter(self.db_claims, deserialize_obj=False)
+        ):
+            if i and i % step == 0:
+                p_bar.update(step)
+            lid = deserialize_key(key, integerkey=True)
+            instance_of, c_subclass_of = self._get_type_values(value, pids)
+            if c_subclass_of:
+                subclass_of[lid] = tuple(sorted(c_subclass_of))
+            for db, values in [
+                (self.db_instance_of, instance_of),
+                (self.db_subclass_of, c_subclass_of),
+            ]:
+                if values:
+                    key = serialize_key(lid, integerkey=True)
+                    values = serialize_value(
+                        values, bytes_value=cf.ToBytesType.INT_NUMPY
                     )
-                    buff_size += len(tail_k) + len(tail_v)
-                    buff.append((tail_k, tail_v))
-                    buff.extend(tail_kv_list)
-                tail_k = tmp_k
-                tail_v = BitMap()
-                tail_kv_list = []
-            tail_v.update(v)
-            k, v = serialize(k, v, bytes_value=cf.ToBytesType.INT_BITMAP)
-            buff_size += len(k) + len(v)
-            tail_kv_list.append((k, v))
-            if buff_size > buff_limit:
-                self.write_bulk(self._env, self.db_claim_ent_inv, buff, sort_key=False)
-                buff = []
+                    buff[db].append((key, values))
+                    buff_size += len(key) + len(values)
+            if buff_size >= cf.LMDB_BUFF_BYTES_SIZE:
+                save_buff()
                 buff_size = 0
-        if buff_size:
-            self.write_bulk(self._env, self.db_claim_ent_inv, buff, sort_key=False)
+        save_buff()
+        p_bar.close()
+
+        superclasses = {}
+        get_successors = self._get_superclasses_successors(subclass_of.get)
+        for lid, closure in tqdm(
+            iter_class_closures(list(subclass_of), get_successors),
+            desc="Superclasses",
+        ):
+            if closure:
+                superclasses[lid] = closure
+        del subclass_of
+        if superclasses:
+            self.write_bulk_with_buffer(
+                self._env,
+                self.db_superclasses,
+                superclasses,
+                integerkey=True,
+                bytes_value=cf.ToBytesType.INT_BITMAP,
+                message="Superclasses",
+            )
+        self.set_build_state("types", {"done": True})
+        self._types = True
+
+    def _update_types(self, items):
+        """
+        Rewrite the direct types of items, and the superclasses of the classes
+        whose P279 values changed and of their subclasses
+        :param items: {lid: (set of P31 lids, set of P279 lids)}
+        """
+        lids = sorted(items)
+        changed = set()
+        for i, db in enumerate([self.db_instance_of, self.db_subclass_of]):
+            old_values = self.get_value(
+                db, lids, integerkey=True, bytes_value=cf.ToBytesType.INT_NUMPY
+            )
+            buff = {}
+            buff_delete = []
+            for lid in lids:
+                values = items[lid][i]
+                if values == set(old_values.get(lid) or []):
+                    continue
+                if db == self.db_subclass_of:
+                    changed.add(lid)
+                if values:
+                    buff[lid] = values
+                else:
+                    buff_delete.append(lid)
+            if buff:
+                self.write_bulk(
+                    self._env,
+                    db,
+                    buff,
+                    integerkey=True,
+                    bytes_value=cf.ToBytesType.INT_NUMPY,
+                )
+            if buff_delete:
+                self.delete(db, buff_delete, integerkey=True)
+        if not changed:
+            return
+
+        # The subclasses (P279 postings of db_claim_ent_inv) and the redirects of
+        # the changed classes reach them
+        pid = self._get_type_pids()[1]
+        affected = set()
+        lids_queue = list(changed)
+        while lids_queue:
+            lid = lids_queue.pop()
+            if lid in affected:
+                continue
+            affected.add(lid)
+            subclasses = self.get_value(
+                self.db_claim_ent_inv,
+                f"{lid}|{pid}",
+                bytes_value=cf.ToBytesType.INT_BITMAP,
+            )
+            if subclasses:
+                lids_queue.extend(subclasses)
+            redirects_of = self.get_redirect_of(lid, decode=False)
+            if redirects_of:
+                lids_queue.extend(redirects_of)
+
+        def get_subclass_of(lid):
+            return self.get_value(
+                self.db_subclass_of,
+                lid,
+                integerkey=True,
+                bytes_value=cf.ToBytesType.INT_NUMPY,
+            )
+
+        def get_superclasses(lid):
+            return self.get_value(
+                self.db_superclasses,
+                lid,
+                integerkey=True,
+                bytes_value=cf.ToBytesType.INT_BITMAP,
+            )
+
+        superclasses = {}
+        superclasses_empty = []
+        for lid, closure in iter_class_closures(
+            affected,
+            self._get_superclasses_successors(get_subclass_of),
+            get_superclasses,
+        ):
+            if closure:
+                superclasses[lid] = closure
+            else:
+                superclasses_empty.append(lid)
+        if superclasses:
+            self.write_bulk(
+                self._env,
+                self.db_superclasses,
+                superclasses,
+                integerkey=True,
+                bytes_value=cf.ToBytesType.INT_BITMAP,
+            )
+        if superclasses_empty:
+            self.delete(self.db_superclasses, superclasses_empty, integerkey=True)
 
     def build_trie_and_redirects(self, step=100000):
         if not os.path.exists(cf.DIR_DUMP_WIKIDATA_PAGE):
@@ -650,57 +1858,88 @@ class DBWikidata(DBCore):
         if not os.path.exists(cf.DIR_DUMP_WIKIDATA_REDIRECT):
             raise Exception(f"Please download file {cf.DIR_DUMP_WIKIDATA_REDIRECT}")
 
-        wd_id_qid = {}
-        with gzip.open(
-            cf.DIR_DUMP_WIKIDATA_PAGE, "rt", encoding="utf-8", newline="\n"
-        ) as f:
-            p_bar = tqdm(desc="Wikidata pages")
-            i = 0
-            for line in f:
-                if not line.startswith("INSERT INTO"):
-                    continue
-                for v in parse_sql_values(line):
-                    if is_wd_item(v[2]):
-                        i += 1
-                        if i and i % step == 0:
-                            p_bar.update(step)
-                        wd_id_qid[v[0]] = v[2]
-                # if len(wd_id_qid) > 1000000:
-                #     break
-            p_bar.close()
-
-        self.db_qid_trie = marisa_trie.Trie(wd_id_qid.values())
+        # Page IDs and encoded Wikidata IDs are kept in int64 arrays (16 bytes per
+        # page) instead of a dict of str, the redirects are joined with the pages
+        # by binary search on the sorted page IDs.
+        # Columns: page_id, page_title
+        page_ids, wd_codes = array("q"), array("q")
+        p_bar = tqdm(desc="Wikidata pages")
+        i = 0
+        for page_id, title in iter_sql_dump(
+            cf.DIR_DUMP_WIKIDATA_PAGE, columns=(0, 2), types=(int, str)
+        ):
+            wd_code = encode_wd_id(title)
+            if wd_code is None:
+                continue
+            i += 1
+            if i and i % step == 0:
+                p_bar.update(step)
+            page_ids.append(page_id)
+            wd_codes.append(wd_code)
+        p_bar.close()
+
+        page_ids = np.frombuffer(page_ids, dtype=np.int64)
+        wd_codes = np.frombuffer(wd_codes, dtype=np.int64)
+        order = np.argsort(page_ids, kind="stable")
+        page_ids = page_ids[order]
+        wd_codes = wd_codes[order]
+        del order
+
+        # Columns: rd_from, rd_title
+        redirect_page_ids, redirect_codes = array("q"), array("q")
+        p_bar = tqdm(desc="Wikidata redirects")
+        i = 0
+        for page_id, title in iter_sql_dump(
+            cf.DIR_DUMP_WIKIDATA_REDIRECT, columns=(0, 2), types=(int, str)
+        ):
+            wd_code = encode_wd_id(title)
+            if wd_code is None:
+                continue
+            i += 1
+            if i and i % step == 0:
+                p_bar.update(step)
+            redirect_page_ids.append(page_id)
+            redirect_codes.append(wd_code)
+        p_bar.close()
+
+        # Join the redirect sources with the pages, the last page of duplicated
+        # page IDs is used
+        redirect_page_ids = np.frombuffer(redirect_page_ids, dtype=np.int64)
+        redirect_codes = np.frombuffer(redirect_codes, dtype=np.int64)
+        pos = np.searchsorted(page_ids, redirect_page_ids, side="right") - 1
+        found = pos >= 0
+        found[found] = page_ids[pos[found]] == redirect_page_ids[found]
+        source_codes = wd_codes[pos[found]]
+        redirect_codes = redirect_codes[found]
+        del page_ids, redirect_page_ids, pos, found
+
+        # Build the trie from the sorted IDs, the keys are generated from the
+        # codes one by one. Duplicated IDs (e.g., talk pages) are kept, they are
+        # the key weights of the trie.
+        wd_codes.sort()
+        self.db_qid_trie = marisa_trie.Trie(
+            decode_wd_id(wd_code) for wd_code in wd_codes
+        )
+        del wd_codes
         self.db_qid_trie.save(cf.DIR_WIKIDATA_ITEMS_TRIE)
         iw.print_status(f"Trie Saved: {len(self.db_qid_trie):,}")
 
-        buff_obj = defaultdict()
-        with gzip.open(
-            cf.DIR_DUMP_WIKIDATA_REDIRECT, "rt", encoding="utf-8", newline="\n",
-        ) as f:
-            i = 0
-            p_bar = tqdm(desc="Wikidata redirects")
-            for line in f:
-                if not line.startswith("INSERT INTO"):
-                    continue
-                for v in parse_sql_values(line):
-                    qid = wd_id_qid.get(v[0])
-                    if not qid:
-                        continue
-                    lid = self.get_lid(qid)
-                    if lid is None:
-                        continue
-                    if is_wd_item(v[2]):
-                        redirect = self.get_lid(v[2])
-                        if redirect is None:
-                            continue
-                        buff_obj[lid] = redirect
-                        i += 1
-                        if i and i % step == 0:
-                            p_bar.update(step)
-            p_bar.close()
+        buff_obj = {}
+        for source_code, redirect_code in zip(
+            source_codes.tolist(), redirect_codes.tolist()
+        ):
+            lid = self.get_lid(decode_wd_id(source_code))
+            if lid is None:
+                continue
+            redirect = self.get_lid(decode_wd_id(redirect_code))
+            if redirect is None:
+                continue
+            buff_obj[lid] = redirect
 
         if buff_obj:
-            self.write_bulk(self._env, self.db_redirect, buff_obj, integerkey=True)
+            self.write_bulk(
+                self._env, self.db_redirect, buff_obj, integerkey=True, append=True
+            )
             buff_obj_inv = defaultdict(set)
             for k, v in buff_obj.items():
                 buff_obj_inv[v].add(k)
@@ -710,175 +1949,865 @@ class DBWikidata(DBCore):
                 buff_obj_inv,
                 integerkey=True,
                 bytes_value=cf.ToBytesType.INT_NUMPY,
+                append=True,
             )
 
-    def build_from_json_dump(self, json_dump=cf.DIR_DUMP_WD, n_process=1, step=1000):
-        iter_items = DumpReaderWikidata(json_dump)
+    def build_from_json_dump(
+        self,
+        json_dump=cf.DIR_DUMP_WD,
+        n_process=1,
+        step=1000,
+        build_haswbstatements=False,
+        buff_limit_index=cf.SIZE_512MB,
+        profile=cf.BUILD_PROFILE,
+    ):
+        """
+        Parse the json dump and save the items
+        :param build_haswbstatements: also build db_claim_ent_inv from the
+        (tail, pid, head) postings of the entity claims, in the same pass
+        :param buff_limit_index: memory budget of the postings
+        :param profile: build profile (see config.BUILD_PROFILE), it is saved
+        in the DB and used by apply_delta
+        """
+        profile = normalize_build_profile(profile)
         attr_db = {
             "label": self.db_label,
             "labels": self.db_labels,
             "descriptions": self.db_descriptions,
             "aliases": self.db_aliases,
             "claims": self.db_claims,
+            "references": self.db_references,
             "sitelinks": self.db_sitelinks,
         }
 
+        # Resume from the last checkpoint: the lines or shards of the dump which
+        # are already saved. Items are keyed by lid, so re-parsed items overwrite
+        # their rows instead of adding duplicates.
+        checkpoint = self.get_build_state("json_dump")
+        if (
+            not checkpoint
+            or checkpoint.get("dump") != json_dump
+            or checkpoint.get("profile") != profile
+        ):
+            if checkpoint and (checkpoint["lines"] or checkpoint["shards"]):
+                # Remove the items of the previous dump or profile
+                iw.print_status("Restart json dump: the dump or profile changed")
+                for db in list(attr_db.values()) + [self.db_claim_ent_inv]:
+                    self.clear_db(db)
+                # The inverted index is built from the items again
+                self.set_build_state("haswbstatements", {"done": False})
+                # The language keyed stores are built from the items again
+                if self.get_build_state("language_keys"):
+                    self.set_build_state("language_keys", {"done": False})
+                    self._language_keys = False
+                    for _, db_lang in self._get_lang_dbs().values():
+                        self.clear_db(db_lang)
+                # The types are built from the claims again
+                if self.get_build_state("types"):
+                    self.set_build_state("types", {"done": False})
+                    self._types = False
+                    for db in [
+                        self.db_instance_of,
+                        self.db_subclass_of,
+                        self.db_superclasses,
+                    ]:
+                        self.clear_db(db)
+                # The items are saved as lz4 frames, and the zstd dictionaries are
+                # trained on them again
+                if self.get_build_state("zstd_dicts"):
+                    self.set_build_state("zstd_dicts", {"done": False, "dbs": []})
+                    self.clear_db(self.db_zstd_dicts)
+                    self._compress_values = self.get_compress_values()
+                # The arrays of the labels and redirects are built again
+                if self.get_build_state("item_arrays"):
+                    self.set_build_state("item_arrays", {"done": False})
+                    self._item_arrays = None
+                    iw.delete_folder(cf.DIR_WIKIDATA_ITEMS_ARRAYS)
+                if checkpoint.get("index_runs"):
+                    iw.delete_folder(os.path.dirname(checkpoint["index_runs"][0]))
+            checkpoint = {
+                "done": False,
+                "dump": json_dump,
+                "profile": profile,
+                "shard_size": cf.DUMP_SHARD_SIZE,
+                "shards": [],
+                "lines": 0,
+                "last_lid": None,
+                "count": 0,
+                "saved_bytes": 0,
+                "index_runs": [] if build_haswbstatements else None,
+                "claims_bytes_value": cf.ToBytesType.CLAIMS,
+            }
+        elif checkpoint["lines"] or checkpoint["shards"]:
+            iw.print_status(
+                f"Resume json dump: {checkpoint['count']:,} items, "
+                f"{checkpoint['lines']:,} lines, last lid: {checkpoint['last_lid']}"
+            )
+        shards_done = set(checkpoint["shards"])
+        shards_pending = []
+        self.set_build_state("profile", {"profile": profile})
+        # The items of a build resumed from a checkpoint without the claims format
+        # are msgpack
+        claims_bytes_value = checkpoint.get("claims_bytes_value", cf.ToBytesType.OBJ)
+        self.set_build_state("claims", {"bytes_value": claims_bytes_value})
+        self._claims_bytes_value = claims_bytes_value
+
+        # Items are buffered per DB, a full buffer is sorted by lid and queued
+        # to the writer thread, so parsing continues while the writer commits.
+        # buff_size is the size of the items since the last checkpoint.
         buff = {attr: [] for attr in attr_db.keys()}
+        buff_attr_size = {attr: 0 for attr in attr_db.keys()}
         buff_size = 0
-        count = 0
+        count = checkpoint["count"]
+        n_lines = checkpoint["lines"]
+        last_lid = checkpoint["last_lid"]
+
+        # The postings are flushed to run files at each checkpoint, the runs of
+        # the saved items are kept in the checkpoint
+        index_builder = None
+        if build_haswbstatements and checkpoint.get("index_runs") is None:
+            # The saved items of the resumed build have no postings
+            iw.print_status("haswbstatements will be built after the json dump")
+        elif build_haswbstatements:
+            index_builder = InvertedIndexBuilder(
+                dir_runs=os.path.dirname(self.db_file),
+                buff_limit=buff_limit_index,
+                runs=checkpoint.get("index_runs"),
+            )
 
         def update_desc():
             return f"Wikidata Parsing|items:{count:,}|{buff_size / cf.LMDB_BUFF_BYTES_SIZE * 100:.0f}%"
 
-        def save_buff(buff):
-            for attr in buff.keys():
-                if not buff[attr]:
-                    continue
-                buff[attr].sort(key=lambda x: x[0])
-                buff[attr] = [
-                    (serialize_key(k, integerkey=True), v) for k, v in buff[attr]
-                ]
-                self.write_bulk(self.env, attr_db[attr], buff[attr], sort_key=False)
-                buff[attr] = []
-                gc.collect()
-            buff = {attr: [] for attr in attr_db.keys()}
-            return buff
-
-        def encode_ref_nodes(c_refs):
-            encode_ref_nodes = []
-            for c_ref_nodes in c_refs:
-                encode_ref_node = {}
-                for ref_type, ref_values in c_ref_nodes.items():
-                    encode_ref_type = {}
-                    for (ref_prop, ref_value_objs) in ref_values.items():
-                        encode_ref_prop = self.get_lid(ref_prop, ref_prop)
-                        encode_ref_values = []
-                        for ref_value_obj in ref_value_objs:
-                            if ref_type == "wikibase-entityid":
-                                ref_value_obj = self.get_lid(
-                                    ref_value_obj, ref_value_obj
-                                )
-                            encode_ref_values.append(ref_value_obj)
-                        encode_ref_type[encode_ref_prop] = encode_ref_values
-                    encode_ref_node[ref_type] = encode_ref_type
-                encode_ref_nodes.append(encode_ref_node)
-            return encode_ref_nodes
-
-        p_bar = tqdm(desc=update_desc(), total=90000000)
-        if n_process == 1:
-            for i, iter_item in enumerate(iter_items):
-                wd_respond = parse_json_dump(iter_item)
-                # with closing(Pool(n_process)) as pool:
-                #     for i, wd_respond in enumerate(
-                #         pool.imap_unordered(parse_json_dump, iter_items)
-                #     ):
-                # if count > 10000:
-                #     break
-                if i and i % step == 0:
-                    p_bar.set_description(desc=update_desc())
-                    p_bar.update(step)
-                if not wd_respond:
-                    continue
-                wd_id, wd_obj = wd_respond
-                lid = self.get_lid(wd_id)
-                if lid is None:
-                    continue
-
-                if wd_obj.get("claims") and wd_obj["claims"].get("wikibase-entityid"):
-                    if wd_obj["claims"]["wikibase-entityid"].get("P31"):
-                        instance_ofs = {
-                            i["value"]
-                            for i in wd_obj["claims"]["wikibase-entityid"]["P31"]
-                        }
-                        if cf.WIKIDATA_IDENTIFIERS.intersection(instance_ofs):
-                            continue
-                    if wd_obj["claims"]["wikibase-entityid"].get("P279"):
-                        subclass_ofs = {
-                            i["value"]
-                            for i in wd_obj["claims"]["wikibase-entityid"]["P279"]
-                        }
-                        if cf.WIKIDATA_IDENTIFIERS.intersection(subclass_ofs):
-                            continue
-                count += 1
-
-                for attr, value in wd_obj.items():
-                    if not value:
-                        continue
+        def save_buff(writer, attr):
+            if not buff[attr]:
+                return
+            data = buff[attr]
+            data.sort(key=lambda x: x[0])
+            is_64bit = attr == "references"
+            data = [
+                (serialize_key(k, integerkey=True, is_64bit=is_64bit), v)
+                for k, v in data
+            ]
+            writer.put(
+                attr_db[attr], data, sort_key=False, integerkey=True, append=True
+            )
+            buff[attr] = []
+            buff_attr_size[attr] = 0
+
+        def save_checkpoint(writer=None, done=False):
+            # With a writer, the checkpoint is saved by the writer thread after
+            # the queued items
+            shards_done.update(shards_pending)
+            shards_pending.clear()
+            checkpoint["done"] = done
+            checkpoint["shards"] = sorted(shards_done)
+            checkpoint["lines"] = n_lines
+            checkpoint["last_lid"] = last_lid
+            checkpoint["count"] = count
+            if index_builder is not None:
+                index_builder.flush()
+                checkpoint["index_runs"] = list(index_builder.runs)
+            state = dict(checkpoint)
+            if writer is None:
+                self.set_build_state("json_dump", state)
+            else:
+                writer.put_callback(lambda: self.set_build_state("json_dump", state))
+
+        def iter_encoded_batches():
+            # Yield (shard id, encoded items) of a shard or a batch of lines
+            shards = DumpShardReaderWikidata(
+                json_dump, shard_size=checkpoint["shard_size"]
+            ).get_shards()
+            if shards:
+                shards = [shard for shard in shards if shard[0] not in shards_done]
+            else:
+                iter_items = islice(
+                    DumpReaderWikidata(json_dump), checkpoint["lines"], None
+                )
 
-                    if attr == "claims":
-                        encode_attr = {}
-                        for c_type, c_statements in value.items():
-                            encode_c_type = {}
-                            for c_prop, c_values in c_statements.items():
-                                encode_c_prop = self.get_lid(c_prop, c_prop)
-                                encode_c_values = []
-                                for c_value in c_values:
-                                    decode_c_value = c_value["value"]
-                                    if c_type == "wikibase-entityid":
-                                        decode_c_value = self.get_lid(
-                                            decode_c_value, decode_c_value
-                                        )
-                                    elif c_type == "quantity":
-                                        if decode_c_value[1] != "1":
-                                            decode_c_value = (
-                                                decode_c_value[0],
-                                                self.get_lid(
-                                                    decode_c_value[1], decode_c_value[1]
-                                                ),
-                                            )
-                                        else:
-                                            decode_c_value = (decode_c_value[0], -1)
-                                    c_refs = c_value.get("references")
-                                    if c_refs:
-                                        c_refs = encode_ref_nodes(c_refs)
-                                        encode_c_values.append(
-                                            {
-                                                "value": decode_c_value,
-                                                "references": c_refs,
-                                            }
-                                        )
-                                    else:
-                                        encode_c_values.append(
-                                            {"value": decode_c_value}
-                                        )
-                                encode_c_type[encode_c_prop] = encode_c_values
-
-                            encode_attr[c_type] = encode_c_type
-                        value = encode_attr
-                    if attr == "label":
-                        compress_value = False
+            if n_process == 1:
+                init_json_dump_worker(
+                    trie=self.db_qid_trie,
+                    profile=profile,
+                    claims_bytes_value=claims_bytes_value,
+                )
+                if shards:
+                    for shard in shards:
+                        yield encode_json_dump_shard(shard)
+                else:
+                    while True:
+                        wd_responds = [
+                            encode_json_dump(iter_item)
+                            for iter_item in islice(iter_items, step)
+                        ]
+                        if not wd_responds:
+                            break
+                        yield None, wd_responds
+            else:
+                # Workers decompress, parse and encode, the main process is the only writer
+                with closing(
+                    Pool(
+                        n_process,
+                        initializer=init_json_dump_worker,
+                        initargs=(
+                            cf.DIR_WIKIDATA_ITEMS_TRIE,
+                            None,
+                            profile,
+                            claims_bytes_value,
+                        ),
+                    )
+                ) as pool:
+                    if shards:
+                        for shard_id, wd_responds in pool.imap_unordered(
+                            encode_json_dump_shard, shards
+                        ):
+                            yield shard_id, wd_responds
                     else:
-                        compress_value = True
-                    value = serialize_value(value, compress_value=compress_value)
-                    buff_size += len(value)
-                    buff[attr].append([lid, value])
+                        # Keep the line order, so the checkpoint is a line offset
+                        wd_responds = []
+                        for wd_respond in pool.imap(
+                            encode_json_dump, iter_items, chunksize=step
+                        ):
+                            wd_responds.append(wd_respond)
+                            if len(wd_responds) == step:
+                                yield None, wd_responds
+                                wd_responds = []
+                        if wd_responds:
+                            yield None, wd_responds
+
+        p_bar = tqdm(desc=update_desc(), total=90000000, initial=n_lines)
+        with DBWriter(self._env) as writer:
+            for shard_id, wd_responds in iter_encoded_batches():
+                for wd_respond in wd_responds:
+                    if not wd_respond:
+                        continue
+                    lid, wd_values, postings = wd_respond
+                    count += 1
+                    if last_lid is None or lid > last_lid:
+                        last_lid = lid
+                    if index_builder is not None:
+                        add_claim_postings(index_builder, lid, postings)
+                    for attr, value in wd_values.items():
+                        if attr == "references":
+                            rows = [
+                                (get_reference_key(lid, statement_id), v)
+                                for statement_id, v in value
+                            ]
+                        else:
+                            rows = [(lid, value)]
+                        for key, value in rows:
+                            buff_size += len(value)
+                            buff_attr_size[attr] += len(value)
+                            buff[attr].append([key, value])
+                        if buff_attr_size[attr] > cf.LMDB_WRITER_BATCH_SIZE:
+                            save_buff(writer, attr)
+                n_lines += len(wd_responds)
+                if shard_id is not None:
+                    shards_pending.append(shard_id)
+                p_bar.set_description(desc=update_desc())
+                p_bar.update(len(wd_responds))
 
-                # Save buffer data
+                # Queue the buffers, then the checkpoint
                 if buff_size > cf.LMDB_BUFF_BYTES_SIZE:
-                    p_bar.set_description(desc=update_desc())
-                    buff = save_buff(buff)
+                    for attr in attr_db.keys():
+                        save_buff(writer, attr)
+                    checkpoint["saved_bytes"] += buff_size
                     buff_size = 0
+                    save_checkpoint(writer)
+
+            p_bar.set_description(desc=update_desc())
+            for attr in attr_db.keys():
+                save_buff(writer, attr)
+            checkpoint["saved_bytes"] += buff_size
+            buff_size = 0
+            if index_builder is not None:
+                # The runs are kept until the index is saved, saving it again
+                # after a crash overwrites the same keys
+                save_checkpoint(writer)
+        p_bar.close()
+
+        if index_builder is not None:
+            index_builder.save(
+                self._env,
+                self.db_claim_ent_inv,
+                buff_limit=buff_limit_index,
+                message="Save haswbstatements",
+            )
+            self.set_build_state("haswbstatements", {"done": True})
+        save_checkpoint(done=True)
+        if index_builder is not None:
+            index_builder.close()
+
+    def _add_lids(self, wd_ids):
+        """
+        Assign local IDs to new Wikidata IDs. The trie is immutable, so the new
+        IDs are stored in db_qid_ext and db_lid_ext after the trie IDs.
+        """
+        new_ids = sorted({wd_id for wd_id in wd_ids if self.get_lid(wd_id) is None})
+        if not new_ids:
+            return
+        next_lid = len(self.db_qid_trie) + self._size_lid_ext
+        new_lids = {wd_id: next_lid + i for i, wd_id in enumerate(new_ids)}
+        self.write_bulk(self._env, self.db_qid_ext, new_lids)
+        self.write_bulk(
+            self._env,
+            self.db_lid_ext,
+            {lid: wd_id for wd_id, lid in new_lids.items()},
+            integerkey=True,
+        )
+        self._size_lid_ext += len(new_lids)
+
+    def apply_delta(self, json_lines, step=10000):
+        """
+        Update the DB with the changed entities of json dump lines, e.g., lines of
+        the Wikidata incremental or entity change dumps. New Wikidata IDs get new
+        local IDs, the rows of changed entities are rewritten, and the inverted
+        index (db_claim_ent_inv) is patched with the claim changes.
+        :return: number of updated entities
+        """
+        count = 0
+        batch = []
+        # The batches read the rows written by the previous batches
+        with self.pause_reader():
+            for json_line in json_lines:
+                wd_respond = parse_json_dump(json_line)
+                if not wd_respond:
+                    continue
+                batch.append(wd_respond)
+                if len(batch) >= step:
+                    count += self._apply_delta_batch(batch)
+                    batch = []
+            if batch:
+                count += self._apply_delta_batch(batch)
+        return count
+
+    def _rewrite_item_rows(self, db, id_bits, items):
+        """
+        Replace the rows of items in a DB keyed by lid << id_bits | ID
+        :param items: {lid: list of (ID, serialized value)}, the rows of an item
+        are deleted if its list is empty
+        """
+        if not items:
+            return
+        with self._env.begin(db=db, write=True) as txn:
+            cur = txn.cursor()
+            for lid, rows in sorted(items.items()):
+                start = lid << id_bits
+                if cur.set_range(serialize_key(start, integerkey=True, is_64bit=True)):
+                    while True:
+                        key = cur.key()
+                        if not key:
+                            break
+                        key = deserialize_key(key, integerkey=True, is_64bit=True)
+                        if key >> id_bits != lid or not cur.delete():
+                            break
+                for row_id, value in rows:
+                    key = serialize_key(start | row_id, integerkey=True, is_64bit=True)
+                    txn.put(key, value)
+
+    def _update_lang_values(self, lang_values):
+        """
+        Rewrite the values of items in the language keyed stores
+        :param lang_values: {attr: {lid: {lang: value} or None}}
+        """
+        for attr, (_, db_lang) in self._get_lang_dbs().items():
+            items = lang_values.get(attr)
+            if not items:
+                continue
+            for values in items.values():
+                if values:
+                    self._add_lang_ids(values.keys())
+            self._rewrite_item_rows(
+                db_lang,
+                LANG_ID_BITS,
+                {
+                    lid: [
+                        (self._lang_ids[lang], serialize_value(value))
+                        for lang, value in (values or {}).items()
+                    ]
+                    for lid, values in items.items()
+                },
+            )
 
-            if buff_size:
-                p_bar.set_description(desc=update_desc())
-                save_buff(buff)
-                buff_size = 0
+    def _apply_delta_batch(self, batch):
+        attr_db = {
+            "label": self.db_label,
+            "labels": self.db_labels,
+            "descriptions": self.db_descriptions,
+            "aliases": self.db_aliases,
+            "claims": self.db_claims,
+            "sitelinks": self.db_sitelinks,
+        }
+        # Keep the latest version of each entity
+        wd_objs = {wd_id: wd_obj for wd_id, wd_obj in batch}
+
+        # Assign lids for new entities before encoding claims
+        self._add_lids(wd_objs.keys())
+
+        # Entities out of the build profile are removed like identifiers
+        profile = self.get_build_profile()
+        buff = {attr: {} for attr in attr_db.keys()}
+        buff_delete = {attr: [] for attr in attr_db.keys()}
+        postings_add = defaultdict(set)
+        postings_delete = defaultdict(set)
+        lang_values = {attr: {} for attr in self._get_lang_dbs().keys()}
+        references = {}
+        types = {}
+        type_pids = self._get_type_pids()
+        for wd_id, wd_obj in wd_objs.items():
+            lid = self.get_lid(wd_id)
+            new_postings = set()
+            if not is_wikidata_identifier(wd_obj):
+                wd_obj = filter_wd_obj(wd_obj, profile)
+            else:
+                wd_obj = None
+            if wd_obj is None:
+                wd_values = {}
+            else:
+                wd_values = encode_wd_obj(
+                    wd_obj,
+                    self.get_lid,
+                    new_postings,
+                    self._claims_bytes_value,
+                    self._compress_values,
+                )
 
+            # Patch the postings of the entity claims
+            old_claims = self.get_value(
+                self.db_claims,
+                lid,
+                integerkey=True,
+                bytes_value=self._claims_bytes_value,
+                compress_value=self._compress_values["claims"],
+            )
+            old_postings = get_claim_postings(old_claims)
+            for tail, pid in old_postings - new_postings:
+                postings_delete[f"{tail}|{pid}"].add(lid)
+            for tail, pid in new_postings - old_postings:
+                postings_add[f"{tail}|{pid}"].add(lid)
+            old_tails = {tail for tail, _ in old_postings}
+            new_tails = {tail for tail, _ in new_postings}
+            for tail in old_tails - new_tails:
+                postings_delete[str(tail)].add(lid)
+            for tail in new_tails - old_tails:
+                postings_add[str(tail)].add(lid)
+
+            for attr in attr_db.keys():
+                if wd_values.get(attr):
+                    buff[attr][lid] = wd_values[attr]
+                else:
+                    buff_delete[attr].append(lid)
+            for attr in lang_values.keys():
+                lang_values[attr][lid] = wd_obj.get(attr) if wd_obj else None
+            references[lid] = wd_values.get("references", [])
+            if self._types:
+                types[lid] = tuple(
+                    {tail for tail, c_pid in new_postings if c_pid == type_pid}
+                    for type_pid in type_pids
+                )
 
-def parse_json_dump(json_line):
-    if isinstance(json_line, bytes) or isinstance(json_line, bytearray):
-        line = json_line.rstrip().decode(cf.ENCODING)
-    else:
-        line = json_line.rstrip()
-    if line in ("[", "]"):
+        for attr, db in attr_db.items():
+            if buff[attr]:
+                buff[attr] = [
+                    (serialize_key(k, integerkey=True), v)
+                    for k, v in sorted(buff[attr].items())
+                ]
+                self.write_bulk(self._env, db, buff[attr], sort_key=False)
+            if buff_delete[attr]:
+                self.delete(db, buff_delete[attr], integerkey=True)
+        self._rewrite_item_rows(self.db_references, STATEMENT_ID_BITS, references)
+        if self._language_keys:
+            self._update_lang_values(lang_values)
+        if self._item_arrays is not None:
+            # The arrays are immutable, the labels of these lids are read from LMDB
+            self._item_arrays.add_changed(
+                lid for lid in references.keys() if lid < self._item_arrays.size
+            )
+            self.set_build_state(
+                "item_arrays",
+                {"done": True, "changed": self._item_arrays.changed.serialize()},
+            )
+
+        postings = {}
+        postings_empty = []
+        for key in set(postings_add.keys()) | set(postings_delete.keys()):
+            posting = self.get_value(
+                self.db_claim_ent_inv, key, bytes_value=cf.ToBytesType.INT_BITMAP
+            )
+            if posting is None:
+                posting = BitMap()
+            if postings_delete.get(key):
+                posting -= BitMap(postings_delete[key])
+            if postings_add.get(key):
+                posting |= BitMap(postings_add[key])
+            if posting:
+                postings[key] = posting
+            else:
+                postings_empty.append(key)
+        if postings:
+            self.write_bulk(
+                self._env,
+                self.db_claim_ent_inv,
+                postings,
+                bytes_value=cf.ToBytesType.INT_BITMAP,
+            )
+        if postings_empty:
+            self.delete(self.db_claim_ent_inv, postings_empty)
+        if types:
+            # After the postings, the P279 postings are the subclasses
+            self._update_types(types)
+        self.clear_caches()
+        return len(wd_objs)
+
+
+# Trie, build profile, and claims format of the json dump worker processes (see
+# build_from_json_dump)
+_worker_trie = None
+_worker_profile = None
+_worker_claims_bytes_value = cf.ToBytesType.OBJ
+
+
+def init_json_dump_worker(
+    trie_file=None, trie=None, profile=None, claims_bytes_value=cf.ToBytesType.OBJ
+):
+    global _worker_trie, _worker_profile, _worker_claims_bytes_value
+    if trie is None:
+        # Memory map the trie, so the workers share the same pages
+        trie = marisa_trie.Trie()
+        trie.mmap(trie_file)
+        # Worker process: the decoded entities have no reference cycles, the
+        # garbage collector would only rescan their containers while they are
+        # created
+        gc.disable()
+    _worker_trie = trie
+    _worker_profile = profile
+    _worker_claims_bytes_value = claims_bytes_value
+
+
+def normalize_build_profile(profile):
+    """
+    :return: the profile with sorted lists (as stored in the DB), or None if
+    it keeps everything
+    """
+    if not profile:
         return None
+    normalized = {}
+    for key, value in profile.items():
+        if key not in BUILD_PROFILE_KEYS:
+            raise ValueError(f"Unknown build profile key: {key}")
+        if value is None:
+            continue
+        if key == "references":
+            normalized[key] = bool(value)
+        else:
+            normalized[key] = sorted(set(value))
+    return normalized or None
+
+
+def filter_wd_obj(wd_obj, profile):
+    """
+    Keep the languages, sites, attributes, and claims of a build profile
+    :return: the filtered entity, or None if it is not an instance of the
+    instance_of filter
+    """
+    if not profile:
+        return wd_obj
+    instance_of = profile.get("instance_of")
+    if instance_of:
+        entity_claims = wd_obj.get("claims", {}).get("wikibase-entityid", {})
+        types = {c_value["value"] for c_value in entity_claims.get("P31", [])}
+        if not types.intersection(instance_of):
+            return None
 
-    if line[-1] == ",":
+    attributes = profile.get("attributes")
+    languages = profile.get("languages")
+    sites = profile.get("sites")
+    claim_types = profile.get("claim_types")
+    references = profile.get("references", True)
+    filtered = {}
+    for attr, value in wd_obj.items():
+        if attributes is not None and attr not in attributes:
+            continue
+        if attr in ("labels", "descriptions", "aliases") and languages is not None:
+            value = {lang: v for lang, v in value.items() if lang in languages}
+        elif attr == "sitelinks" and sites is not None:
+            value = {site: v for site, v in value.items() if site in sites}
+        elif attr == "claims":
+            if claim_types is not None:
+                value = {t: v for t, v in value.items() if t in claim_types}
+            if not references:
+                value = {
+                    c_type: {
+                        c_prop: [{"value": c_value["value"]} for c_value in c_values]
+                        for c_prop, c_values in c_statements.items()
+                    }
+                    for c_type, c_statements in value.items()
+                }
+        filtered[attr] = value
+    return filtered
+
+
+def is_wikidata_identifier(wd_obj):
+    if not wd_obj.get("claims") or not wd_obj["claims"].get("wikibase-entityid"):
+        return False
+    for prop in ["P31", "P279"]:
+        if wd_obj["claims"]["wikibase-entityid"].get(prop):
+            prop_values = {
+                i["value"] for i in wd_obj["claims"]["wikibase-entityid"][prop]
+            }
+            if cf.WIKIDATA_IDENTIFIERS.intersection(prop_values):
+                return True
+    return False
+
+
+def encode_ref_nodes(c_refs, get_lid):
+    encode_ref_nodes = []
+    for c_ref_nodes in c_refs:
+        encode_ref_node = {}
+        for ref_type, ref_values in c_ref_nodes.items():
+            encode_ref_type = {}
+            for (ref_prop, ref_value_objs) in ref_values.items():
+                encode_ref_prop = get_lid(ref_prop, ref_prop)
+                encode_ref_values = []
+                for ref_value_obj in ref_value_objs:
+                    if ref_type == "wikibase-entityid":
+                        ref_value_obj = get_lid(ref_value_obj, ref_value_obj)
+                    encode_ref_values.append(ref_value_obj)
+                encode_ref_type[encode_ref_prop] = encode_ref_values
+            encode_ref_node[ref_type] = encode_ref_type
+        encode_ref_nodes.append(encode_ref_node)
+    return encode_ref_nodes
+
+
+def encode_claims(claims, get_lid, postings=None, references=None):
+    """
+    Encode Wikidata IDs of claims to local IDs
+    :param postings: if given, add the (tail lid, pid lid) of entity claims
+    :param references: if given, add the encoded references by statement index
+    instead of storing them in the claims
+    """
+    encode_attr = {}
+    statement_id = 0
+    for c_type, c_statements in claims.items():
+        encode_c_type = {}
+        for c_prop, c_values in c_statements.items():
+            encode_c_prop = get_lid(c_prop, c_prop)
+            encode_c_values = []
+            for c_value in c_values:
+                decode_c_value = c_value["value"]
+                if c_type == "wikibase-entityid":
+                    decode_c_value = get_lid(decode_c_value, decode_c_value)
+                    if postings is not None and isinstance(decode_c_value, int):
+                        postings.add((decode_c_value, encode_c_prop))
+                elif c_type == "quantity":
+                    if decode_c_value[1] != "1":
+                        decode_c_value = (
+                            decode_c_value[0],
+                            get_lid(decode_c_value[1], decode_c_value[1]),
+                        )
+                    else:
+                        decode_c_value = (decode_c_value[0], -1)
+                c_refs = c_value.get("references")
+                if c_refs:
+                    c_refs = encode_ref_nodes(c_refs, get_lid)
+                if c_refs and references is None:
+                    encode_c_values.append(
+                        {"value": decode_c_value, "references": c_refs,}
+                    )
+                else:
+                    encode_c_values.append({"value": decode_c_value})
+                    if c_refs:
+                        references[statement_id] = c_refs
+                statement_id += 1
+            encode_c_type[encode_c_prop] = encode_c_values
+
+        encode_attr[c_type] = encode_c_type
+    return encode_attr
+
+
+def encode_json_dump(json_line):
+    """
+    Parse a json dump line, encode Wikidata IDs to local IDs, and serialize the
+    values. It runs in the worker processes of build_from_json_dump.
+    :return: (lid, {attr: serialized value}, set of (tail lid, pid lid)) or None
+    if the item is skipped
+    """
+    wd_respond = parse_json_dump(json_line)
+    if not wd_respond:
+        return None
+    wd_id, wd_obj = wd_respond
+    lid = _worker_trie.get(wd_id)
+    if lid is None:
+        return None
+    if is_wikidata_identifier(wd_obj):
+        return None
+    wd_obj = filter_wd_obj(wd_obj, _worker_profile)
+    if wd_obj is None:
+        return None
+
+    postings = set()
+    wd_values = encode_wd_obj(
+        wd_obj, _worker_trie.get, postings, _worker_claims_bytes_value
+    )
+    return lid, wd_values, postings
+
+
+def encode_wd_obj(
+    wd_obj,
+    get_lid,
+    postings=None,
+    claims_bytes_value=cf.ToBytesType.OBJ,
+    compress_values=None,
+):
+    """
+    :param claims_bytes_value: format of the claims (see get_claims_bytes_value)
+    :param compress_values: {attr: compress_value} (see get_compress_values),
+    the values of the other attributes are compressed with lz4
+    :return: {attr: serialized value}, the references of the claims are
+    "references": list of (statement index, serialized references)
+    """
+    wd_values = {}
+    for attr, value in wd_obj.items():
+        if not value:
+            continue
+        if attr == "claims":
+            references = {}
+            value = encode_claims(value, get_lid, postings, references)
+            if references:
+                wd_values["references"] = [
+                    (statement_id, serialize_value(refs, compress_value=True))
+                    for statement_id, refs in sorted(references.items())
+                ]
+        if attr == "label":
+            compress_value = False
+        elif compress_values and attr in compress_values:
+            compress_value = compress_values[attr]
+        else:
+            compress_value = True
+        if attr == "claims":
+            bytes_value = claims_bytes_value
+        else:
+            bytes_value = cf.ToBytesType.OBJ
+        wd_values[attr] = serialize_value(
+            value, bytes_value=bytes_value, compress_value=compress_value
+        )
+    return wd_values
+
+
+def add_references(claims, references):
+    """
+    Add the references of db_references ({statement index: references}) to the
+    statements of the claims of an item
+    """
+    if not references:
+        return claims
+    statement_id = 0
+    for c_statements in claims.values():
+        for c_values in c_statements.values():
+            for c_value in c_values:
+                c_refs = references.get(statement_id)
+                if c_refs:
+                    c_value["references"] = c_refs
+                statement_id += 1
+    return claims
+
+
+def get_claim_postings(claims):
+    """
+    :return: set of (tail lid, pid lid) of the entity claims (encoded claims)
+    """
+    postings = set()
+    if not claims or not claims.get("wikibase-entityid"):
+        return postings
+    for claim_prop, claim_value_objs in claims["wikibase-entityid"].items():
+        for claim_value_obj in claim_value_objs:
+            claim_value = claim_value_obj["value"]
+            if isinstance(claim_value, int):
+                postings.add((claim_value, claim_prop))
+    return postings
+
+
+def add_claim_postings(index_builder, head_lid, postings):
+    # haswbstatements keys: "{tail}" and "{tail}|{pid}"
+    for claim_value, claim_prop in postings:
+        index_builder.add(str(claim_value), head_lid)
+        index_builder.add(f"{claim_value}|{claim_prop}", head_lid)
+
+
+def encode_json_dump_shard(shard):
+    return shard[0], [encode_json_dump(line) for line in iter_dump_shard(shard)]
+
+
+def parse_datavalue(value_type, value):
+    if value_type == "wikibase-entityid":
+        return value["id"]
+    if value_type == "time":
+        value = value["time"].replace("T00:00:00Z", "")
+        if value[0] == "+":
+            value = value[1:]
+        return value
+    if value_type == "quantity":
+        unit = value["unit"].replace(cf.WD, "")
+        value = value["amount"]
+        if value[0] == "+":
+            value = value[1:]
+        return value, unit
+    if value_type == "monolingualtext":
+        return value["text"]
+    return value
+
+
+def parse_references(references):
+    nodes = []
+    for reference_node in references:
+        snaks = reference_node.get("snaks")
+        if not snaks:
+            continue
+        node = {}
+        for ref_prop, ref_claims in snaks.items():
+            for ref_claim in ref_claims:
+                datavalue = ref_claim.get("datavalue")
+                if datavalue is None:
+                    continue
+                ref_type = datavalue["type"]
+                ref_values = node.get(ref_type)
+                if ref_values is None:
+                    ref_values = node[ref_type] = defaultdict(list)
+                ref_values[ref_prop].append(
+                    parse_datavalue(ref_type, datavalue["value"])
+                )
+        nodes.append(node)
+    return nodes
+
+
+def parse_json_dump(json_line, skip_unused=True):
+    """
+    Parse an entity line of the json dump
+    :param skip_unused: cut the qualifiers out of the line before decoding it, and
+    decode it with orjson if it is installed. The parsed entity is the same.
+    :return: (Wikidata ID, entity) or None
+    """
+    if isinstance(json_line, str):
+        json_line = json_line.encode(cf.ENCODING)
+    elif isinstance(json_line, bytearray):
+        json_line = bytes(json_line)
+    line = json_line.rstrip()
+    if not line or line in (b"[", b"]"):
+        return None
+
+    if line[-1:] == b",":
         line = line[:-1]
     try:
-        obj = ujson.loads(line)
+        if skip_unused:
+            obj = loads_json(skip_json_qualifiers(line))
+        else:
+            obj = ujson.loads(line)
     except ValueError:
         return None
+    return parse_json_obj(obj)
+
+
+def parse_json_obj(obj):
     if obj["type"] != "item" and is_wd_item(obj["id"]) is False:
         return None
 
@@ -908,90 +2837,29 @@ def parse_json_dump(json_line):
 
     # Statements
     if obj.get("claims"):
+        wd_claims = wd_obj["claims"] = defaultdict()
         for prop, claims in obj["claims"].items():
-            if wd_obj.get("claims") is None:
-                wd_obj["claims"] = defaultdict()
-
-            # if wd_obj.get("claims_provenance") is None:
-            #     wd_obj["claims_provenance"] = defaultdict()
-
             for claim in claims:
-                if (
-                    claim.get("mainsnak") is None
-                    or claim["mainsnak"].get("datavalue") is None
-                ):
+                mainsnak = claim.get("mainsnak")
+                if mainsnak is None:
+                    continue
+                datavalue = mainsnak.get("datavalue")
+                if datavalue is None:
                     continue
-                claim_type = claim["mainsnak"]["datavalue"]["type"]
-                claim_value = claim["mainsnak"]["datavalue"]["value"]
+                claim_type = datavalue["type"]
+                claim_value = parse_datavalue(claim_type, datavalue["value"])
 
                 claim_references = claim.get("references")
                 if claim_references:
-                    nodes = []
-                    for reference_node in claim_references:
-                        if not reference_node.get("snaks"):
-                            continue
-                        node = {}
-                        for ref_prop, ref_claims in reference_node["snaks"].items():
-                            for ref_claim in ref_claims:
-                                if ref_claim.get("datavalue") is None:
-                                    continue
-                                ref_type = ref_claim["datavalue"]["type"]
-                                ref_value = ref_claim["datavalue"]["value"]
-                                if node.get(ref_type) is None:
-                                    node[ref_type] = defaultdict(list)
-
-                                if ref_type == "wikibase-entityid":
-                                    ref_value = ref_value["id"]
-                                elif ref_type == "time":
-                                    ref_value = ref_value["time"]
-                                    ref_value = ref_value.replace("T00:00:00Z", "")
-                                    if ref_value[0] == "+":
-                                        ref_value = ref_value[1:]
-                                elif ref_type == "quantity":
-                                    ref_unit = ref_value["unit"]
-                                    ref_unit = ref_unit.replace(cf.WD, "")
-                                    ref_value = ref_value["amount"]
-                                    if ref_value[0] == "+":
-                                        ref_value = ref_value[1:]
-                                    ref_value = (ref_value, ref_unit)
-                                elif ref_type == "monolingualtext":
-                                    ref_value = ref_value["text"]
-
-                                node[ref_type][ref_prop].append(ref_value)
-                        nodes.append(node)
-                    claim_references = nodes
+                    claim_references = parse_references(claim_references)
                 else:
                     claim_references = []
 
-                if wd_obj["claims"].get(claim_type) is None:
-                    wd_obj["claims"][claim_type] = defaultdict(list)
-
-                # if wd_obj["claims_provenance"].get(claim_type) is None:
-                #     wd_obj["claims_provenance"][claim_type] = defaultdict(list)
-
-                if claim_type == "wikibase-entityid":
-                    claim_value = claim_value["id"]
-                elif claim_type == "time":
-                    claim_value = claim_value["time"]
-                    claim_value = claim_value.replace("T00:00:00Z", "")
-                    if claim_value[0] == "+":
-                        claim_value = claim_value[1:]
-                elif claim_type == "quantity":
-                    claim_unit = claim_value["unit"]
-                    claim_unit = claim_unit.replace(cf.WD, "")
-                    claim_value = claim_value["amount"]
-                    if claim_value[0] == "+":
-                        claim_value = claim_value[1:]
-                    claim_value = (claim_value, claim_unit)
-                elif claim_type == "monolingualtext":
-                    claim_value = claim_value["text"]
-
-                wd_obj["claims"][claim_type][prop].append(
+                claims_type = wd_claims.get(claim_type)
+                if claims_type is None:
+                    claims_type = wd_claims[claim_type] = defaultdict(list)
+                claims_type[prop].append(
                     {"value": claim_value, "references": claim_references}
                 )
-                # wd_obj["claims"][claim_type][prop].append(claim_value)
-                # wd_obj["claims_provenance"][claim_type][prop].append(
-                #     {"value": claim_value, "provenance": claim_references}
-                # )
 
     return wd_id, wd_obj
@@ -0,0 +1,483 @@
+import bz2
+import gzip
+import os
+import re
+from functools import lru_cache
+
+import ujson
+
+import config as cf
+import core.io_worker as iw
+
+try:
+    import indexed_gzip
+except ImportError:
+    indexed_gzip = None
+
+try:
+    import orjson
+except ImportError:
+    orjson = None
+
+# bz2 blocks are not byte aligned, they start with the 48-bit block magic (BCD pi)
+# and the stream ends with the 48-bit end of stream magic (BCD sqrt(pi))
+BZ2_BLOCK_MAGIC = 0x314159265359
+BZ2_EOS_MAGIC = 0x177245385090
+# Max decompressed size of a bz2 block (level 9)
+BZ2_BLOCK_SIZE = 900_000
+# Number of following blocks a bz2 shard may read to finish its last line
+BZ2_MAX_EXTEND_BLOCKS = 16
+
+# MySQL values: a quoted string with backslash escapes, or an unquoted number/NULL
+SQL_STRING = rb"'[^'\\]*(?:\\.[^'\\]*)*'"
+SQL_QUOTED = rb"'([^'\\]*(?:\\.[^'\\]*)*)'"
+SQL_UNQUOTED = rb"([^,()']*)"
+SQL_VALUE = rb"(?:" + SQL_STRING + rb"|[^,()']*)"
+# The rest of a row: unquoted bytes and strings until the closing parenthesis
+SQL_ROW_END = rb"[^'()]*(?:" + SQL_STRING + rb"[^'()]*)*\)"
+SQL_ESCAPES = {
+    b"0": b"\x00",
+    b"b": b"\b",
+    b"n": b"\n",
+    b"r": b"\r",
+    b"t": b"\t",
+    b"Z": b"\x1a",
+}
+SQL_ESCAPE_PATTERN = re.compile(rb"\\(.)", re.DOTALL)
+
+# Json dump statements serialize their qualifiers after the main snak:
+# {"mainsnak":{...},"type":"statement","qualifiers":{...},"qualifiers-order":[...],...
+# A quote after "," or "{" always starts a key (quotes in strings are escaped),
+# so these markers are found without tokenizing the strings
+JSON_QUALIFIERS_START = b',"qualifiers":{'
+JSON_QUALIFIERS_END = b'},"qualifiers-order":['
+JSON_STATEMENT_START = b'"mainsnak":'
+
+
+class DumpReaderWikidata(object):
+    def __init__(self, dir_dump):
+        self.dir_dump = dir_dump
+
+    def __iter__(self):
+        if ".bz2" in self.dir_dump:
+            reader = bz2.BZ2File(self.dir_dump)
+        elif ".gz" in self.dir_dump:
+            reader = gzip.open(self.dir_dump, "rt")
+        else:
+            reader = open(self.dir_dump)
+
+        if reader:
+            for line in reader:
+                yield line
+            reader.close()
+
+
+class DumpShardReaderWikidata(object):
+    """
+    Split a json dump into shards that can be decompressed and parsed
+    independently. A shard is a picklable tuple, workers read its lines with
+    iter_dump_shard.
+    - bz2: groups of bz2 blocks, found by scanning the file for the block magic
+    - gz: ranges of the decompressed data, using a seek point index
+    (requires indexed_gzip)
+    - others: byte ranges of the file
+    The bz2 block list and the gzip index are built once and saved next to the dump.
+    """
+
+    def __init__(self, dir_dump, shard_size=cf.DUMP_SHARD_SIZE):
+        self.dir_dump = dir_dump
+        self.shard_size = shard_size
+        self.dir_index = f"{dir_dump}.shards.pkl"
+
+    def is_shardable(self):
+        if ".gz" in self.dir_dump and indexed_gzip is None:
+            return False
+        return True
+
+    def get_shards(self):
+        if not self.is_shardable():
+            iw.print_status(
+                f"Install indexed_gzip to read {self.dir_dump} in parallel shards"
+            )
+            return None
+        if ".bz2" in self.dir_dump:
+            return self._get_bz2_shards()
+        if ".gz" in self.dir_dump:
+            return self._get_gz_shards()
+        return self._get_range_shards(
+            os.path.getsize(self.dir_dump), kind="raw", index_file=None
+        )
+
+    def __iter__(self):
+        shards = self.get_shards()
+        if shards is None:
+            for line in DumpReaderWikidata(self.dir_dump):
+                yield line
+            return
+        for shard in shards:
+            for line in iter_dump_shard(shard):
+                yield line
+
+    def _get_dump_stat(self):
+        stat = os.stat(self.dir_dump)
+        return stat.st_size, stat.st_mtime
+
+    def _load_index(self):
+        # The index is rebuilt if the dump file changed
+        if os.path.exists(self.dir_index):
+            index = iw.load_obj_pkl(self.dir_index)
+            if index.get("dump_stat") == self._get_dump_stat():
+                return index["index"]
+        return None
+
+    def _save_index(self, index):
+        iw.save_obj_pkl(
+            self.dir_index,
+            {"dump_stat": self._get_dump_stat(), "index": index},
+            is_message=False,
+        )
+
+    def _get_range_shards(self, file_size, kind, index_file):
+        shards = []
+        for i, start in enumerate(range(0, file_size, self.shard_size)):
+            end = min(start + self.shard_size, file_size)
+            shards.append((i, self.dir_dump, kind, (start, end, index_file)))
+        return shards
+
+    def _get_gz_shards(self):
+        index_file = f"{self.dir_dump}.gzidx"
+        file_size = self._load_index()
+        if file_size is None or not os.path.exists(index_file):
+            iw.print_status(f"Build gzip seek point index: {index_file}")
+            with indexed_gzip.IndexedGzipFile(
+                self.dir_dump, spacing=cf.DUMP_GZIP_INDEX_SPACING
+            ) as f:
+                f.build_full_index()
+                file_size = f.seek(0, os.SEEK_END)
+                f.export_index(index_file)
+            self._save_index(file_size)
+        return self._get_range_shards(file_size, kind="gz", index_file=index_file)
+
+    def _get_bz2_shards(self):
+        blocks = self._load_index()
+        if blocks is None:
+            iw.print_status(f"Find bz2 blocks: {self.dir_dump}")
+            blocks = find_bz2_blocks(self.dir_dump)
+            self._save_index(blocks)
+
+        n_blocks = max(1, self.shard_size // BZ2_BLOCK_SIZE)
+        shards = []
+        for i, start in enumerate(range(0, len(blocks), n_blocks)):
+            end = start + n_blocks
+            prev_block = blocks[start - 1] if start else None
+            shards.append(
+                (
+                    i,
+                    self.dir_dump,
+                    "bz2",
+                    (
+                        blocks[start:end],
+                        prev_block,
+                        blocks[end : end + BZ2_MAX_EXTEND_BLOCKS],
+                    ),
+                )
+            )
+        return shards
+
+
+def iter_dump_shard(shard):
+    """
+    Yield the lines (bytes) of a shard. A line belongs to the shard where it
+    starts, the last line is read past the end of the shard.
+    """
+    _, dir_dump, kind, args = shard
+    if kind == "bz2":
+        for line in _iter_bz2_shard(dir_dump, *args):
+            yield line
+        return
+
+    start, end, index_file = args
+    if kind == "gz":
+        reader = indexed_gzip.IndexedGzipFile(dir_dump, index_file=index_file)
+    else:
+        reader = open(dir_dump, "rb")
+    with reader:
+        if start:
+            # Skip the line which started in the previous shard
+            reader.seek(start - 1)
+            reader.readline()
+        pos = reader.tell()
+        while pos < end:
+            line = reader.readline()
+            if not line:
+                break
+            pos += len(line)
+            yield line
+
+
+def _iter_bz2_shard(dir_dump, blocks, prev_block, next_blocks):
+    with open(dir_dump, "rb") as fp:
+        skip_first = False
+        if prev_block:
+            skip_first = not decompress_bz2_block(fp, *prev_block).endswith(b"\n")
+
+        buff = b""
+        for block in blocks:
+            buff += decompress_bz2_block(fp, *block)
+            if skip_first:
+                pos = buff.find(b"\n")
+                if pos == -1:
+                    buff = b""
+                    continue
+                buff = buff[pos + 1 :]
+                skip_first = False
+            lines = buff.split(b"\n")
+            buff = lines.pop()
+            for line in lines:
+                yield line + b"\n"
+
+        if skip_first or not buff:
+            return
+        for block in next_blocks:
+            data = decompress_bz2_block(fp, *block)
+            pos = data.find(b"\n")
+            if pos != -1:
+                yield buff + data[: pos + 1]
+                return
+            buff += data
+        if next_blocks and len(next_blocks) == BZ2_MAX_EXTEND_BLOCKS:
+            raise ValueError(f"Line is longer than {BZ2_MAX_EXTEND_BLOCKS} bz2 blocks")
+        yield buff
+
+
+def find_bit_pattern(data, pattern, n_bytes=6):
+    """
+    Find a 48-bit pattern at any bit offset of data
+    :return: set of bit positions
+    """
+    positions = set()
+    needle = pattern.to_bytes(n_bytes, "big")
+    i = data.find(needle)
+    while i != -1:
+        positions.add(i * 8)
+        i = data.find(needle, i + 1)
+
+    for shift in range(1, 8):
+        # The pattern spans 7 bytes, the 5 middle bytes are fixed
+        window = (pattern << (8 - shift)).to_bytes(n_bytes + 1, "big")
+        first_mask = (1 << (8 - shift)) - 1
+        last_mask = (0xFF << (8 - shift)) & 0xFF
+        needle = window[1:n_bytes]
+        i = data.find(needle, 1)
+        while i != -1:
+            b = i - 1
+            if (
+                b + n_bytes < len(data)
+                and data[b] & first_mask == window[0]
+                and data[b + n_bytes] & last_mask == window[n_bytes]
+            ):
+                positions.add(b * 8 + shift)
+            i = data.find(needle, i + 1)
+    return positions
+
+
+def find_bz2_blocks(dir_dump, chunk_size=cf.SIZE_512MB):
+    """
+    Scan a bz2 (single or multi stream) file for its blocks
+    :return: list of (start bit, end bit) of the blocks
+    """
+    block_starts, block_ends = set(), set()
+    offset = 0
+    tail = b""
+    with open(dir_dump, "rb") as fp:
+        while True:
+            chunk = fp.read(chunk_size)
+            if not chunk:
+                break
+            data = tail + chunk
+            base = (offset - len(tail)) * 8
+            block_starts.update(
+                base + p for p in find_bit_pattern(data, BZ2_BLOCK_MAGIC)
+            )
+            block_ends.update(base + p for p in find_bit_pattern(data, BZ2_EOS_MAGIC))
+            offset += len(chunk)
+            tail = data[-7:]
+
+    boundaries = sorted(block_starts | block_ends)
+    blocks = []
+    for start, end in zip(boundaries, boundaries[1:]):
+        if start in block_starts:
+            blocks.append((start, end))
+    return blocks
+
+
+def decompress_bz2_block(fp, start_bit, end_bit):
+    """
+    Decompress one bz2 block by wrapping it in a single block stream
+    """
+    n_bits = end_bit - start_bit
+    start_byte, end_byte = start_bit // 8, (end_bit + 7) // 8
+    fp.seek(start_byte)
+    block = int.from_bytes(fp.read(end_byte - start_byte), "big")
+    block >>= end_byte * 8 - end_bit
+    block &= (1 << n_bits) - 1
+
+    # The stream CRC of a single block stream is the block CRC
+    block_crc = (block >> (n_bits - 80)) & 0xFFFFFFFF
+    stream = (block << 80) | (BZ2_EOS_MAGIC << 32) | block_crc
+    n_bits += 80
+    padding = -n_bits % 8
+    stream <<= padding
+    stream = b"BZh9" + stream.to_bytes((n_bits + padding) // 8, "big")
+    return bz2.decompress(stream)
+
+
+@lru_cache(maxsize=None)
+def _compile_sql_row(columns, types):
+    """
+    Compile a pattern of the rows which captures the values of the columns
+    :return: pattern, list of (converter, group indexes) of the columns
+    """
+    column_types = dict(zip(columns, types))
+    parts, converters = [], []
+    n_groups = 0
+    for column in range(max(columns) + 1):
+        column_type = column_types.get(column)
+        if column_type is None:
+            parts.append(SQL_VALUE)
+        elif column_type in (int, float):
+            # Numbers are not quoted
+            parts.append(SQL_UNQUOTED)
+            converters.append((column_type, (n_groups,)))
+            n_groups += 1
+        else:
+            parts.append(rb"(?:" + SQL_QUOTED + rb"|" + SQL_UNQUOTED + rb")")
+            converters.append((column_type, (n_groups, n_groups + 1)))
+            n_groups += 2
+    # Keep the requested column order
+    converters = [converters[sorted(columns).index(column)] for column in columns]
+    pattern = rb"\(" + rb",".join(parts) + rb"(?:,|(?=\)))" + SQL_ROW_END
+    return re.compile(pattern, re.DOTALL), converters
+
+
+def unescape_sql_value(value):
+    if b"\\" not in value:
+        return value
+    return SQL_ESCAPE_PATTERN.sub(
+        lambda m: SQL_ESCAPES.get(m.group(1), m.group(1)), value
+    )
+
+
+def convert_sql_column(groups, column_type, indexes, has_escapes):
+    """
+    Convert the values of a column of the rows of a statement
+    :param groups: captured groups of the rows, by group index
+    """
+    if len(indexes) == 1:
+        values = groups[indexes[0]]
+        if b"NULL" in values:
+            return [None if v == b"NULL" else column_type(v) for v in values]
+        return list(map(column_type, values))
+
+    values, unquoted = groups[indexes[0]], groups[indexes[1]]
+    if any(unquoted):
+        # NULL or unquoted values in a string column
+        values = [
+            v if not u else (None if u == b"NULL" else u)
+            for v, u in zip(values, unquoted)
+        ]
+    if has_escapes:
+        values = [v if v is None else unescape_sql_value(v) for v in values]
+    if column_type is bytes:
+        return list(values)
+    if column_type is str:
+        return [v if v is None else v.decode(cf.ENCODING) for v in values]
+    return [v if v is None else column_type(v) for v in values]
+
+
+def parse_sql_insert(line, columns, types=None):
+    """
+    Parse a MySQL INSERT INTO ... VALUES statement (bytes) without decoding it
+    :param columns: indexes of the columns to return
+    :param types: type of each returned column: int, float, str, or bytes
+    (default). Strings are unescaped, NULL values are None.
+    :return: iterator of tuples of the requested columns
+    """
+    columns = tuple(columns)
+    if types is None:
+        types = (bytes,) * len(columns)
+    pattern, converters = _compile_sql_row(columns, tuple(types))
+    start = line.find(b" VALUES ")
+    if start == -1:
+        return
+    # Each match consumes a whole row, so a parenthesis in a string is never
+    # taken as the start of a row
+    rows = pattern.findall(line, start + 8)
+    if not rows:
+        return
+    if pattern.groups == 1:
+        groups = [rows]
+    else:
+        groups = list(zip(*rows))
+    has_escapes = b"\\" in line
+    values = [
+        convert_sql_column(groups, column_type, indexes, has_escapes)
+        for column_type, indexes in converters
+    ]
+    for row in zip(*values):
+        yield row
+
+
+def iter_sql_dump(dir_dump, columns, types=None):
+    """
+    Yield the rows of the INSERT statements of a (gzip) MySQL dump
+    """
+    if dir_dump.endswith(".gz"):
+        reader = gzip.open(dir_dump, "rb")
+    else:
+        reader = open(dir_dump, "rb")
+    with reader:
+        for line in reader:
+            if not line.startswith(b"INSERT INTO"):
+                continue
+            for row in parse_sql_insert(line, columns, types):
+                yield row
+
+
+def skip_json_qualifiers(line):
+    """
+    Cut the qualifiers of the statements out of a json dump line (bytes), so they
+    are not decoded. The line is returned as is if a statement does not follow
+    the dump layout.
+    """
+    start = line.find(JSON_QUALIFIERS_START)
+    if start == -1:
+        return line
+    parts = []
+    end = 0
+    while start != -1:
+        parts.append(line[end:start])
+        end = line.find(JSON_QUALIFIERS_END, start)
+        # The qualifiers end in the statement where they start
+        if end == -1 or line.find(JSON_STATEMENT_START, start, end) != -1:
+            return line
+        end = line.find(b"]", end + len(JSON_QUALIFIERS_END))
+        if end == -1:
+            return line
+        end += 1
+        start = line.find(JSON_QUALIFIERS_START, end)
+    parts.append(line[end:])
+    return b"".join(parts)
+
+
+def loads_json(line):
+    """
+    Decode json with orjson if it is installed, or ujson
+    """
+    if orjson is not None:
+        try:
+            return orjson.loads(line)
+        except orjson.JSONDecodeError:
+            # e.g., lone surrogates, ujson decodes them
+            pass
+    return ujson.loads(line)
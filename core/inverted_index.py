@@ -0,0 +1,112 @@
+import heapq
+import os
+import tempfile
+from collections import defaultdict
+
+import msgpack
+from pyroaring import BitMap
+from tqdm import tqdm
+
+import config as cf
+import core.io_worker as iw
+from core.db_core import DBCore, serialize_key
+
+# Approximate memory of a key (str, dict entry, BitMap object) and a posting
+SIZE_INDEX_KEY = 200
+SIZE_INDEX_POSTING = 4
+
+
+class InvertedIndexBuilder(object):
+    """
+    External memory builder of an inverted index (key -> BitMap of integers).
+    Postings are accumulated in memory. When the memory budget is reached, they
+    are flushed as a sorted run to a temporary file. Saving k-way merges the
+    runs, ORs the bitmaps of the same key, and writes the postings in key order,
+    so the peak memory is bounded by the budget and the number of runs.
+    The run files are durable, a builder can be restored from the runs of an
+    interrupted build.
+    """
+
+    def __init__(self, dir_runs=None, buff_limit=cf.SIZE_512MB, runs=None):
+        """
+        :param dir_runs: parent directory of the temporary run folder
+        :param runs: run files of a previous builder, to continue its build
+        """
+        if runs:
+            self.dir_runs = os.path.dirname(runs[0])
+            self.runs = list(runs)
+        else:
+            self.dir_runs = tempfile.mkdtemp(prefix="runs_", dir=dir_runs)
+            self.runs = []
+        self.buff_limit = buff_limit
+        self.buff = defaultdict(BitMap)
+        self.buff_size = 0
+
+    def add(self, key, value):
+        posting = self.buff.get(key)
+        if posting is None:
+            posting = self.buff[key]
+            self.buff_size += SIZE_INDEX_KEY
+        posting.add(value)
+        self.buff_size += SIZE_INDEX_POSTING
+        if self.buff_size >= self.buff_limit:
+            self.flush()
+
+    def flush(self):
+        if not self.buff:
+            return None
+        dir_run = os.path.join(self.dir_runs, f"{len(self.runs)}.run")
+        buff = sorted((serialize_key(k), v) for k, v in self.buff.items())
+        with open(dir_run, "wb") as f:
+            packer = msgpack.Packer()
+            for k, v in buff:
+                f.write(packer.pack((k, v.serialize())))
+            f.flush()
+            os.fsync(f.fileno())
+        self.runs.append(dir_run)
+        self.buff = defaultdict(BitMap)
+        self.buff_size = 0
+        return dir_run
+
+    def iter_merged(self):
+        """
+        Yield (key bytes, BitMap) in key order
+        """
+        self.flush()
+        runs = [iter_run(dir_run) for dir_run in self.runs]
+        key_pre, posting_pre = None, None
+        for key, posting in heapq.merge(*runs, key=lambda x: x[0]):
+            if key == key_pre:
+                posting_pre |= posting
+                continue
+            if key_pre is not None:
+                yield key_pre, posting_pre
+            key_pre, posting_pre = key, posting
+        if key_pre is not None:
+            yield key_pre, posting_pre
+
+    def save(self, env, db, buff_limit=cf.SIZE_512MB, message="Save db"):
+        buff = []
+        buff_size = 0
+        for key, posting in tqdm(self.iter_merged(), desc=message):
+            posting = posting.serialize()
+            buff.append((key, posting))
+            buff_size += len(key) + len(posting)
+            if buff_size > buff_limit:
+                DBCore.write_bulk(env, db, buff, sort_key=False, append=True)
+                buff = []
+                buff_size = 0
+        if buff:
+            DBCore.write_bulk(env, db, buff, sort_key=False, append=True)
+
+    def close(self):
+        self.buff = defaultdict(BitMap)
+        self.buff_size = 0
+        self.runs = []
+        iw.delete_folder(self.dir_runs)
+
+
+def iter_run(dir_run):
+    with open(dir_run, "rb") as f:
+        for k, v in msgpack.Unpacker(f, use_list=False):
+            yield k, BitMap.deserialize(v)
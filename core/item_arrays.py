@@ -0,0 +1,418 @@
+import mmap
+import os
+from collections.abc import Sequence
+
+import numpy as np
+from pyroaring import BitMap
+
+import config as cf
+
+# Redirect of the lids which are not redirects
+NO_REDIRECT = np.iinfo(np.uint32).max
+# Code of the lids which are not canonical Wikidata IDs, and lid of the numbers
+# which are not Wikidata IDs
+NO_CODE = np.iinfo(np.uint32).max
+NO_LID = np.iinfo(np.uint32).max
+
+FILE_LABEL_OFFSETS = "label_offsets.npy"
+FILE_LABEL_BLOB = "label_blob.bin"
+FILE_REDIRECTS = "redirects.npy"
+FILE_LID_CODES = "lid_codes.npy"
+FILE_Q_LIDS = "q_lids.npy"
+FILE_P_LIDS = "p_lids.npy"
+
+# Number of labels whose lengths are written to the offsets at once
+SAVE_BATCH_SIZE = 1_000_000
+# Maximum number of digits of the Q/P numbers of the arrays (uint32)
+MAX_NUMBER_DIGITS = 10
+
+
+def save_item_arrays(dir_arrays, size, labels, redirects, wd_codes):
+    """
+    Save the arrays of ItemArrays. The files are written next to the current
+    files and replace them at the end, so the opened arrays stay readable.
+    :param size: number of lids
+    :param labels: iterator of (lid, label) in increasing lid order
+    :param redirects: iterator of (lid, redirect lid)
+    :param wd_codes: iterator of (lid, encoded Wikidata ID), see
+    db_wd.encode_wd_id
+    """
+    os.makedirs(dir_arrays, exist_ok=True)
+    files = [
+        FILE_LABEL_OFFSETS,
+        FILE_LABEL_BLOB,
+        FILE_REDIRECTS,
+        FILE_LID_CODES,
+        FILE_Q_LIDS,
+        FILE_P_LIDS,
+    ]
+    tmp_files = {file: os.path.join(dir_arrays, f"{file}.tmp") for file in files}
+
+    # offsets[lid + 1] is the length of the label of lid, the offsets are their
+    # cumulative sum
+    offsets = np.lib.format.open_memmap(
+        tmp_files[FILE_LABEL_OFFSETS], mode="w+", dtype=np.uint64, shape=(size + 1,)
+    )
+    buff_lids, buff_lengths = [], []
+
+    def save_lengths():
+        offsets[np.array(buff_lids, dtype=np.int64) + 1] = buff_lengths
+        buff_lids.clear()
+        buff_lengths.clear()
+
+    with open(tmp_files[FILE_LABEL_BLOB], "wb") as f:
+        for lid, label in labels:
+            if lid >= size or not label:
+                continue
+            label = label.encode(cf.ENCODING)
+            f.write(label)
+            buff_lids.append(lid)
+            buff_lengths.append(len(label))
+            if len(buff_lids) >= SAVE_BATCH_SIZE:
+                save_lengths()
+    if buff_lids:
+        save_lengths()
+    np.cumsum(offsets, out=offsets)
+    offsets.flush()
+    del offsets
+
+    redirect_array = np.lib.format.open_memmap(
+        tmp_files[FILE_REDIRECTS], mode="w+", dtype=np.uint32, shape=(size,)
+    )
+    redirect_array[:] = NO_REDIRECT
+    for lid, redirect in redirects:
+        if lid < size:
+            redirect_array[lid] = redirect
+    redirect_array.flush()
+    del redirect_array
+
+    save_wd_id_arrays(tmp_files, size, wd_codes)
+
+    for file in files:
+        os.replace(tmp_files[file], os.path.join(dir_arrays, file))
+
+
+def save_wd_id_arrays(files, size, wd_codes):
+    """
+    Save the arrays of lid -> Wikidata ID code, and of item and property
+    number -> lid
+    """
+    lid_codes = np.lib.format.open_memmap(
+        files[FILE_LID_CODES], mode="w+", dtype=np.uint32, shape=(size,)
+    )
+    lid_codes[:] = NO_CODE
+    max_numbers = [-1, -1]
+    buff_lids, buff_codes = [], []
+
+    def save_codes():
+        lid_codes[buff_lids] = buff_codes
+        buff_lids.clear()
+        buff_codes.clear()
+
+    for lid, wd_code in wd_codes:
+        if lid >= size or wd_code is None or wd_code >= NO_CODE:
+            continue
+        buff_lids.append(lid)
+        buff_codes.append(wd_code)
+        if wd_code >> 1 > max_numbers[wd_code & 1]:
+            max_numbers[wd_code & 1] = wd_code >> 1
+        if len(buff_lids) >= SAVE_BATCH_SIZE:
+            save_codes()
+    if buff_lids:
+        save_codes()
+
+    # Item (Q) and property (P) numbers -> lid, from the codes of lid ranges
+    for is_property, file in [(0, FILE_Q_LIDS), (1, FILE_P_LIDS)]:
+        number_lids = np.lib.format.open_memmap(
+            files[file],
+            mode="w+",
+            dtype=np.uint32,
+            shape=(max_numbers[is_property] + 1,),
+        )
+        number_lids[:] = NO_LID
+        for start in range(0, size, SAVE_BATCH_SIZE):
+            codes = lid_codes[start : start + SAVE_BATCH_SIZE].astype(np.int64)
+            lids = np.flatnonzero((codes != NO_CODE) & ((codes & 1) == is_property))
+            number_lids[codes[lids] >> 1] = lids + start
+        number_lids.flush()
+        del number_lids
+    lid_codes.flush()
+    del lid_codes
+
+
+class ItemArrays(object):
+    """
+    Memory mapped arrays of the labels, redirects, and Wikidata IDs of lids (see
+    DBWikidata.build_item_arrays), read without LMDB transactions:
+    - the label of lid is the UTF-8 string blob[offsets[lid]:offsets[lid + 1]]
+    - redirects[lid] is the lid of the redirect of lid, or NO_REDIRECT
+    - lid_codes[lid] is the encoded Wikidata ID of lid (Q{n} -> 2n, P{n} -> 2n+1)
+    - q_lids[n] and p_lids[n] are the lids of Q{n} and P{n}, or NO_LID
+    The arrays are immutable. The labels of the lids which are out of the arrays
+    or changed after the arrays were built (changed) are read from LMDB, and so
+    are the IDs of the lids added after the arrays were built.
+    """
+
+    def __init__(self, dir_arrays, changed=None):
+        self.label_offsets = np.load(
+            os.path.join(dir_arrays, FILE_LABEL_OFFSETS), mmap_mode="r"
+        )
+        self.redirects = np.load(
+            os.path.join(dir_arrays, FILE_REDIRECTS), mmap_mode="r"
+        )
+        self.size = len(self.redirects)
+        with open(os.path.join(dir_arrays, FILE_LABEL_BLOB), "rb") as f:
+            if os.fstat(f.fileno()).st_size:
+                self.label_blob = mmap.mmap(f.fileno(), 0, access=mmap.ACCESS_READ)
+            else:
+                self.label_blob = b""
+        # Indexing the memory views returns ints, it is faster than NumPy scalars
+        self._offsets = memoryview(self.label_offsets)
+        self._redirects = memoryview(self.redirects)
+        # Arrays of the Wikidata IDs (not in the arrays built before them)
+        if os.path.exists(os.path.join(dir_arrays, FILE_LID_CODES)):
+            self.lid_codes, self.q_lids, self.p_lids = [
+                np.load(os.path.join(dir_arrays, file), mmap_mode="r")
+                for file in [FILE_LID_CODES, FILE_Q_LIDS, FILE_P_LIDS]
+            ]
+            self._lid_codes = memoryview(self.lid_codes)
+            self._number_lids = {
+                "Q": memoryview(self.q_lids),
+                "P": memoryview(self.p_lids),
+            }
+        else:
+            self.lid_codes = self.q_lids = self.p_lids = None
+            self._lid_codes = None
+            self._number_lids = {}
+        self.changed = BitMap(changed) if changed else BitMap()
+        self._changed_array = None
+
+    def add_changed(self, lids):
+        self.changed.update(lids)
+        self._changed_array = None
+
+    def is_current(self, lid):
+        """
+        :return: True if the label of lid in the arrays is current
+        """
+        return 0 <= lid < self.size and lid not in self.changed
+
+    def is_current_many(self, lids):
+        """
+        :param lids: NumPy array of lids
+        :return: bool array, vectorized is_current
+        """
+        current = (lids >= 0) & (lids < self.size)
+        if self.changed:
+            if self._changed_array is None:
+                self._changed_array = np.array(self.changed.to_array(), dtype=np.int64)
+            current &= ~np.isin(lids, self._changed_array)
+        return current
+
+    def _get_label(self, lid):
+        if not self.is_current(lid):
+            raise KeyError(lid)
+        start = self._offsets[lid]
+        end = self._offsets[lid + 1]
+        if start == end:
+            return None
+        return self.label_blob[start:end].decode(cf.ENCODING)
+
+    def get_label(self, lid):
+        """
+        :return: label of lid, or of its redirect if lid has no label
+        :raise KeyError: if the label is not current in the arrays
+        """
+        label = self._get_label(lid)
+        if label is None:
+            redirect = self.get_redirect(lid)
+            if redirect is not None and redirect != lid:
+                label = self._get_label(redirect)
+        return label
+
+    def get_redirect(self, lid):
+        """
+        :return: lid of the redirect of lid, None if lid is not a redirect
+        :raise KeyError: if lid is out of the arrays
+        """
+        if not 0 <= lid < self.size:
+            raise KeyError(lid)
+        redirect = self._redirects[lid]
+        if redirect == NO_REDIRECT:
+            return None
+        return redirect
+
+    def get_lid(self, wd_id):
+        """
+        :return: lid of a Wikidata item or property ID, None if it is not in the
+        arrays
+        """
+        number_lids = self._number_lids.get(wd_id[:1])
+        if number_lids is None:
+            return None
+        # The number must be canonical: ASCII digits without leading zeros
+        number = wd_id[1:].encode(cf.ENCODING)
+        if not number.isdigit() or (number[0] == 48 and len(number) > 1):
+            return None
+        number = int(number)
+        if number >= len(number_lids):
+            return None
+        lid = number_lids[number]
+        if lid == NO_LID:
+            return None
+        return lid
+
+    def get_qid(self, lid):
+        """
+        :return: Wikidata ID of lid, None if it is not in the arrays
+        """
+        if self._lid_codes is None or not 0 <= lid < self.size:
+            return None
+        code = self._lid_codes[lid]
+        if code == NO_CODE:
+            return None
+        return f"{'QP'[code & 1]}{code >> 1}"
+
+    def get_lids(self, wd_ids):
+        """
+        Vectorized get_lid, the numbers are parsed from the code points of a
+        NumPy str array
+        :param wd_ids: list or NumPy array of Wikidata IDs
+        :return: int64 array of lids, -1 if an ID is not in the arrays
+        """
+        wd_ids = np.ascontiguousarray(wd_ids, dtype=str)
+        lids = np.full(len(wd_ids), -1, dtype=np.int64)
+        width = wd_ids.dtype.itemsize // 4
+        if self.lid_codes is None or not len(wd_ids) or width < 2:
+            return lids
+        chars = wd_ids.view(np.uint32).reshape(len(wd_ids), width)
+
+        # Canonical IDs: Q or P, then ASCII digits without leading zeros, then the
+        # padding of the str array
+        numbers = np.zeros(len(wd_ids), dtype=np.int64)
+        n_digits = np.zeros(len(wd_ids), dtype=np.int64)
+        ended = np.zeros(len(wd_ids), dtype=bool)
+        valid = np.ones(len(wd_ids), dtype=bool)
+        for i in range(1, width):
+            column = chars[:, i].astype(np.int64)
+            is_end = column == 0
+            ended |= is_end
+            is_digit = (column >= 48) & (column <= 57) & ~ended
+            valid &= is_digit | is_end
+            numbers = np.where(is_digit, numbers * 10 + column - 48, numbers)
+            n_digits += is_digit
+        valid &= (n_digits > 0) & (n_digits <= MAX_NUMBER_DIGITS)
+        valid &= (chars[:, 1] != 48) | (n_digits == 1)
+
+        for prefix, number_lids in [("Q", self.q_lids), ("P", self.p_lids)]:
+            indexes = np.flatnonzero(
+                valid & (chars[:, 0] == ord(prefix)) & (numbers < len(number_lids))
+            )
+            lids[indexes] = number_lids[numbers[indexes]]
+        lids[lids == NO_LID] = -1
+        return lids
+
+    def get_codes(self, lids):
+        """
+        :param lids: NumPy array of lids
+        :return: uint32 array of the encoded Wikidata IDs of lids, NO_CODE if a lid
+        is not in the arrays, None if the arrays have no Wikidata IDs
+        """
+        if self.lid_codes is None:
+            return None
+        codes = np.full(len(lids), NO_CODE, dtype=np.uint32)
+        indexes = np.flatnonzero((lids >= 0) & (lids < self.size))
+        codes[indexes] = self.lid_codes[lids[indexes]]
+        return codes
+
+    def get_labels(self, lids):
+        """
+        Vectorized get_label
+        :param lids: NumPy array of lids
+        :return: list of labels, and the indexes of the lids whose labels are
+        not current in the arrays (their labels are None in the list)
+        """
+        lids = np.asarray(lids, dtype=np.int64)
+        labels = [None] * len(lids)
+        current = self.is_current_many(lids)
+        indexes = np.flatnonzero(current)
+        label_lids = lids[indexes]
+        starts = self.label_offsets[label_lids]
+        ends = self.label_offsets[label_lids + 1]
+
+        # Lids without label get the labels of their redirects
+        no_label = np.flatnonzero(starts == ends)
+        if len(no_label):
+            redirects = self.redirects[label_lids[no_label]].astype(np.int64)
+            no_label = no_label[
+                (redirects != NO_REDIRECT) & (redirects != label_lids[no_label])
+            ]
+            redirects = self.redirects[label_lids[no_label]].astype(np.int64)
+            redirect_current = self.is_current_many(redirects)
+            current[indexes[no_label[~redirect_current]]] = False
+            no_label = no_label[redirect_current]
+            redirects = redirects[redirect_current]
+            starts[no_label] = self.label_offsets[redirects]
+            ends[no_label] = self.label_offsets[redirects + 1]
+
+        blob = self.label_blob
+        for i, start, end in zip(indexes.tolist(), starts.tolist(), ends.tolist()):
+            if start != end:
+                labels[i] = blob[start:end].decode(cf.ENCODING)
+        return labels, np.flatnonzero(~current)
+
+
+class QIDSequence(Sequence):
+    """
+    Lazy sequence of the Wikidata IDs of lids (see DBWikidata.get_qids). The IDs
+    are formatted from their codes when they are read, and the IDs of the lids
+    without code are read with get_qid.
+    """
+
+    def __init__(self, lids, codes, get_qid):
+        """
+        :param lids: NumPy array of lids
+        :param codes: NumPy array of the codes of lids (see ItemArrays.get_codes),
+        or None
+        :param get_qid: function lid -> Wikidata ID
+        """
+        self.lids = lids
+        self.codes = codes
+        self._get_qid = get_qid
+
+    def _decode(self, lid, code):
+        if code == NO_CODE:
+            return self._get_qid(lid)
+        if code & 1:
+            return "P" + str(code >> 1)
+        return "Q" + str(code >> 1)
+
+    def __len__(self):
+        return len(self.lids)
+
+    def __getitem__(self, index):
+        if isinstance(index, slice):
+            codes = None if self.codes is None else self.codes[index]
+            return QIDSequence(self.lids[index], codes, self._get_qid)
+        lid = int(self.lids[index])
+        code = NO_CODE if self.codes is None else int(self.codes[index])
+        return self._decode(lid, code)
+
+    def __iter__(self):
+        lids = self.lids.tolist()
+        if self.codes is None:
+            codes = [NO_CODE] * len(lids)
+        else:
+            codes = self.codes.tolist()
+        get_qid = self._get_qid
+        for lid, code in zip(lids, codes):
+            # Inlined _decode
+            if code == NO_CODE:
+                yield get_qid(lid)
+            elif code & 1:
+                yield "P" + str(code >> 1)
+            else:
+                yield "Q" + str(code >> 1)
+
+    def __repr__(self):
+        return f"QIDSequence({list(self)})"